@@ -0,0 +1,26 @@
+# 批量执行 - 有界并发、单项超时、按输入顺序返回结果
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def run_batch(items, handler, concurrency, timeout, on_error):
+    """
+    以最多 concurrency 个并发执行 handler(item)，按 items 的顺序返回结果。
+
+    - **timeout**: 单项超时（秒），超时或出错的项由 on_error(item, exc) 生成结果，不影响其他项
+    - **on_error**: 出错时的结果构造函数，超时时 exc 为 asyncio.TimeoutError
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(item):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(handler(item), timeout)
+            except Exception as e:
+                logger.error("Batch item failed: %s: %s", type(e).__name__, e,
+                             extra={"event": "batch.item_failed", "error": type(e).__name__})
+                return on_error(item, e)
+
+    return await asyncio.gather(*(run_one(item) for item in items))
@@ -0,0 +1,86 @@
+# 基准测试：导出不同规模的支付订单时的内存峰值——一次性收集后返回 vs 逐页流式输出
+#
+# 运行：python -m backend.benchmarks.bench_export --sizes 1000 5000 20000
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+import stripe
+
+from backend import exports
+from backend.benchmarks.fake_stripe import FakeStripeServer, _new_id
+from backend.gateway import StripeGateway
+from backend.ratelimit import StripeRateLimiter
+
+
+def _seed(server, count):
+    state = server.state
+    with state.lock:
+        state.payment_intents.clear()
+        for i in range(count):
+            intent_id = _new_id("pi")
+            state.payment_intents[intent_id] = {
+                "id": intent_id, "object": "payment_intent", "amount": 1000 + i, "currency": "usd",
+                "created": 1700000000 + i, "status": "succeeded", "payment_method": _new_id("pm"),
+                "metadata": {"merchant_id": str(i % 10), "merchant_order_id": f"order-{i}",
+                             "system_order_id": f"sys-{i}", "external_request_order_id": f"ext-{i}"},
+            }
+
+
+async def _buffered(gateway):
+    # 对照组：先收集全部记录再一次性编码
+    rows = []
+    async for page in exports.payment_pages(gateway, exports.ExportFilter()):
+        rows.extend(page)
+    return len(await _drain(exports.encode_pages(rows, _empty(), exports.FORMAT_CSV, exports.PAYMENT_COLUMNS)))
+
+
+async def _empty():
+    return
+    yield
+
+
+async def _streaming(gateway):
+    pages = exports.payment_pages(gateway, exports.ExportFilter())
+    first_page = await anext(pages, [])
+    size = 0
+    async for chunk in exports.encode_pages(first_page, pages, exports.FORMAT_CSV, exports.PAYMENT_COLUMNS):
+        size += len(chunk)  # 模拟写出到连接后丢弃
+    return size
+
+
+async def _drain(chunks):
+    return "".join([chunk async for chunk in chunks])
+
+
+def _measure(label, export, gateway, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = asyncio.run(export(gateway))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} rows={count:<7} bytes={size:<10} peak={peak / 1024:.0f}KB elapsed={elapsed:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出接口内存峰值对比")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    args = parser.parse_args()
+
+    with FakeStripeServer() as server:
+        stripe.api_base = server.url
+        stripe.api_key = "sk_test_bench"
+        gateway = StripeGateway(limiter=StripeRateLimiter.unlimited())
+        try:
+            for count in args.sizes:
+                _seed(server, count)
+                _measure("buffered", _buffered, gateway, count)
+                _measure("streaming", _streaming, gateway, count)
+        finally:
+            gateway.close()
+
+
+if __name__ == "__main__":
+    main()
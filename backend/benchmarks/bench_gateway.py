@@ -0,0 +1,57 @@
+# 基准测试：同步 SDK 直接调用 vs 异步网关，在 N 个并发请求下的吞吐量
+#
+# 运行：python -m backend.benchmarks.bench_gateway --requests 200 --concurrency 50 --latency-ms 50
+import argparse
+import asyncio
+import time
+
+import stripe
+
+from backend.benchmarks.fake_stripe import FakeStripeServer
+from backend.gateway import StripeGateway
+from backend.ratelimit import StripeRateLimiter
+
+
+async def _blocking_retrieve(payment_id):
+    # 与改造前的接口写法一致：在协程中直接调用同步 SDK
+    return stripe.PaymentIntent.retrieve(payment_id)
+
+
+async def _run(label, make_call, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await make_call()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} requests={total} concurrency={concurrency} "
+          f"elapsed={elapsed:.3f}s throughput={total / elapsed:.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同步 SDK 与异步网关吞吐量对比")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    with FakeStripeServer(latency=args.latency_ms / 1000) as server:
+        stripe.api_base = server.url
+        stripe.api_key = "sk_test_bench"
+        payment_id = stripe.PaymentIntent.create(amount=1000, currency="usd").id
+
+        # 这里只比较线程池的吞吐量，关闭客户端限流
+        gateway = StripeGateway(max_workers=args.concurrency, limiter=StripeRateLimiter.unlimited())
+        try:
+            asyncio.run(_run("blocking", lambda: _blocking_retrieve(payment_id), args.requests, args.concurrency))
+            asyncio.run(_run("gateway", lambda: gateway.retrieve_payment_intent(payment_id),
+                             args.requests, args.concurrency))
+        finally:
+            gateway.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# 负载测试：以固定并发驱动支付服务的主要接口，输出吞吐量、延迟分位数与每请求 CPU 时间（JSON），用于回归对比
+#
+# 服务以子进程启动（python -m backend.test_payment），指向按 --profile 配置的本地 Stripe 替身（见 fake_stripe.PROFILES）；
+# 每个场景在每个并发级别下发起 --requests 个请求，所需的测试数据（支付、停在 3DS 的支付）在计时前经接口预先创建。
+# CPU 时间取自服务进程及其 worker 子进程的 /proc 统计，只在 Linux 上可用，其他平台输出 null。
+#
+# 运行：python -m backend.benchmarks.bench_load --profile typical --concurrency 1 8 32 --requests 500 --output load.json
+# 对比：python -m backend.benchmarks.bench_load --profile typical --baseline load.json --tolerance 0.1
+#       （任一场景吞吐量下降或 p99 上升超过 tolerance 时退出码为 1）
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+from backend.benchmarks.bench_validation import PAYLOAD
+from backend.benchmarks.bench_workers import _ROOT, _UNLIMITED, _free_port
+from backend.benchmarks.fake_stripe import PROFILES, FakeStripeServer
+
+SCENARIOS = ("create", "refund", "details", "card_payments", "cancel")
+# 确认时要求 3DS 验证的测试卡，用于准备可取消的支付
+CARD_3DS = "4000002760003184"
+# refund / details / card_payments 场景轮流使用的支付数
+SEED_PAYMENTS = 20
+
+
+def _payment(tag, card_number=None):
+    payload = copy.deepcopy(PAYLOAD)
+    payload["external_request_order_id"] = f"load-{tag}-{time.time_ns()}"
+    if card_number:
+        payload["order"]["payment_method"]["payment_data"]["card_number"] = card_number
+    return payload
+
+
+def _cpu_seconds(pid):
+    """进程及其全部子进程（多 worker 模式）已消耗的 CPU 时间；无法读取 /proc 时返回 None"""
+    try:
+        ticks = os.sysconf("SC_CLK_TCK")
+        total, pending = 0, [pid]
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        return total / ticks
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+@contextmanager
+def _service(server, workers, env_overrides):
+    """启动支付服务子进程，就绪后返回 (base_url, pid)"""
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=_ROOT, STRIPE_SECRET_KEY="sk_test_load", STRIPE_API_BASE=server.url,
+                   STRIPE_LEDGER_PATH=os.path.join(tmp, "ledger.db"), STRIPE_PREWARM="0", **_UNLIMITED)
+        env.update(env_overrides)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "backend.test_payment", "--port", str(port), "--workers", str(workers)],
+            cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            ready = 0
+            while ready < workers * 4:
+                try:
+                    requests.get(f"{base}/health", timeout=1)
+                    ready += 1
+                except requests.ConnectionError:
+                    if process.poll() is not None:
+                        raise RuntimeError("server exited during startup")
+                    time.sleep(0.05)
+            yield base, process.pid
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def _drive(calls, concurrency):
+    """以 concurrency 个线程（各自一个长连接 Session）执行 calls，返回 [(耗时秒, 状态码, 响应体)] 与总耗时"""
+    local = threading.local()
+
+    def run(call):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = call(session)
+        except requests.RequestException:
+            return time.perf_counter() - start, 0, None
+        elapsed = time.perf_counter() - start
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return elapsed, response.status_code, body
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(run, calls))
+    return results, time.perf_counter() - start
+
+
+def _seed(base, server, count, card_number=None):
+    """经接口创建 count 笔支付，返回 [(PaymentIntent ID, PaymentMethod ID)]"""
+    calls = [lambda session, i=i: session.post(f"{base}/create-payment", json=_payment(f"seed-{i}", card_number))
+             for i in range(count)]
+    results, _ = _drive(calls, 8)
+    seeded = []
+    for _, status, body in results:
+        payment_id = (body or {}).get("channel_order_id") if status == 200 else None
+        if payment_id:
+            seeded.append((payment_id, server.state.payment_intents[payment_id]["payment_method"]))
+    if not seeded:
+        raise RuntimeError("failed to seed payments; check the fake Stripe profile")
+    return seeded
+
+
+def _sync_card_index(base):
+    """触发卡 -> 支付索引的补齐并等待完成，card_payments 场景读本地索引（与已完成补齐的线上服务一致）"""
+    requests.post(f"{base}/card-payments/sync", timeout=30)
+    # 返回 started 说明上一次补齐已经结束（新开始的一次从已完成的游标继续，很快结束）
+    while requests.post(f"{base}/card-payments/sync", timeout=30).json()["status"] != "started":
+        time.sleep(0.1)
+
+
+def _calls(scenario, base, server, requests_count, run_id):
+    if scenario == "create":
+        return [lambda session, i=i: session.post(f"{base}/create-payment", json=_payment(f"{run_id}-{i}"))
+                for i in range(requests_count)]
+    if scenario == "cancel":
+        payments = _seed(base, server, requests_count, CARD_3DS)
+        return [lambda session, payment_id=payment_id: session.post(f"{base}/cancel-payment/{payment_id}")
+                for payment_id, _ in payments]
+    payments = _seed(base, server, SEED_PAYMENTS)
+    if scenario == "refund":
+        return [lambda session, i=i: session.post(f"{base}/refund", json={
+            "channel_order_id": payments[i % len(payments)][0], "refund_amount": 1, "system_order_id": f"sys-{i}",
+            "external_refund_id": f"load-{run_id}-{i}", "refund_request_id": f"req-{i}"})
+                for i in range(requests_count)]
+    if scenario == "details":
+        return [lambda session, i=i: session.get(f"{base}/payment/{payments[i % len(payments)][0]}")
+                for i in range(requests_count)]
+    _sync_card_index(base)
+    return [lambda session, i=i: session.get(f"{base}/card-payments/{payments[i % len(payments)][1]}")
+            for i in range(requests_count)]
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def _measure(scenario, concurrency, base, pid, server, requests_count):
+    calls = _calls(scenario, base, server, requests_count, f"{scenario}-{concurrency}-{time.time_ns()}")
+    upstream_before = server.state.request_count
+    cpu_before = _cpu_seconds(pid)
+    results, elapsed = _drive(calls, concurrency)
+    cpu_after = _cpu_seconds(pid)
+    latencies = sorted(result[0] for result in results)
+    errors = sum(1 for _, status, _ in results if not 200 <= status < 300)
+    failed = sum(1 for _, status, body in results
+                 if 200 <= status < 300 and isinstance(body, dict) and body.get("status") == "failed")
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": errors,
+        "failed": failed,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50": round(_percentile(latencies, 0.50) * 1000, 3),
+            "p90": round(_percentile(latencies, 0.90) * 1000, 3),
+            "p99": round(_percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+        "cpu_ms_per_request": round(cpu * 1000 / len(results), 3) if cpu is not None else None,
+        "upstream_requests": server.state.request_count - upstream_before,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(report, baseline, tolerance):
+    """逐项对比基线，返回是否存在回归；吞吐量下降或 p99 上升超过 tolerance 视为回归"""
+    previous = {(item["scenario"], item["concurrency"]): item for item in baseline["results"]}
+    regressed = False
+    for item in report["results"]:
+        before = previous.get((item["scenario"], item["concurrency"]))
+        if before is None:
+            continue
+        throughput = item["throughput_rps"] / before["throughput_rps"] - 1
+        p99 = item["latency_ms"]["p99"] / before["latency_ms"]["p99"] - 1
+        flag = throughput < -tolerance or p99 > tolerance
+        regressed = regressed or flag
+        print(f"{item['scenario']:<14} c={item['concurrency']:<4} throughput {throughput:+.1%} p99 {p99:+.1%}"
+              f"{'  REGRESSION' if flag else ''}", file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="支付服务负载测试")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="typical", help="Stripe 替身的预设表现")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=500, help="每个场景、每个并发级别的请求数")
+    parser.add_argument("--workers", type=int, default=1, help="服务的 worker 进程数")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="传给服务进程的环境变量，如 STRIPE_CREATE_PAYMENT_MODE=two_step，可重复")
+    parser.add_argument("--output", help="JSON 结果写入该文件，默认输出到标准输出")
+    parser.add_argument("--baseline", help="与之前输出的 JSON 结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    env_overrides = dict(item.split("=", 1) for item in args.env)
+    if args.workers > 1:
+        env_overrides.setdefault("STRIPE_STATE_BACKEND", "sqlite")
+    report = {
+        "meta": {
+            "profile": args.profile,
+            "workers": args.workers,
+            "requests": args.requests,
+            "env": env_overrides,
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": int(time.time()),
+        },
+        "results": [],
+    }
+    with FakeStripeServer.from_profile(args.profile) as server, \
+            _service(server, args.workers, env_overrides) as (base, pid):
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = _measure(scenario, concurrency, base, pid, server, args.requests)
+                report["results"].append(result)
+                cpu = result["cpu_ms_per_request"]
+                print(f"{scenario:<14} c={concurrency:<4} {result['throughput_rps']:>8.1f} req/s "
+                      f"p50={result['latency_ms']['p50']:.1f}ms p99={result['latency_ms']['p99']:.1f}ms "
+                      f"cpu={'-' if cpu is None else f'{cpu:.2f}ms'}/req errors={result['errors']} "
+                      f"failed={result['failed']}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if _compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
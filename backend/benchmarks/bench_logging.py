@@ -0,0 +1,95 @@
+# 基准测试：拒付风暴下每条失败日志在事件循环线程上的耗时——同步 f-string 日志与队列日志管道
+#
+# 模拟一批并发请求全部以 CardError 失败、各自写一条错误日志。日志输出端每次 write 阻塞 --sink-latency-us，
+# 模拟负载高峰时写满的 stderr 管道或容器日志驱动；同步日志的这段阻塞直接落在事件循环线程上。
+#
+# 运行：python -m backend.benchmarks.bench_logging --requests 20000 --sink-latency-us 50
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+import stripe
+
+from backend.logs import configure_logging, flush_logging
+
+logger = logging.getLogger("bench.logging")
+
+
+class SlowSink:
+    """每次 write 阻塞一段时间（释放 GIL，与真实的阻塞 I/O 一致），并统计写出的行数"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lines = 0
+
+    def write(self, text):
+        time.sleep(self.latency)
+        self.lines += text.count("\n")
+
+    def flush(self):
+        pass
+
+
+def _card_error(i):
+    return stripe.error.CardError(f"Your card was declined. (request {i})", "card_number", "card_declined",
+                                  http_status=402, json_body={"error": {"decline_code": "generic_decline"}})
+
+
+async def _storm(requests, log):
+    """requests 个协程各记一条失败日志，返回每次记录在调用方的耗时（秒）"""
+    costs = []
+
+    async def request(i):
+        error = _card_error(i)
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        log(i, error)
+        costs.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(request(i) for i in range(requests)))
+    return costs
+
+
+def _report(label, costs, elapsed, written):
+    costs = sorted(costs)
+    print(f"{label:<8} p50={statistics.median(costs) * 1e6:.1f}us p99={costs[int(len(costs) * 0.99)] * 1e6:.1f}us "
+          f"loop_total={sum(costs) * 1000:.0f}ms wall={elapsed * 1000:.0f}ms lines_written={written}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日志管道开销")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--sink-latency-us", type=float, default=50.0, help="日志输出端每次 write 的阻塞时间")
+    parser.add_argument("--rate-limit", default="20/60", help="同一类错误每个窗口最多输出的条数")
+    args = parser.parse_args()
+
+    root = logging.getLogger()
+    # 原有方式：basicConfig 同步写出，消息在调用处用 f-string 与 str(e) 拼好
+    output = SlowSink(args.sink_latency_us / 1e6)
+    handler = logging.StreamHandler(output)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    start = time.perf_counter()
+    costs = asyncio.run(_storm(args.requests, lambda i, e: logger.error(f"Stripe Error: {str(e)}")))
+    elapsed = time.perf_counter() - start
+    root.removeHandler(handler)
+    _report("sync", costs, elapsed, output.lines)
+
+    for label, rate_limit in (("queue", f"{args.requests}/60"), ("limited", args.rate_limit)):
+        output = SlowSink(args.sink_latency_us / 1e6)
+        configure_logging(log_format="json", rate_limit=rate_limit, queue_size=args.requests, stream=output)
+        start = time.perf_counter()
+        costs = asyncio.run(_storm(args.requests, lambda i, e: logger.error(
+            "Stripe Error: %s", e, extra={"event": "payment.failed", "error": type(e).__name__})))
+        elapsed = time.perf_counter() - start
+        flush_logging()
+        _report(label, costs, elapsed, output.lines)
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# 基准测试：多商户隔离——一个商户的慢请求洪峰对其他商户延迟的影响（单一网关 vs 商户路由），以及路由查找开销
+#
+# 吵闹商户的每个 Stripe 请求耗时 --noisy-latency-ms，并一次性发起 --noisy-requests 个请求；
+# 同时 --quiet-merchants 个普通商户各自串行发起 --quiet-requests 个请求（每个耗时 --quiet-latency-ms）。
+# 单一网关下所有商户共用一组并发名额；商户路由下每个商户有自己的名额、限流预算与熔断器。
+#
+# 运行：python -m backend.benchmarks.bench_merchants --noisy-requests 200 --quiet-merchants 10
+import argparse
+import asyncio
+import statistics
+import time
+
+import stripe
+
+from backend.benchmarks.fake_stripe import FakeStripeServer
+from backend.gateway import StripeGateway
+from backend.merchants import MerchantRegistry
+from backend.ratelimit import DEFAULT_RATES, StripeRateLimiter
+from backend.transport import PooledTransport
+
+NOISY = "m_noisy"
+
+
+def _unlimited_config(account_id):
+    # 关闭限流，只比较并发名额的隔离效果
+    return {"api_key": None, "account_id": account_id, "max_concurrency": None,
+            "rates": dict.fromkeys(DEFAULT_RATES, 1e9), "account_rate": 1e9}
+
+
+async def _run(create, args):
+    """create(merchant_id) 为该商户创建一笔支付；返回普通商户各请求的耗时（秒）及普通、吵闹商户全部完成的时间"""
+    quiet_latencies = []
+
+    async def noisy_request():
+        await create(NOISY)
+
+    async def quiet_merchant(merchant_id):
+        for _ in range(args.quiet_requests):
+            start = time.perf_counter()
+            await create(merchant_id)
+            quiet_latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    flood = asyncio.gather(*(noisy_request() for _ in range(args.noisy_requests)))
+    await asyncio.sleep(0.05)
+    await asyncio.gather(*(quiet_merchant(f"m_quiet_{i}") for i in range(args.quiet_merchants)))
+    quiet_done = time.perf_counter() - start
+    await flood
+    return quiet_latencies, quiet_done, time.perf_counter() - start
+
+
+def _report(label, latencies, quiet_done, total):
+    latencies = sorted(latencies)
+    print(f"{label:<9} quiet p50={statistics.median(latencies) * 1000:.0f}ms "
+          f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.0f}ms quiet_done={quiet_done:.2f}s "
+          f"noisy_done={total:.2f}s")
+
+
+def _lookup(merchant_count, iterations):
+    registry = MerchantRegistry(default=None, path="", max_workers=1)
+    registry.load({f"m_{i}": _unlimited_config(f"acct_{i}") for i in range(merchant_count)})
+    ids = [f"m_{i}" for i in range(merchant_count)]
+    start = time.perf_counter()
+    for i in range(iterations):
+        registry.gateway(ids[i % merchant_count])
+    elapsed = time.perf_counter() - start
+    registry.close()
+    print(f"lookup    {merchant_count} merchants: {elapsed / iterations * 1e9:.0f} ns/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多商户隔离")
+    parser.add_argument("--noisy-requests", type=int, default=200)
+    parser.add_argument("--noisy-latency-ms", type=float, default=300.0)
+    parser.add_argument("--quiet-merchants", type=int, default=10)
+    parser.add_argument("--quiet-requests", type=int, default=20)
+    parser.add_argument("--quiet-latency-ms", type=float, default=20.0)
+    parser.add_argument("--workers", type=int, default=32, help="线程池大小（两种方式相同）")
+    parser.add_argument("--merchant-concurrency", type=int, default=8, help="商户路由下单个商户的在途上限")
+    args = parser.parse_args()
+
+    account_latency = {"acct_noisy": args.noisy_latency_ms / 1000}
+    with FakeStripeServer(latency=args.quiet_latency_ms / 1000, account_latency=account_latency) as server:
+        stripe.api_base = server.url
+        stripe.api_key = "sk_test_bench"
+        stripe.default_http_client = PooledTransport(pool_size=args.workers)
+        accounts = {NOISY: "acct_noisy"}
+        accounts.update({f"m_quiet_{i}": f"acct_quiet_{i}" for i in range(args.quiet_merchants)})
+
+        # 原有方式：一个网关，连接账户随请求切换，所有商户共用并发名额
+        shared = StripeGateway(max_workers=args.workers, limiter=StripeRateLimiter.unlimited())
+        _report("shared", *asyncio.run(_run(lambda merchant_id: shared.create_payment_intent(
+            amount=1000, currency="usd", stripe_account=accounts[merchant_id]), args)))
+        shared.close()
+
+        registry = MerchantRegistry(default=None, path="", max_workers=args.workers,
+                                    max_concurrency=args.merchant_concurrency)
+        registry.load({merchant_id: _unlimited_config(account) for merchant_id, account in accounts.items()})
+        _report("registry", *asyncio.run(_run(lambda merchant_id: registry.gateway(merchant_id).create_payment_intent(
+            amount=1000, currency="usd"), args)))
+        registry.close()
+        stripe.default_http_client.close()
+
+    _lookup(1000, 1_000_000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# 基准测试：支付详情完整返回 vs fields= 精简摘要，对比响应大小与构建 + 序列化耗时
+#
+# 运行：python -m backend.benchmarks.bench_payment_details --charges 20 --refunds 5
+import argparse
+import json
+import time
+
+import stripe
+from fastapi.encoders import jsonable_encoder
+
+from backend.ledger import build_payment_details, parse_fields, project_payment_details
+
+
+def _charge(i, refunds):
+    # 字段取自真实 Charge 对象的常见子集，体积与线上返回相当
+    charge_id = f"ch_{i:024d}"
+    return {
+        "id": charge_id, "object": "charge", "amount": 10000, "amount_captured": 10000, "amount_refunded": 500 * refunds,
+        "currency": "usd", "status": "succeeded", "paid": True, "captured": True, "refunded": False,
+        "created": 1700000000 + i, "failure_code": None, "failure_message": None, "livemode": False,
+        "billing_details": {"name": "Jane Doe", "email": "jane@example.com", "phone": None,
+                            "address": {"line1": "1 Market St", "line2": "Suite 100", "city": "San Francisco",
+                                        "state": "CA", "postal_code": "94105", "country": "US"}},
+        "outcome": {"network_status": "approved_by_network", "reason": None, "risk_level": "normal",
+                    "risk_score": 32, "seller_message": "Payment complete.", "type": "authorized"},
+        "payment_method_details": {"type": "card", "card": {
+            "brand": "visa", "last4": "4242", "exp_month": 12, "exp_year": 2030, "country": "US", "funding": "credit",
+            "fingerprint": "Xt5EWLLDS7FJjR1c", "network": "visa", "three_d_secure": None,
+            "checks": {"address_line1_check": "pass", "address_postal_code_check": "pass", "cvc_check": "pass"}}},
+        "receipt_url": f"https://pay.stripe.com/receipts/payment/{charge_id}",
+        "metadata": {"system_order_id": "sys_1", "merchant_order_id": "order_1"},
+        "refunds": {"object": "list", "has_more": False, "url": f"/v1/charges/{charge_id}/refunds", "data": [
+            {"id": f"re_{i:012d}{j:012d}", "object": "refund", "amount": 500, "currency": "usd", "charge": charge_id,
+             "created": 1700001000 + j, "reason": "requested_by_customer", "status": "succeeded",
+             "balance_transaction": f"txn_{i:012d}{j:012d}", "receipt_number": None,
+             "metadata": {"external_refund_id": f"refund_{i}_{j}", "refund_request_id": f"req_{i}_{j}"}}
+            for j in range(refunds)
+        ]},
+    }
+
+
+def _payment_intent(charges, refunds):
+    return stripe.util.convert_to_stripe_object({
+        "id": "pi_bench", "object": "payment_intent", "amount": 10000, "currency": "usd", "status": "succeeded",
+        "created": 1700000000, "metadata": {"source": "DD", "merchant_id": "1"},
+        "payment_method": {"id": "pm_bench", "object": "payment_method", "type": "card",
+                           "billing_details": {"name": "Jane Doe"},
+                           "card": {"brand": "visa", "last4": "4242", "exp_month": 12, "exp_year": 2030}},
+        "charges": {"object": "list", "has_more": False, "data": [_charge(i, refunds) for i in range(charges)]},
+    }, "sk_test_bench", None, None)
+
+
+def _measure(label, render, iterations):
+    body = render()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        render()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<16} bytes={len(body):<8} avg={elapsed * 1e6 / iterations:.0f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="支付详情完整返回与精简摘要对比")
+    parser.add_argument("--charges", type=int, default=20)
+    parser.add_argument("--refunds", type=int, default=5, help="每笔 Charge 的退款数")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    payment_intent = _payment_intent(args.charges, args.refunds)
+    fields = parse_fields("status,amount,currency,refunds")
+
+    # 改造前：to_dict 全量转换，由 jsonable_encoder + json.dumps 输出（不含 response_model 的二次校验）
+    def legacy():
+        details = build_payment_details(payment_intent)
+        return json.dumps(jsonable_encoder(details)).encode()
+
+    _measure("full (legacy)", legacy, args.iterations)
+    _measure("full", lambda: build_payment_details(payment_intent).model_dump_json().encode(), args.iterations)
+    _measure("fields=refunds", lambda: project_payment_details(payment_intent, fields).model_dump_json(
+        exclude_unset=True).encode(), args.iterations)
+
+
+if __name__ == "__main__":
+    main()
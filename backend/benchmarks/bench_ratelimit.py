@@ -0,0 +1,87 @@
+# 基准测试：突发流量打到限流的 Stripe 替身时，有无客户端限流的成功率，以及结账与查询的排队延迟
+#
+# 运行：python -m backend.benchmarks.bench_ratelimit --requests 300 --stub-rate 100 --latency-ms 20
+import argparse
+import asyncio
+import statistics
+import time
+
+import stripe
+
+from backend.benchmarks.fake_stripe import FakeStripeServer
+from backend.gateway import StripeGateway
+from backend.ratelimit import KIND_CREATE, KIND_LIST, KIND_READ, KIND_REFUND, StripeRateLimiter
+
+
+async def _burst(gateway, calls):
+    """同时发出全部请求，返回 [(类别, 耗时, 是否成功), ...]"""
+
+    async def one(kind, make_call):
+        start = time.perf_counter()
+        try:
+            await make_call()
+            ok = True
+        except stripe.error.StripeError:
+            ok = False
+        return kind, time.perf_counter() - start, ok
+
+    return await asyncio.gather(*(one(kind, make_call) for kind, make_call in calls))
+
+
+def _report(label, results, elapsed, server):
+    by_kind = {}
+    for kind, latency, ok in results:
+        by_kind.setdefault(kind, []).append((latency, ok))
+    print(f"{label:<12} elapsed={elapsed:.2f}s upstream_429={server.state.throttled_count}")
+    for kind, rows in by_kind.items():
+        latencies = sorted(latency for latency, _ in rows)
+        ok = sum(1 for _, success in rows if success)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"  {kind:<8} ok={ok}/{len(rows)} p50={statistics.median(latencies) * 1000:.0f}ms p95={p95 * 1000:.0f}ms")
+
+
+def _calls(gateway, total, payment_id):
+    # 查询先到、结账后到，用于观察优先级通道能否让结账插队
+    calls = []
+    for i in range(total):
+        if i % 2 == 0:
+            calls.append((KIND_READ, lambda: gateway.retrieve_payment_intent(payment_id)))
+        else:
+            calls.append((KIND_CREATE, lambda: gateway.create_payment_intent(amount=1000, currency="usd")))
+    return sorted(calls, key=lambda call: call[0] != KIND_READ)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="客户端限流与重试调度模拟")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--stub-rate", type=int, default=100, help="替身每秒允许的请求数，超出返回 429")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--workers", type=int, default=64)
+    args = parser.parse_args()
+
+    scenarios = [
+        ("no-limiter", StripeRateLimiter.unlimited()),
+        ("retry-only", StripeRateLimiter(rates=dict.fromkeys((KIND_CREATE, KIND_REFUND, KIND_LIST, KIND_READ), 1e9),
+                                         account_rate=1e9, max_retries=5, backoff_base=0.1, backoff_cap=2)),
+        ("limiter", StripeRateLimiter(rates={KIND_CREATE: args.stub_rate, KIND_READ: args.stub_rate},
+                                      account_rate=args.stub_rate * 0.9, max_retries=5,
+                                      backoff_base=0.1, backoff_cap=2)),
+    ]
+    for label, limiter in scenarios:
+        with FakeStripeServer(latency=args.latency_ms / 1000, rate_limit=args.stub_rate) as server:
+            stripe.api_base = server.url
+            stripe.api_key = "sk_test_bench"
+            payment_id = stripe.PaymentIntent.create(amount=1000, currency="usd").id
+            time.sleep(1)
+
+            gateway = StripeGateway(max_workers=args.workers, limiter=limiter)
+            try:
+                start = time.perf_counter()
+                results = asyncio.run(_burst(gateway, _calls(gateway, args.requests, payment_id)))
+                _report(label, results, time.perf_counter() - start, server)
+            finally:
+                gateway.close()
+
+
+if __name__ == "__main__":
+    main()
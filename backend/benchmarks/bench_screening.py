@@ -0,0 +1,161 @@
+# 基准测试：支付前置风控在真实键基数下的单次耗时、内存与拦截效果——固定内存的概率计数 vs 精确的按键滑动窗口
+#
+# 模拟 --customers 个正常客户（各自的 IP、设备、邮箱与卡，约每 --nat 个客户共用一个出口 IP）按 --rate 每秒的
+# 虚拟时钟随机下单，并每隔 --attack-every 个请求插入一次试卡洪峰：同一 IP 与设备在几秒内轮换 --attack-cards 张新卡。
+# 报告每次 screen() 的耗时、计数结构的内存、正常请求被误拦截数与洪峰请求的拦截比例，
+# 并按规则分别报告洪峰请求的命中率：频次规则几乎总会命中洪峰，单看总拦截比例会掩盖去重规则（不同卡数）的失效，
+# 例如窗口内不同组合数远超 --distinct-capacity 导致去重过滤器饱和时。
+#
+# 运行：python -m backend.benchmarks.bench_screening --requests 1000000 --customers 2000000
+#       python -m backend.benchmarks.bench_screening --requests 2000000 --customers 4000000 --distinct-capacity 500000
+import argparse
+import random
+import statistics
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from backend.screening import COUNT_ATTEMPTS, DEFAULT_RULES, PaymentScreener, _parse_rules, _screen_keys
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ExactScreener:
+    """对照组：每个键一个时间戳队列（去重规则为 值 -> 最近出现时间 的字典），结果精确但内存随键数增长"""
+
+    def __init__(self, rules, clock):
+        self.rules = [rule for rule in _parse_rules(rules) if rule["count"] == COUNT_ATTEMPTS]
+        self.clock = clock
+        self._windows = {rule["name"]: {} for rule in self.rules}
+        self.hits = {rule["name"]: 0 for rule in self.rules}
+
+    def screen(self, data):
+        keys = _screen_keys(data)
+        now = self.clock()
+        hit = None
+        for rule in self.rules:
+            key = keys[rule["key"]]
+            if key is None:
+                continue
+            windows = self._windows[rule["name"]]
+            horizon = now - rule["window"]
+            if rule["distinct"]:
+                seen = windows.setdefault(key, {})
+                seen[keys[rule["distinct"]]] = now
+                for value in [value for value, at in seen.items() if at < horizon]:
+                    del seen[value]
+                value = len(seen)
+            else:
+                times = windows.setdefault(key, deque())
+                times.append(now)
+                while times[0] < horizon:
+                    times.popleft()
+                value = len(times)
+            if value > rule["limit"]:
+                self.hits[rule["name"]] += 1
+                hit = rule["name"]
+        return hit
+
+
+def _request(ip, device, email, card):
+    return SimpleNamespace(
+        env=SimpleNamespace(client_ip=ip, device_info=SimpleNamespace(device_token_id=device)),
+        order=SimpleNamespace(shipping=SimpleNamespace(email=email),
+                              payment_method=SimpleNamespace(payment_data=SimpleNamespace(card_number=card))),
+    )
+
+
+def _customer(rng, i, nat):
+    return (f"10.{(i // nat) >> 16 & 255}.{(i // nat) >> 8 & 255}.{(i // nat) & 255}", f"dev-{i:08d}",
+            f"user{i}@example.com", f"4{rng.randrange(10 ** 15):015d}")
+
+
+def _traffic(args):
+    """生成 (是否洪峰, 请求)；客户属性每次由客户编号确定性地生成，不在内存中保存客户，内存增长只来自被测结构"""
+    rng = random.Random(args.seed)
+    attack = 0
+    for n in range(args.requests):
+        if args.attack_every and n % args.attack_every == 0:
+            attack += 1
+            ip, device = f"203.0.113.{attack % 250}", f"bot-{attack}"
+            for _ in range(args.attack_cards):
+                yield True, _request(ip, device, f"bot{attack}@example.net", f"4{rng.randrange(10 ** 15):015d}")
+        i = rng.randrange(args.customers)
+        yield False, _request(*_customer(random.Random(i), i, args.nat))
+
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096 / 2 ** 20
+
+
+def _run(label, make, args):
+    clock = VirtualClock()
+    before = _rss_mb()
+    screener = make(clock)
+    costs, blocked_legit, attack_total, attack_blocked = [], 0, 0, 0
+    # 各规则命中的洪峰请求数与正常请求数
+    attack_hits = dict.fromkeys(screener.hits, 0)
+    legit_hits = dict.fromkeys(screener.hits, 0)
+    step = 1.0 / args.rate
+    for is_attack, data in _traffic(args):
+        clock.now += step
+        before_hits = dict(screener.hits)
+        start = time.perf_counter()
+        hit = screener.screen(data)
+        costs.append(time.perf_counter() - start)
+        tally = attack_hits if is_attack else legit_hits
+        for name, count in screener.hits.items():
+            tally[name] += count - before_hits[name]
+        if is_attack:
+            attack_total += 1
+            attack_blocked += hit is not None
+        elif hit is not None:
+            blocked_legit += 1
+    memory = _rss_mb() - before
+    costs.sort()
+    print(f"{label:<7} p50={statistics.median(costs) * 1e6:.1f}us p99={costs[int(len(costs) * 0.99)] * 1e6:.1f}us "
+          f"max={costs[-1] * 1e6:.0f}us rss=+{memory:.0f}MB legit_blocked={blocked_legit} "
+          f"attack_blocked={attack_blocked}/{attack_total}")
+    for name in attack_hits:
+        distinct = " (distinct)" if any(rule["name"] == name and rule["distinct"] for rule in screener.rules) else ""
+        print(f"{label:<7}   {name:<16} attack_hit_rate={attack_hits[name] / max(attack_total, 1):.3f} "
+              f"legit_hits={legit_hits[name]}{distinct}")
+    return screener
+
+
+def main():
+    parser = argparse.ArgumentParser(description="支付前置风控")
+    parser.add_argument("--requests", type=int, default=1_000_000, help="正常请求数")
+    parser.add_argument("--customers", type=int, default=2_000_000, help="正常客户数（不同的设备、邮箱与卡）")
+    parser.add_argument("--nat", type=int, default=4, help="平均每个出口 IP 的客户数")
+    parser.add_argument("--rate", type=float, default=1000.0, help="虚拟时钟下的每秒请求数")
+    parser.add_argument("--attack-every", type=int, default=20000, help="每隔多少个正常请求插入一次试卡洪峰，0 为不插入")
+    parser.add_argument("--attack-cards", type=int, default=200, help="每次洪峰轮换的卡数")
+    parser.add_argument("--width", type=int, default=65536)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--distinct-capacity", type=int, help="覆盖所有去重规则的窗口内预计不同组合数（默认使用规则自带的 capacity）")
+    parser.add_argument("--exact", action="store_true", help="同时运行精确的按键滑动窗口作为对照")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    # 不调用 Stripe，不会产生拒付：只保留按请求计数的规则
+    rules = [rule for rule in DEFAULT_RULES if rule.get("count", COUNT_ATTEMPTS) == COUNT_ATTEMPTS]
+    if args.distinct_capacity:
+        rules = [dict(rule, capacity=args.distinct_capacity) if rule.get("distinct") else rule for rule in rules]
+    screener = _run("sketch", lambda clock: PaymentScreener(rules, width=args.width, depth=args.depth,
+                                                            distinct_capacity=args.distinct_capacity, clock=clock), args)
+    print(f"sketch  structures={screener.stats()['memory_bytes'] / 2 ** 20:.1f}MB rules={len(rules)} "
+          f"distinct_rules={sum(1 for rule in rules if rule.get('distinct'))} distinct_fill={screener.distinct_fill()}")
+    if args.exact:
+        _run("exact", lambda clock: ExactScreener(rules, clock), args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# 基准测试：从请求模型得到发往 Stripe 的表单请求体的 CPU 耗时——
+# 手写嵌套字典 + SDK 编码、扁平参数 + SDK 编码、编译计划直接编码
+#
+# 运行：python -m backend.benchmarks.bench_serializers --iterations 50000
+import argparse
+import copy
+import time
+from urllib.parse import parse_qsl, urlencode
+
+from stripe.api_requestor import _api_encode
+
+from backend import serializers
+from backend.benchmarks.bench_validation import PAYLOAD
+from backend.schema import PaymentRequestSchema
+
+
+def _legacy_params(data):
+    # 改造前 create_payment 中的写法（单次往返模式）
+    payment_data = data.order.payment_method.payment_data
+    billing_address = payment_data.billing_address
+    stripe_address = {
+        "line1": billing_address.address1,
+        "line2": billing_address.address2,
+        "city": billing_address.city,
+        "state": billing_address.state,
+        "postal_code": billing_address.zip_code,
+        "country": billing_address.country,
+    }
+    card = {
+        "number": payment_data.card_number,
+        "exp_month": int(payment_data.expiry_month),
+        "exp_year": int("20" + payment_data.expiry_year),
+        "cvc": payment_data.cvv,
+    }
+    billing_details = {
+        "name": payment_data.card_holder_name.full_name,
+        "email": data.order.shipping.email,
+        "address": stripe_address,
+    }
+    intent_params = dict(
+        amount=data.order.payment_amount.value,
+        currency=data.order.payment_amount.currency,
+        confirmation_method="automatic",
+        confirm=True,
+        return_url=data.system_three_ds_return_url,
+        payment_method_options={
+            "card": {
+                "request_three_d_secure": "challenge" if payment_data.requires_3ds else "automatic"
+            }
+        },
+        metadata={
+            "system_order_id": data.system_order_id,
+            "merchant_order_id": data.order.merchant_order_id,
+            "external_request_order_id": data.external_request_order_id,
+            "source": "DD",
+            "merchant_id": data.merchant_id,
+        },
+    )
+    intent_params["payment_method_data"] = {"type": "card", "card": card, "billing_details": billing_details}
+    return intent_params
+
+
+def _sdk_encode(params):
+    # 与 stripe.api_requestor.APIRequestor.request_raw 的编码步骤一致
+    return urlencode(list(_api_encode(params))).replace("%5B", "[").replace("%5D", "]")
+
+
+def _measure(label, encode, data, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        encode(data)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} iterations={iterations} avg={elapsed * 1e6 / iterations:.2f}us "
+          f"throughput={iterations / elapsed:.0f}/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stripe 参数构造与编码的 CPU 耗时")
+    parser.add_argument("--iterations", type=int, default=50000)
+    args = parser.parse_args()
+
+    data = PaymentRequestSchema.model_validate(copy.deepcopy(PAYLOAD))
+    plan = serializers.PAYMENT_INTENT_WITH_METHOD
+
+    # 三种方式发送给 Stripe 的参数必须完全一致（参数顺序无关）
+    legacy_body = sorted(parse_qsl(_sdk_encode(_legacy_params(data))))
+    assert legacy_body == sorted(parse_qsl(_sdk_encode(plan.params(data)))), "serialized params differ"
+    assert legacy_body == sorted(parse_qsl(plan.encode(data))), "encoded body differs"
+
+    legacy = _measure("legacy", lambda d: _sdk_encode(_legacy_params(d)), data, args.iterations)
+    _measure("params", lambda d: _sdk_encode(plan.params(d)), data, args.iterations)
+    compiled = _measure("encode", plan.encode, data, args.iterations)
+    print(f"saving     {(legacy - compiled) * 1e6 / args.iterations:.2f}us per request ({1 - compiled / legacy:.0%})")
+
+
+if __name__ == "__main__":
+    main()
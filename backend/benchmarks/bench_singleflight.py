@@ -0,0 +1,84 @@
+# 基准测试：多个客户端同时轮询同一笔支付（3DS 流程）时，有无请求合并的上游调用数与响应延迟
+#
+# 运行：python -m backend.benchmarks.bench_singleflight --clients 20 --rounds 10 --latency-ms 50
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import stripe
+
+from backend.benchmarks.fake_stripe import FakeStripeServer
+from backend.gateway import StripeGateway
+from backend.ledger import PAYMENT_DETAILS_EXPAND, build_payment_details
+from backend.ratelimit import StripeRateLimiter
+from backend.singleflight import SingleFlight
+
+
+async def _poll(load, clients, rounds, interval, jitter):
+    """每轮所有客户端在 jitter 内先后到达，模拟前端与订单服务同时轮询"""
+    latencies = []
+
+    async def one():
+        await asyncio.sleep(random.uniform(0, jitter))
+        start = time.perf_counter()
+        await load()
+        latencies.append(time.perf_counter() - start)
+
+    for _ in range(rounds):
+        await asyncio.gather(*(one() for _ in range(clients)))
+        await asyncio.sleep(interval)
+    return latencies
+
+
+def _report(label, latencies, upstream):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<12} requests={len(latencies)} upstream={upstream} "
+          f"p50={statistics.median(latencies) * 1000:.0f}ms p95={p95 * 1000:.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="读接口请求合并负载测试")
+    parser.add_argument("--clients", type=int, default=20, help="同时轮询同一笔支付的客户端数")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--interval-ms", type=float, default=100.0, help="两轮轮询的间隔")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="同一轮内客户端到达时间的分散范围")
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    with FakeStripeServer(latency=args.latency_ms / 1000) as server:
+        stripe.api_base = server.url
+        stripe.api_key = "sk_test_bench"
+        gateway = StripeGateway(max_workers=args.clients, limiter=StripeRateLimiter.unlimited())
+        payment_id = asyncio.run(gateway.create_payment_intent(
+            amount=1000, currency="usd", confirm=True,
+            payment_method_data={"type": "card", "card": {"number": "4242424242424242", "exp_month": 12,
+                                                          "exp_year": 2030, "cvc": "123"}},
+        )).id
+        # 停留在 3DS 验证中，与线上轮询的场景一致
+        server.state.payment_intents[payment_id]["status"] = "requires_action"
+
+        async def load():
+            payment_intent = await gateway.retrieve_payment_intent(payment_id, expand=PAYMENT_DETAILS_EXPAND)
+            return build_payment_details(payment_intent)
+
+        reads = SingleFlight()
+
+        async def coalesced():
+            return await reads.do(("payment_details", payment_id), load)
+
+        try:
+            for label, call in (("direct", load), ("coalesced", coalesced)):
+                before = server.state.request_count
+                latencies = asyncio.run(_poll(call, args.clients, args.rounds, args.interval_ms / 1000,
+                                              args.jitter_ms / 1000))
+                _report(label, latencies, server.state.request_count - before)
+            print(f"stats        {reads.stats()['payment_details']}")
+        finally:
+            gateway.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# 基准测试：冷启动到第一笔支付成功的耗时，以及启动后首批并发支付的延迟（有无启动预热）
+#
+# 每次运行启动一个新的 uvicorn 进程（--factory backend.test_payment:create_app），指向本地 Stripe 替身；
+# 替身为每条新连接加上握手耗时，模拟到 api.stripe.com 的 DNS + TCP + TLS。
+#
+# 运行：python -m backend.benchmarks.bench_startup --runs 3 --burst 8 --connect-latency-ms 100
+import argparse
+import copy
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from backend.benchmarks.bench_validation import PAYLOAD
+from backend.benchmarks.fake_stripe import FakeStripeServer
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _payment(i):
+    payload = copy.deepcopy(PAYLOAD)
+    payload["external_request_order_id"] = f"startup-{time.time_ns()}-{i}"
+    return payload
+
+
+def _run_once(server, prewarm, burst, connections):
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=_ROOT, STRIPE_SECRET_KEY="sk_test_bench", STRIPE_API_BASE=server.url,
+                   STRIPE_LEDGER_PATH=os.path.join(tmp, "ledger.db"), STRIPE_PREWARM="1" if prewarm else "0",
+                   STRIPE_PREWARM_CONNECTIONS=str(connections))
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "--factory", "backend.test_payment:create_app",
+             "--port", str(port), "--log-level", "warning"],
+            cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            session = requests.Session()
+            while True:
+                try:
+                    session.get(f"{base}/health", timeout=1)
+                    break
+                except requests.ConnectionError:
+                    if process.poll() is not None:
+                        raise RuntimeError("uvicorn exited during startup")
+                    time.sleep(0.005)
+            ready = time.perf_counter() - start
+
+            def pay(i):
+                sent = time.perf_counter()
+                response = requests.post(f"{base}/create-payment", json=_payment(i), timeout=30)
+                done = time.perf_counter()
+                return response.status_code, done - sent, done - start
+
+            with ThreadPoolExecutor(burst) as pool:
+                results = list(pool.map(pay, range(burst)))
+            if any(status != 200 for status, _, _ in results):
+                raise RuntimeError(f"payment failed: {[status for status, _, _ in results]}")
+            return {
+                "ready": ready,
+                "first_payment": min(finished for _, _, finished in results),
+                "burst_p50": statistics.median(latency for _, latency, _ in results),
+                "burst_max": max(latency for _, latency, _ in results),
+            }
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动与首批请求延迟")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--burst", type=int, default=8, help="服务就绪后同时发起的首批支付数")
+    parser.add_argument("--connections", type=int, default=8, help="预热建立的连接数")
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    parser.add_argument("--connect-latency-ms", type=float, default=100.0)
+    args = parser.parse_args()
+
+    with FakeStripeServer(latency=args.latency_ms / 1000, connect_latency=args.connect_latency_ms / 1000) as server:
+        for prewarm in (False, True):
+            runs = [_run_once(server, prewarm, args.burst, args.connections) for _ in range(args.runs)]
+            label = "prewarm" if prewarm else "cold"
+            averages = {key: statistics.mean(run[key] for run in runs) * 1000 for key in runs[0]}
+            print(f"{label:<8} ready={averages['ready']:.0f}ms first_payment={averages['first_payment']:.0f}ms "
+                  f"burst_p50={averages['burst_p50']:.0f}ms burst_max={averages['burst_max']:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# 基准测试：/create-payment 请求体校验的吞吐量与内存分配
+#
+# 运行：python -m backend.benchmarks.bench_validation --iterations 20000
+import argparse
+import copy
+import sys
+import time
+import tracemalloc
+
+from backend.schema import PaymentRequestSchema
+
+_NAME = {"first_name": " Jane ", "last_name": "Doe ", "full_name": " Jane Doe"}
+_ADDRESS = {"country": "US", "state": "CA", "city": "San Francisco", "address1": " 1 Market St ",
+            "address2": "Suite 100", "zip_code": "94105"}
+
+# 与线上请求结构一致：包含设备信息、两件商品、收货信息与元数据，部分字段带首尾空格
+PAYLOAD = {
+    "env": {
+        "terminal_type": "WEB",
+        "client_ip": " 203.0.113.10 ",
+        "browser_info": {"user_agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7)",
+                         "accept_header": "text/html", "java_enabled": False, "java_script_enabled": True,
+                         "language": "en-US"},
+        "device_info": {"color_depth": 24, "screen_height": 1080, "screen_width": 1920, "time_zone_offset": -480,
+                        "device_language": "en-US"},
+    },
+    "order": {
+        "merchant_order_id": "order-0001",
+        "goods": [
+            {"goods_id": f"sku-{i}", "goods_name": " T-shirt ", "goods_category": "apparel", "goods_quantity": 2,
+             "goods_url": "https://shop.example.com/p/1", "goods_price": 1999, "delivery_method_type": "PHYSICAL"}
+            for i in range(2)
+        ],
+        "shipping": {"shipping_name": _NAME, "shipping_address": _ADDRESS, "email": " jane@example.com ",
+                     "phone": "+14155550100", "carrier": "UPS"},
+        "payment_amount": {"currency": "USD", "value": 3998},
+        "payment_method": {
+            "payment_type": "card",
+            "payment_data": {"card_number": "4242424242424242", "expiry_year": "30", "expiry_month": "12",
+                             "cvv": "123", "requires_3ds": False, "country": "US",
+                             "card_holder_name": _NAME, "billing_address": _ADDRESS},
+        },
+        "metadata": {"channel": "web", "campaign": "fall"},
+    },
+    "merchant_id": "merchant-1",
+    "redirect_url": "https://shop.example.com/return",
+    "external_request_order_id": "ext-0001",
+}
+
+
+def _payloads(count, unique_emails, offset=0):
+    # 与 FastAPI 一致，每次校验的都是新解析出的请求体
+    payloads = [copy.deepcopy(PAYLOAD) for _ in range(count)]
+    if unique_emails:
+        for i, payload in enumerate(payloads, offset):
+            payload["order"]["shipping"]["email"] = f"buyer{i}@example.com"
+    return payloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="支付请求校验吞吐量与内存分配")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--unique-emails", action="store_true", help="每个请求使用不同的邮箱，不命中邮箱规范化缓存")
+    args = parser.parse_args()
+
+    payloads = _payloads(args.iterations, args.unique_emails)
+    validate = PaymentRequestSchema.model_validate
+    validate(copy.deepcopy(PAYLOAD))
+
+    start = time.perf_counter()
+    for payload in payloads:
+        validate(payload)
+    elapsed = time.perf_counter() - start
+
+    # 每次校验进入 Python 层的函数调用数（自定义校验器、str() 等），以及新分配且仍被结果模型持有的内存
+    payloads = _payloads(1000, args.unique_emails, offset=args.iterations)
+    calls = 0
+
+    def profiler(frame, event, arg):
+        nonlocal calls
+        if event in ("call", "c_call"):
+            calls += 1
+
+    sys.setprofile(profiler)
+    for payload in payloads[:100]:
+        validate(payload)
+    sys.setprofile(None)
+
+    models = []
+    tracemalloc.start()
+    start_memory, _ = tracemalloc.get_traced_memory()
+    for payload in payloads[100:]:
+        models.append(validate(payload))
+    allocated = tracemalloc.get_traced_memory()[0] - start_memory
+    tracemalloc.stop()
+
+    print(f"validate  iterations={args.iterations} elapsed={elapsed:.3f}s "
+          f"throughput={args.iterations / elapsed:.0f} req/s avg={elapsed * 1e6 / args.iterations:.1f}us")
+    print(f"python    calls_per_request={calls / 100:.0f} allocated_per_request={allocated / 900:.0f}B")
+
+
+if __name__ == "__main__":
+    main()
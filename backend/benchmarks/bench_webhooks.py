@@ -0,0 +1,94 @@
+# 基准测试：Webhook 接收（验签 + 去重 + 落库 + 入队）与后台处理吞吐量
+#
+# 运行：python -m backend.benchmarks.bench_webhooks --events 5000 --intents 200
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import stripe
+
+from backend.benchmarks.fake_stripe import FakeStripeServer
+from backend.card_index import CardPaymentIndex
+from backend.gateway import StripeGateway
+from backend.ratelimit import StripeRateLimiter
+from backend.ledger import PaymentLedger
+from backend.webhooks import WebhookProcessor, sign_payload
+
+SECRET = "whsec_bench"
+
+
+def _make_events(intents, total):
+    # 事件时间逐个递增，同一 PaymentIntent 的事件按顺序到达
+    created = int(time.time())
+    events = []
+    for i in range(total):
+        intent = intents[i % len(intents)]
+        event = {
+            "id": f"evt_bench_{i}",
+            "object": "event",
+            "type": "payment_intent.succeeded",
+            "created": created + i,
+            "data": {"object": intent},
+        }
+        payload = json.dumps(event)
+        events.append((payload.encode(), sign_payload(payload, SECRET)))
+    return events
+
+
+async def _run(processor, events):
+    await processor.start()
+
+    start = time.perf_counter()
+    for payload, signature in events:
+        await processor.receive(payload, signature)
+    received = time.perf_counter() - start
+
+    # 同一批事件再投递一次，全部应被去重
+    for payload, signature in events[:1000]:
+        await processor.receive(payload, signature)
+
+    await processor.queue.join()
+    processed = time.perf_counter() - start
+    await processor.stop()
+    return received, processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook 管道吞吐量")
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--intents", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with FakeStripeServer() as server, tempfile.TemporaryDirectory() as tmp:
+        stripe.api_base = server.url
+        stripe.api_key = "sk_test_bench"
+        # 旧版 API 的 PaymentIntent 事件自带 charges 列表
+        intents = [stripe.PaymentIntent.retrieve(stripe.PaymentIntent.create(amount=1000, currency="usd", confirm=True).id,
+                                                 expand=["charges.data"]).to_dict_recursive()
+                   for _ in range(args.intents)]
+        events = _make_events(intents, args.events)
+
+        path = os.path.join(tmp, "bench.db")
+        gateway = StripeGateway(max_workers=args.workers, limiter=StripeRateLimiter.unlimited())
+        ledger = PaymentLedger(path=path)
+        card_index = CardPaymentIndex(path=path)
+        processor = WebhookProcessor(gateway, ledger, card_index, secret=SECRET, path=path, workers=args.workers)
+        try:
+            received, processed = asyncio.run(_run(processor, events))
+        finally:
+            gateway.close()
+
+        print(f"receive   events={args.events} elapsed={received:.3f}s "
+              f"throughput={args.events / received:.0f} events/s "
+              f"avg={received * 1e6 / args.events:.1f}us")
+        print(f"process   events={args.events} elapsed={processed:.3f}s "
+              f"throughput={args.events / processed:.0f} events/s")
+        print(f"stats     {processor.stats()} upstream_requests={server.state.request_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# 基准测试：多 worker 部署的吞吐量随 worker 进程数的变化（SQLite 共享状态后端）
+#
+# 每组配置启动一个新的服务（python -m backend.test_payment --workers N），指向本地 Stripe 替身；
+# 客户端以多个进程并发发起请求，分别测量创建支付（经过 Stripe 替身）与查询支付详情（台账命中）的吞吐量。
+# 吞吐量只会随可用 CPU 核数增长，worker 数超过核数后不再提升。
+#
+# 运行：python -m backend.benchmarks.bench_workers --workers 1 2 4 --duration 10 --clients 4 --threads 8
+import argparse
+import copy
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from backend.benchmarks.bench_validation import PAYLOAD
+from backend.benchmarks.fake_stripe import FakeStripeServer
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 限流调到远高于测试负载，只测服务本身的吞吐量
+_UNLIMITED = {f"STRIPE_RATE_{kind}": "1000000" for kind in ("CREATE", "REFUND", "LIST", "READ", "ACCOUNT")}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _payment(tag):
+    payload = copy.deepcopy(PAYLOAD)
+    payload["external_request_order_id"] = f"workers-{tag}-{time.time_ns()}"
+    return payload
+
+
+def _client(base, endpoint, payment_id, threads, duration, start_at, counts):
+    """单个客户端进程：threads 个线程在 duration 秒内循环发起请求，把成功数放入 counts"""
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.time() + duration
+
+    def loop(thread):
+        session = requests.Session()
+        done = 0
+        while time.time() < deadline:
+            if endpoint == "create":
+                response = session.post(f"{base}/create-payment", json=_payment(f"{os.getpid()}-{thread}"))
+            else:
+                response = session.get(f"{base}/payment/{payment_id}")
+            done += response.status_code == 200
+        return done
+
+    with ThreadPoolExecutor(threads) as pool:
+        counts.put(sum(pool.map(loop, range(threads))))
+
+
+def _run(server, workers, endpoint, clients, threads, duration):
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=_ROOT, STRIPE_SECRET_KEY="sk_test_bench", STRIPE_API_BASE=server.url,
+                   STRIPE_LEDGER_PATH=os.path.join(tmp, "ledger.db"), STRIPE_STATE_BACKEND="sqlite",
+                   STRIPE_PREWARM="0", **_UNLIMITED)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "backend.test_payment", "--port", str(port), "--workers", str(workers)],
+            cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            # 所有 worker 都就绪后再开始计时：连续多次探测成功
+            ready = 0
+            while ready < workers * 4:
+                try:
+                    requests.get(f"{base}/health", timeout=1)
+                    ready += 1
+                except requests.ConnectionError:
+                    if process.poll() is not None:
+                        raise RuntimeError("server exited during startup")
+                    time.sleep(0.05)
+            payment_id = requests.post(f"{base}/create-payment", json=_payment("seed"), timeout=30).json()[
+                "channel_order_id"]
+
+            before = server.state.request_count
+            counts = multiprocessing.Queue()
+            start_at = time.time() + 0.5
+            procs = [multiprocessing.Process(target=_client,
+                                             args=(base, endpoint, payment_id, threads, duration, start_at, counts))
+                     for _ in range(clients)]
+            for proc in procs:
+                proc.start()
+            total = sum(counts.get() for _ in procs)
+            for proc in procs:
+                proc.join()
+            return total / duration, server.state.request_count - before
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多 worker 吞吐量")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--endpoints", nargs="+", choices=["create", "details"], default=["create", "details"])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=4, help="客户端进程数")
+    parser.add_argument("--threads", type=int, default=8, help="每个客户端进程的并发线程数")
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"cpu_count={os.cpu_count()}")
+    with FakeStripeServer(latency=args.latency_ms / 1000) as server:
+        for endpoint in args.endpoints:
+            baseline = None
+            for workers in args.workers:
+                throughput, upstream = _run(server, workers, endpoint, args.clients, args.threads, args.duration)
+                baseline = baseline or throughput
+                print(f"{endpoint:<8} workers={workers} throughput={throughput:,.0f} req/s "
+                      f"speedup={throughput / baseline:.2f}x upstream={upstream}")
+
+
+if __name__ == "__main__":
+    main()
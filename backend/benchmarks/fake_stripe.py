@@ -0,0 +1,490 @@
+# 本地 Stripe 替身服务 - 仅用于基准测试，不访问真实 Stripe
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+def _nest(pairs):
+    """将 Stripe 表单编码（如 card[number]=xxx、expand[0]=yyy）还原为嵌套字典"""
+    result = {}
+    for key, value in pairs:
+        parts = key.replace("]", "").split("[")
+        node = result
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return result
+
+
+def _new_id(prefix):
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+# 与 Stripe 测试卡号一致的行为：确认时需要 3DS 验证，或直接被拒
+CARD_3DS = "3ds"
+CARD_DECLINE = "decline"
+TEST_CARDS = {
+    "4000002760003184": CARD_3DS,
+    "4000002500003155": CARD_3DS,
+    "4000000000000002": CARD_DECLINE,
+    "4000000000009995": CARD_DECLINE,
+}
+
+# 预设的上游表现，FakeStripeServer.from_profile(name) 使用；各项含义见 FakeStripeServer
+PROFILES = {
+    # 无延迟，只测服务本身的开销
+    "instant": {},
+    # 接近 Stripe 线上的常态：中位数约 30ms，带长尾
+    "typical": {"latency": 0.03, "latency_sigma": 0.5, "connect_latency": 0.05},
+    # 上游变慢并伴随少量 5xx
+    "degraded": {"latency": 0.2, "latency_sigma": 0.8, "error_rate": 0.05, "connect_latency": 0.1},
+    # 账户被限流：超过每秒 50 次的请求以及随机 10% 的请求返回 429
+    "throttled": {"latency": 0.03, "rate_limit": 50, "throttle_rate": 0.1},
+    # 半数卡需要 3DS 验证，PaymentIntent 停留在 requires_action
+    "3ds": {"latency": 0.03, "latency_sigma": 0.5, "three_ds_rate": 0.5},
+}
+
+
+class FakeStripeState:
+    """内存中的 Stripe 对象存储，保证并发请求下的一致性"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.payment_methods = {}
+        self.payment_intents = {}
+        self.charges = {}
+        self.refunds = {}
+        self.idempotency = {}
+        # PaymentMethod ID -> 测试卡行为（CARD_3DS / CARD_DECLINE）
+        self.card_behaviours = {}
+        self.request_count = 0
+        self.connection_count = 0
+        self.throttled_count = 0
+        self._window = (0, 0)
+
+    def admit(self, rate_limit):
+        """按一秒固定窗口计数，超过 rate_limit 的请求应返回 429"""
+        with self.lock:
+            second = int(time.monotonic())
+            start, count = self._window
+            count = count + 1 if start == second else 1
+            self._window = (second, count)
+            if count > rate_limit:
+                return False
+            return True
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeStripe/1.0"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.state.lock:
+            self.server.state.connection_count += 1
+        # 每条新连接的建立开销，模拟到 Stripe 的 DNS + TCP + TLS 握手
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+
+    # ---- 请求分发 ----
+    def do_HEAD(self):
+        # 连接池健康检查与预热使用，保持长连接
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self._dispatch("get")
+
+    def do_POST(self):
+        self._dispatch("post")
+
+    def do_DELETE(self):
+        self._dispatch("delete")
+
+    def _dispatch(self, method):
+        split = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        params = _nest(parse_qsl(split.query if method != "post" else body, keep_blank_values=True))
+        state = self.server.state
+        with state.lock:
+            state.request_count += 1
+
+        latency = self.server.account_latency.get(self.headers.get("Stripe-Account"), self.server.latency)
+        if latency and self.server.latency_sigma:
+            # 对数正态分布：中位数为 latency，sigma 越大尾部越长
+            latency *= random.lognormvariate(0, self.server.latency_sigma)
+        if latency:
+            time.sleep(latency)
+        if (self.server.rate_limit and not state.admit(self.server.rate_limit)) or (
+                self.server.throttle_rate and random.random() < self.server.throttle_rate):
+            with state.lock:
+                state.throttled_count += 1
+            return self._send(429, {"error": {"type": "invalid_request_error", "code": "rate_limit",
+                                              "message": "Too many requests hit the API too quickly."}})
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            return self._send(500, {"error": {"type": "api_error", "message": "An unknown error occurred"}})
+
+        # /v1/payment_intents/{id}/cancel -> _post_payment_intents_item_cancel
+        parts = [p for p in split.path.split("/") if p][1:]
+        name = f"_{method}_{parts[0]}" if parts else ""
+        if len(parts) > 1:
+            name += "_item"
+        if len(parts) > 2:
+            name += "_" + "_".join(parts[2:])
+        handler = getattr(self, name, None)
+        if handler is None:
+            return self._send(404, {"error": {"type": "invalid_request_error", "message": f"Unrecognized request URL ({method.upper()}: {split.path})"}})
+
+        # 与 Stripe 一致，幂等键按账户隔离
+        key = self.headers.get("Idempotency-Key")
+        if key:
+            key = (self.headers.get("Stripe-Account"), key)
+        if key and method == "post":
+            with state.lock:
+                cached = state.idempotency.get(key)
+            if cached is not None:
+                return self._send(*cached)
+
+        status, payload = handler(parts[1] if len(parts) > 1 else None, params)
+        if key and method == "post":
+            with state.lock:
+                state.idempotency[key] = (status, payload)
+        self._send(status, payload)
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Request-Id", _new_id("req"))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def _not_found(obj_id):
+        return 404, {"error": {"type": "invalid_request_error", "code": "resource_missing",
+                               "message": f"No such object: '{obj_id}'"}}
+
+    def _paginate(self, items, params, url):
+        created = params.get("created")
+        if isinstance(created, dict):
+            bounds = {op: int(value) for op, value in created.items()}
+            items = [o for o in items if ("gte" not in bounds or o["created"] >= bounds["gte"])
+                     and ("gt" not in bounds or o["created"] > bounds["gt"])
+                     and ("lte" not in bounds or o["created"] <= bounds["lte"])
+                     and ("lt" not in bounds or o["created"] < bounds["lt"])]
+        items = sorted(items, key=lambda o: (o["created"], o["id"]), reverse=True)
+        starting_after = params.get("starting_after")
+        if starting_after:
+            ids = [o["id"] for o in items]
+            items = items[ids.index(starting_after) + 1:] if starting_after in ids else []
+        limit = int(params.get("limit", 10))
+        return 200, {"object": "list", "url": url, "has_more": len(items) > limit, "data": items[:limit]}
+
+    # ---- PaymentMethod ----
+    def _post_payment_methods(self, _, params):
+        card = params.get("card", {})
+        pm = {
+            "id": _new_id("pm"),
+            "object": "payment_method",
+            "type": params.get("type", "card"),
+            "created": int(time.time()),
+            "billing_details": params.get("billing_details", {}),
+            "card": {"brand": "visa", "last4": card.get("number", "0000")[-4:],
+                     "exp_month": int(card.get("exp_month", 12)), "exp_year": int(card.get("exp_year", 2099))},
+            "metadata": {},
+        }
+        behaviour = TEST_CARDS.get(card.get("number", "").replace(" ", ""))
+        with self.server.state.lock:
+            self.server.state.payment_methods[pm["id"]] = pm
+            if behaviour:
+                self.server.state.card_behaviours[pm["id"]] = behaviour
+        return 200, pm
+
+    def _get_payment_methods_item(self, pm_id, _):
+        pm = self.server.state.payment_methods.get(pm_id)
+        return (200, pm) if pm else self._not_found(pm_id)
+
+    # ---- PaymentIntent ----
+    def _post_payment_intents(self, _, params):
+        state = self.server.state
+        pm_id = params.get("payment_method")
+        if not pm_id and "payment_method_data" in params:
+            pm_id = self._post_payment_methods(None, params["payment_method_data"])[1]["id"]
+        now = int(time.time())
+        intent = {
+            "id": _new_id("pi"),
+            "object": "payment_intent",
+            "amount": int(params.get("amount", 0)),
+            "currency": params.get("currency", "usd").lower(),
+            "created": now,
+            "metadata": params.get("metadata", {}),
+            "payment_method": pm_id,
+            "capture_method": params.get("capture_method", "automatic"),
+            "status": "requires_confirmation",
+            "next_action": None,
+            "latest_charge": None,
+        }
+        if params.get("return_url"):
+            intent["return_url"] = params["return_url"]
+        error = None
+        if str(params.get("confirm", "")).lower() == "true":
+            error = self._confirm_with_card(intent)
+        with state.lock:
+            state.payment_intents[intent["id"]] = intent
+        return error or (200, intent)
+
+    def _confirm_with_card(self, intent):
+        """按测试卡行为（或 three_ds_rate）确认：需要 3DS 时停在 requires_action，被拒时返回 402"""
+        behaviour = self.server.state.card_behaviours.get(intent["payment_method"])
+        if behaviour is None and self.server.three_ds_rate and random.random() < self.server.three_ds_rate:
+            behaviour = CARD_3DS
+        if behaviour == CARD_3DS:
+            intent["status"] = "requires_action"
+            intent["next_action"] = {"type": "redirect_to_url", "redirect_to_url": {
+                "url": f"https://hooks.stripe.com/3d_secure_2/hosted?payment_intent={intent['id']}",
+                "return_url": intent.get("return_url")}}
+            return None
+        if behaviour == CARD_DECLINE:
+            intent["status"] = "requires_payment_method"
+            return 402, {"error": {"type": "card_error", "code": "card_declined", "decline_code": "generic_decline",
+                                   "message": "Your card was declined.", "payment_intent": intent}}
+        self._confirm(intent)
+        return None
+
+    def _confirm(self, intent):
+        intent["status"] = "requires_capture" if intent["capture_method"] == "manual" else "succeeded"
+        charge = {
+            "id": _new_id("ch"),
+            "object": "charge",
+            "amount": intent["amount"],
+            "amount_captured": 0 if intent["capture_method"] == "manual" else intent["amount"],
+            "amount_refunded": 0,
+            "currency": intent["currency"],
+            "created": intent["created"],
+            "payment_intent": intent["id"],
+            "payment_method": intent["payment_method"],
+            "status": "succeeded",
+            "paid": True,
+            "refunded": False,
+            "metadata": {},
+        }
+        with self.server.state.lock:
+            self.server.state.charges[charge["id"]] = charge
+        intent["latest_charge"] = charge["id"]
+
+    def _get_payment_intents_item(self, pi_id, params):
+        intent = self.server.state.payment_intents.get(pi_id)
+        if intent is None:
+            return self._not_found(pi_id)
+        expand = set((params.get("expand") or {}).values())
+        result = dict(intent)
+        if "charges.data" in expand:
+            # 模拟旧版 API 中 PaymentIntent 自带的 charges 列表（含各自的 refunds）
+            state = self.server.state
+            charges = [dict(c, refunds={"object": "list", "data": [r for r in state.refunds.values()
+                                                                   if r["charge"] == c["id"]]})
+                       for c in state.charges.values() if c["payment_intent"] == pi_id]
+            result["charges"] = {"object": "list", "data": charges}
+        if "payment_method" in expand and intent["payment_method"]:
+            result["payment_method"] = self.server.state.payment_methods.get(intent["payment_method"])
+        return 200, result
+
+    def _post_payment_intents_item_confirm(self, pi_id, params):
+        intent = self.server.state.payment_intents.get(pi_id)
+        if intent is None:
+            return self._not_found(pi_id)
+        if params.get("payment_method"):
+            intent["payment_method"] = params["payment_method"]
+        if intent["status"] == "requires_action":
+            # 视为持卡人已完成 3DS 验证
+            intent["next_action"] = None
+            self._confirm(intent)
+            return 200, intent
+        if intent["status"] not in ("requires_confirmation", "requires_payment_method"):
+            return 400, {"error": {"type": "invalid_request_error", "code": "payment_intent_unexpected_state",
+                                   "message": f"This PaymentIntent's status is {intent['status']}, so it cannot be confirmed."}}
+        return self._confirm_with_card(intent) or (200, intent)
+
+    def _post_payment_intents_item_cancel(self, pi_id, _):
+        intent = self.server.state.payment_intents.get(pi_id)
+        if intent is None:
+            return self._not_found(pi_id)
+        if intent["status"] in ("succeeded", "canceled"):
+            return 400, {"error": {"type": "invalid_request_error", "code": "payment_intent_unexpected_state",
+                                   "message": f"You cannot cancel this PaymentIntent because it has a status of {intent['status']}."}}
+        intent["status"] = "canceled"
+        return 200, intent
+
+    def _post_payment_intents_item_capture(self, pi_id, params):
+        intent = self.server.state.payment_intents.get(pi_id)
+        if intent is None:
+            return self._not_found(pi_id)
+        if intent["status"] != "requires_capture":
+            return 400, {"error": {"type": "invalid_request_error", "code": "payment_intent_unexpected_state",
+                                   "message": f"This PaymentIntent could not be captured because it has a status of {intent['status']}."}}
+        amount = int(params.get("amount_to_capture", intent["amount"]))
+        intent["status"] = "succeeded"
+        intent["amount_received"] = amount
+        charge = self.server.state.charges.get(intent["latest_charge"])
+        if charge:
+            charge["amount_captured"] = amount
+        return 200, intent
+
+    def _get_payment_intents(self, _, params):
+        items = list(self.server.state.payment_intents.values())
+        return self._paginate(items, params, "/v1/payment_intents")
+
+    # ---- Charge ----
+    def _get_charges(self, _, params):
+        state = self.server.state
+        expand = set((params.get("expand") or {}).values())
+        items = list(state.charges.values())
+        status, page = self._paginate(items, params, "/v1/charges")
+        if "data.payment_intent" in expand:
+            page["data"] = [dict(c, payment_intent=state.payment_intents.get(c["payment_intent"])) for c in page["data"]]
+        return status, page
+
+    # ---- Refund ----
+    def _post_refunds(self, _, params):
+        state = self.server.state
+        intent = state.payment_intents.get(params.get("payment_intent"))
+        if intent is None:
+            return self._not_found(params.get("payment_intent"))
+        if intent["status"] != "succeeded":
+            return 400, {"error": {"type": "invalid_request_error", "code": "charge_not_refundable",
+                                   "message": "This PaymentIntent does not have a successful charge to refund."}}
+        charge = state.charges.get(intent["latest_charge"])
+        amount = int(params.get("amount", charge["amount"] - charge["amount_refunded"]))
+        if amount > charge["amount"] - charge["amount_refunded"]:
+            return 400, {"error": {"type": "invalid_request_error", "code": "amount_too_large",
+                                   "message": "Refund amount is greater than unrefunded amount on charge."}}
+        refund = {
+            "id": _new_id("re"),
+            "object": "refund",
+            "amount": amount,
+            "currency": intent["currency"],
+            "created": int(time.time()),
+            "charge": charge["id"],
+            "payment_intent": intent["id"],
+            "status": "succeeded",
+            "metadata": params.get("metadata", {}),
+        }
+        with state.lock:
+            charge["amount_refunded"] += amount
+            charge["refunded"] = charge["amount_refunded"] >= charge["amount"]
+            state.refunds[refund["id"]] = refund
+        return 200, refund
+
+    def _get_refunds(self, _, params):
+        state = self.server.state
+        items = list(state.refunds.values())
+        if params.get("payment_intent"):
+            items = [r for r in items if r["payment_intent"] == params["payment_intent"]]
+        status, page = self._paginate(items, params, "/v1/refunds")
+        if "data.payment_intent" in set((params.get("expand") or {}).values()):
+            page["data"] = [dict(r, payment_intent=state.payment_intents.get(r["payment_intent"])) for r in page["data"]]
+        return status, page
+
+
+class FakeStripeServer:
+    """
+    在后台线程中运行的本地 Stripe 替身。
+
+    使用方式：
+        with FakeStripeServer(latency=0.05) as server:
+            stripe.api_base = server.url
+
+    - **rate_limit**: 每秒允许的请求数，超出返回 429（0 表示不限流）
+    - **error_rate**: 随机返回 500 的比例，用于验证重试与熔断
+    - **connect_latency**: 每条新连接额外的建立耗时（秒），模拟 TLS 握手
+    - **account_latency**: {连接账户: 秒}，按 Stripe-Account 请求头覆盖 latency，模拟个别商户的慢请求
+    - **latency_sigma**: 大于 0 时每个请求的延迟按对数正态分布抖动，latency 为中位数
+    - **throttle_rate**: 与 rate_limit 无关、随机返回 429 的比例
+    - **three_ds_rate**: 确认支付时要求 3DS 验证的比例；测试卡号（TEST_CARDS）的行为总是生效
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_limit=0, error_rate=0.0, connect_latency=0.0,
+                 account_latency=None, latency_sigma=0.0, throttle_rate=0.0, three_ds_rate=0.0):
+        self.httpd = ThreadingHTTPServer((host, port), FakeStripeHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = FakeStripeState()
+        self.httpd.latency = latency
+        self.httpd.rate_limit = rate_limit
+        self.httpd.error_rate = error_rate
+        self.httpd.connect_latency = connect_latency
+        self.httpd.account_latency = account_latency or {}
+        self.httpd.latency_sigma = latency_sigma
+        self.httpd.throttle_rate = throttle_rate
+        self.httpd.three_ds_rate = three_ds_rate
+        self._thread = None
+
+    @classmethod
+    def from_profile(cls, name, **overrides):
+        """按 PROFILES 中的预设创建，overrides 覆盖其中的单项"""
+        return cls(**dict(PROFILES[name], **overrides))
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def state(self):
+        return self.httpd.state
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-stripe", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地 Stripe 替身服务")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="instant",
+                        help="预设的上游表现，下面单独给出的参数覆盖预设")
+    parser.add_argument("--latency-ms", type=float)
+    parser.add_argument("--latency-sigma", type=float)
+    parser.add_argument("--rate-limit", type=int)
+    parser.add_argument("--throttle-rate", type=float)
+    parser.add_argument("--error-rate", type=float)
+    parser.add_argument("--three-ds-rate", type=float)
+    parser.add_argument("--connect-latency-ms", type=float)
+    args = parser.parse_args()
+
+    overrides = {
+        "latency": args.latency_ms / 1000 if args.latency_ms is not None else None,
+        "latency_sigma": args.latency_sigma,
+        "rate_limit": args.rate_limit,
+        "throttle_rate": args.throttle_rate,
+        "error_rate": args.error_rate,
+        "three_ds_rate": args.three_ds_rate,
+        "connect_latency": args.connect_latency_ms / 1000 if args.connect_latency_ms is not None else None,
+    }
+    server = FakeStripeServer.from_profile(args.profile, port=args.port,
+                                           **{key: value for key, value in overrides.items() if value is not None})
+    print(f"Fake Stripe ({args.profile}) listening on {server.url}")
+    server.httpd.serve_forever()
@@ -0,0 +1,218 @@
+# 卡 -> 支付订单二级索引 - 以 PaymentMethod ID 查询关联的 PaymentIntent，无需扫描 Charge 列表
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def payment_summary(intent, charges):
+    """与 /card-payments 接口返回的单条支付记录结构一致"""
+    return {
+        "channel_order_id": intent.id,
+        "status": intent.status,
+        "amount": intent.amount,
+        "currency": intent.currency,
+        "created": intent.created,
+        "metadata": intent.metadata.to_dict() if hasattr(intent.metadata, "to_dict") else dict(intent.metadata or {}),
+        "charges": charges,
+    }
+
+
+class CardPaymentIndex:
+    """
+    维护 payment_method_id -> PaymentIntent 的二级索引（SQLite）。
+
+    - create_payment 成功后写入
+    - backfill() 通过分页遍历 Charge 列表补齐历史数据，进度持久化，可中断续跑
+    - 历史补齐完成前，查询接口应回退到 Stripe 扫描，避免漏掉旧订单
+    - 每条记录带有 scope（商户隔离范围，见 MerchantRegistry.scope），按卡查询只返回同一 scope 的记录
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("STRIPE_LEDGER_PATH", "payment_ledger.db")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS card_payments ("
+            " payment_method_id TEXT NOT NULL,"
+            " payment_intent_id TEXT NOT NULL,"
+            " created INTEGER NOT NULL,"
+            " body TEXT NOT NULL,"
+            " scope TEXT,"
+            " PRIMARY KEY (payment_method_id, payment_intent_id))"
+        )
+        # 早期版本创建的表没有 scope 列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(card_payments)")}
+        if "scope" not in columns:
+            self._conn.execute("ALTER TABLE card_payments ADD COLUMN scope TEXT")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_card_payments_order"
+            " ON card_payments (payment_method_id, created DESC, payment_intent_id DESC)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_card_payments_intent ON card_payments (payment_intent_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_card_payments_created ON card_payments (created DESC, payment_intent_id DESC)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS index_state (name TEXT PRIMARY KEY, value TEXT)")
+
+    # ---- 写入 ----
+    def add(self, payment_method_id, payment, scope=None):
+        if not payment_method_id:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO card_payments (payment_method_id, payment_intent_id, created, body, scope)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (payment_method_id, payment["channel_order_id"], payment["created"], json.dumps(payment), scope),
+            )
+
+    def add_many(self, rows, scope=None):
+        """批量写入 [(payment_method_id, payment), ...]，单个事务"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO card_payments (payment_method_id, payment_intent_id, created, body, scope)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(pm_id, p["channel_order_id"], p["created"], json.dumps(p), scope) for pm_id, p in rows if pm_id],
+            )
+            self._conn.execute("COMMIT")
+
+    def update_status(self, payment_intent_id, status):
+        """本服务改变了 PaymentIntent 状态（如取消）时同步更新索引中的摘要"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE card_payments SET body = json_set(body, '$.status', ?) WHERE payment_intent_id = ?",
+                (status, payment_intent_id),
+            )
+
+    # ---- 查询 ----
+    def list(self, payment_method_id, limit=100, starting_after=None, scope=None):
+        """
+        按创建时间倒序返回 scope 下的 (payments, has_more)。
+
+        - **starting_after**: 上一页最后一条的 channel_order_id，用于游标分页
+        """
+        params = [payment_method_id, scope]
+        where = "payment_method_id = ? AND scope IS ?"
+        if starting_after:
+            with self._lock:
+                cursor = self._conn.execute(
+                    "SELECT created FROM card_payments"
+                    " WHERE payment_method_id = ? AND scope IS ? AND payment_intent_id = ?",
+                    (payment_method_id, scope, starting_after),
+                ).fetchone()
+            if cursor is None:
+                return [], False
+            where += " AND (created < ? OR (created = ? AND payment_intent_id < ?))"
+            params += [cursor[0], cursor[0], starting_after]
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT body FROM card_payments WHERE {where}"
+                " ORDER BY created DESC, payment_intent_id DESC LIMIT ?",
+                params + [limit + 1],
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows[:limit]], len(rows) > limit
+
+    def export_page(self, limit=100, starting_after=None, created_gte=None, created_lt=None,
+                    merchant_id=None, status=None):
+        """
+        按创建时间倒序返回全部卡支付的一页 [(payment_method_id, payment), ...]，供导出接口逐页读取。
+
+        - **starting_after**: 上一页最后一条的 channel_order_id；不在索引中时抛出 ValueError
+        - 其余参数为过滤条件，均在 SQLite 中完成
+        """
+        where, params = [], []
+        if starting_after:
+            with self._lock:
+                cursor = self._conn.execute(
+                    "SELECT created FROM card_payments WHERE payment_intent_id = ?", (starting_after,)
+                ).fetchone()
+            if cursor is None:
+                raise ValueError(f"游标不存在: {starting_after}")
+            where.append("(created < ? OR (created = ? AND payment_intent_id < ?))")
+            params += [cursor[0], cursor[0], starting_after]
+        if created_gte is not None:
+            where.append("created >= ?")
+            params.append(created_gte)
+        if created_lt is not None:
+            where.append("created < ?")
+            params.append(created_lt)
+        if merchant_id is not None:
+            where.append("json_extract(body, '$.metadata.merchant_id') = ?")
+            params.append(merchant_id)
+        if status is not None:
+            where.append("json_extract(body, '$.status') = ?")
+            params.append(status)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT payment_method_id, body FROM card_payments {clause}"
+                " ORDER BY created DESC, payment_intent_id DESC LIMIT ?",
+                params + [limit],
+            ).fetchall()
+        return [(pm_id, json.loads(body)) for pm_id, body in rows]
+
+    # ---- 历史补齐 ----
+    def get_state(self, name):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM index_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO index_state (name, value) VALUES (?, ?)", (name, value))
+
+    @staticmethod
+    def _state_name(name, scope):
+        return f"{name}:{scope}" if scope else name
+
+    @property
+    def backfill_complete(self):
+        return self.is_backfilled()
+
+    def is_backfilled(self, scope=None):
+        """scope 为商户 ID 时表示该商户的账户已补齐，为空时表示默认账户"""
+        return self.get_state(self._state_name("backfill_complete", scope)) == "1"
+
+    async def backfill(self, gateway, page_size=100, scope=None):
+        """
+        分页遍历账户下全部 Charge 并写入索引。每页处理后记录游标，
+        中断后再次调用会从上次的位置继续；完成后标记 backfill_complete。
+        各商户的账户（scope 为商户 ID）各自记录进度。
+        """
+        cursor = self.get_state(self._state_name("backfill_cursor", scope))
+        total = 0
+        while True:
+            params = {"limit": page_size, "expand": ["data.payment_intent"]}
+            if cursor:
+                params["starting_after"] = cursor
+            page = await gateway.list_charges(**params)
+            rows = [
+                (charge.payment_method, payment_summary(charge.payment_intent, [charge.to_dict()]))
+                for charge in page.data
+                if charge.payment_method and charge.payment_intent and not isinstance(charge.payment_intent, str)
+            ]
+            # 写入在线程中进行，不阻塞事件循环
+            await asyncio.to_thread(self.add_many, rows, scope)
+            total += len(rows)
+            if page.data:
+                cursor = page.data[-1].id
+                await asyncio.to_thread(self.set_state, self._state_name("backfill_cursor", scope), cursor)
+            if not page.has_more:
+                break
+        await asyncio.to_thread(self.set_state, self._state_name("backfill_complete", scope), "1")
+        logger.info("Card payment index backfill finished, indexed %d payments", total,
+                    extra={"event": "card_index.backfilled"})
+        return total
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
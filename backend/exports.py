@@ -0,0 +1,180 @@
+# 数据导出 - 自动翻页遍历 Stripe 列表或本地索引，以 NDJSON / CSV 流式输出，内存占用只与单页大小有关
+import csv
+import io
+import json
+import logging
+import os
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+MEDIA_TYPES = {FORMAT_NDJSON: "application/x-ndjson", FORMAT_CSV: "text/csv; charset=utf-8"}
+
+# Stripe 列表接口单页上限为 100
+EXPORT_PAGE_SIZE = int(os.getenv("STRIPE_EXPORT_PAGE_SIZE", "100"))
+
+# 导出的列，NDJSON 每行的键与 CSV 表头一致
+PAYMENT_COLUMNS = (
+    "id", "created", "status", "amount", "amount_received", "currency", "payment_method",
+    "merchant_id", "merchant_order_id", "system_order_id", "external_request_order_id",
+)
+REFUND_COLUMNS = (
+    "id", "created", "status", "amount", "currency", "payment_intent", "charge", "reason",
+    "merchant_id", "system_order_id", "external_refund_id", "refund_request_id",
+)
+
+
+class ExportFilter(NamedTuple):
+    """
+    导出过滤条件。
+
+    - **created_gte** / **created_lt**: 创建时间范围（Unix 时间戳，左闭右开），由 Stripe 在服务端过滤
+    - **merchant_id**: metadata.merchant_id；Stripe 列表不支持按 metadata 过滤，逐页在本地筛选
+    - **status**: 对象状态，同样在本地筛选
+    """
+    created_gte: Optional[int] = None
+    created_lt: Optional[int] = None
+    merchant_id: Optional[str] = None
+    status: Optional[str] = None
+
+    def list_params(self):
+        created = {}
+        if self.created_gte is not None:
+            created["gte"] = self.created_gte
+        if self.created_lt is not None:
+            created["lt"] = self.created_lt
+        return {"created": created} if created else {}
+
+    def matches(self, row):
+        return ((self.merchant_id is None or row["merchant_id"] == self.merchant_id)
+                and (self.status is None or row["status"] == self.status))
+
+
+def _id(value):
+    # 未展开时为 ID 字符串，展开后为对象
+    if value is None or isinstance(value, str):
+        return value
+    return value.get("id")
+
+
+def payment_row(intent, payment_method=None):
+    metadata = intent.get("metadata") or {}
+    return {
+        "id": intent["id"],
+        "created": intent["created"],
+        "status": intent["status"],
+        "amount": intent["amount"],
+        "amount_received": intent.get("amount_received"),
+        "currency": intent["currency"],
+        "payment_method": payment_method or _id(intent.get("payment_method")),
+        "merchant_id": metadata.get("merchant_id"),
+        "merchant_order_id": metadata.get("merchant_order_id"),
+        "system_order_id": metadata.get("system_order_id"),
+        "external_request_order_id": metadata.get("external_request_order_id"),
+    }
+
+
+def refund_row(refund):
+    metadata = refund.get("metadata") or {}
+    intent = refund.get("payment_intent")
+    # merchant_id 记录在 PaymentIntent 上，导出退款时展开 data.payment_intent 读取
+    intent_metadata = (intent.get("metadata") or {}) if intent is not None and not isinstance(intent, str) else {}
+    return {
+        "id": refund["id"],
+        "created": refund["created"],
+        "status": refund["status"],
+        "amount": refund["amount"],
+        "currency": refund["currency"],
+        "payment_intent": _id(intent),
+        "charge": _id(refund.get("charge")),
+        "reason": refund.get("reason"),
+        "merchant_id": intent_metadata.get("merchant_id"),
+        "system_order_id": metadata.get("system_order_id"),
+        "external_refund_id": metadata.get("external_refund_id"),
+        "refund_request_id": metadata.get("refund_request_id"),
+    }
+
+
+async def stripe_pages(list_page, params, starting_after=None, page_size=EXPORT_PAGE_SIZE):
+    """
+    按 starting_after 游标自动翻页，每次产出一页对象；任一时刻只持有当前页。
+
+    - **list_page**: 网关的列表方法，如 gateway.list_payment_intents
+    - **starting_after**: 从该对象之后继续，用于断点续传
+    """
+    while True:
+        page_params = dict(params, limit=page_size)
+        if starting_after:
+            page_params["starting_after"] = starting_after
+        page = await list_page(**page_params)
+        if page.data:
+            yield page.data
+            starting_after = page.data[-1].id
+        if not page.has_more:
+            return
+
+
+async def payment_pages(gateway, filters, starting_after=None, page_size=EXPORT_PAGE_SIZE):
+    async for intents in stripe_pages(gateway.list_payment_intents, filters.list_params(), starting_after, page_size):
+        yield [row for row in map(payment_row, intents) if filters.matches(row)]
+
+
+async def refund_pages(gateway, filters, starting_after=None, page_size=EXPORT_PAGE_SIZE):
+    params = dict(filters.list_params(), expand=["data.payment_intent"])
+    async for refunds in stripe_pages(gateway.list_refunds, params, starting_after, page_size):
+        yield [row for row in map(refund_row, refunds) if filters.matches(row)]
+
+
+async def local_payment_pages(card_index, filters, starting_after=None, page_size=EXPORT_PAGE_SIZE):
+    """从本地卡 -> 支付订单索引逐页读取，过滤在 SQLite 中完成，不消耗 Stripe 配额"""
+    while True:
+        rows = card_index.export_page(page_size, starting_after, **filters._asdict())
+        if rows:
+            yield [payment_row({"id": payment["channel_order_id"], **payment}, payment_method)
+                   for payment_method, payment in rows]
+            starting_after = rows[-1][1]["channel_order_id"]
+        if len(rows) < page_size:
+            return
+
+
+async def encode_pages(first_page, pages, export_format, columns):
+    """
+    逐页编码输出，每页一个数据块。每行都带 id，中断后以收到的最后一个 id 作为 starting_after 续传。
+
+    - **first_page**: 已预取的第一页，使参数错误、Stripe 错误能在响应开始前以 400 返回
+    """
+    if export_format == FORMAT_CSV:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns)
+        writer.writeheader()
+
+        def encode(rows):
+            writer.writerows(rows)
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return chunk
+
+        yield encode([])
+    else:
+        def encode(rows):
+            return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+    exported = len(first_page)
+    last_id = first_page[-1]["id"] if first_page else None
+    if first_page:
+        yield encode(first_page)
+    try:
+        async for rows in pages:
+            if rows:
+                exported += len(rows)
+                last_id = rows[-1]["id"]
+                yield encode(rows)
+    except Exception as e:
+        # 响应头已发出，只能中断连接；客户端以最后收到的 id 续传
+        logger.error("Export aborted after %d rows, last id %s: %s", exported, last_id, e,
+                     extra={"event": "export.aborted", "error": type(e).__name__})
+        raise
+    logger.info("Export finished, %d rows", exported, extra={"event": "export.finished"})
@@ -0,0 +1,177 @@
+# Stripe 异步网关 - 在有界线程池中执行同步 Stripe SDK 调用，避免阻塞事件循环
+import asyncio
+import functools
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+
+from backend.metrics import counters, latency
+from backend.ratelimit import KIND_CREATE, KIND_LIST, KIND_READ, KIND_REFUND, StripeRateLimiter
+
+
+def _find_refund(payment_intent_id, external_refund_id, **options):
+    refunds = stripe.Refund.list(payment_intent=payment_intent_id, limit=100, **options)
+    for refund in refunds.auto_paging_iter():
+        if refund.metadata.get("external_refund_id") == external_refund_id:
+            return refund
+    return None
+
+
+def _post_form(path, body, api_key=None, stripe_account=None, idempotency_key=None):
+    """
+    把已编码的表单请求体直接 POST 给 Stripe（见 backend.serializers），跳过 SDK 的参数展开与编码；
+    请求头、错误映射与返回对象均沿用 SDK，与 Resource.create 的行为一致。
+    """
+    requestor = stripe.api_requestor.APIRequestor(api_key, account=stripe_account)
+    api_key = api_key or stripe.api_key
+    if api_key is None:
+        raise stripe.error.AuthenticationError("No API key provided.")
+    headers = requestor.request_headers(api_key, "post")
+    if idempotency_key is not None:
+        headers["Idempotency-Key"] = idempotency_key
+    rbody, rcode, rheaders = stripe.default_http_client.request_with_retries(
+        "post", requestor.api_base + path, headers, body)
+    response = requestor.interpret_response(rbody, rcode, rheaders)
+    return stripe.util.convert_to_stripe_object(response, api_key, None, stripe_account)
+
+
+# 以已编码表单直接 POST 的路径对应的 SDK 操作名，与 SDK 调用的埋点名称保持一致
+_FORM_OPERATIONS = {
+    "/v1/payment_methods": "PaymentMethod.create",
+    "/v1/payment_intents": "PaymentIntent.create",
+    "/v1/refunds": "Refund.create",
+}
+
+
+def _operation(func, args):
+    if func is _post_form:
+        return _FORM_OPERATIONS.get(args[0], args[0])
+    return func.__qualname__.lstrip("_")
+
+
+class StripeGateway:
+    """
+    所有接口访问 Stripe 的统一入口。
+
+    stripe==7.0.0 只提供同步 SDK，因此每次调用都被投递到专用的有界线程池中执行，
+    事件循环只负责等待结果；同时用信号量限制同一时刻在途的 Stripe 请求数，
+    超出的请求在协程中排队，而不是占满线程池。
+
+    - **max_workers**: 线程池大小，默认读取环境变量 STRIPE_MAX_WORKERS（32）
+    - **max_concurrency**: 在途请求上限，默认读取 STRIPE_MAX_CONCURRENCY（等于 max_workers）
+    - **api_key** / **account**: 调用时使用的密钥与连接账户
+    - 创建类方法既接受 SDK 的关键字参数，也接受 body=（backend.serializers 编码好的表单请求体）
+    - **limiter**: 限流与重试调度器，429/5xx 在这里按类别限速、退避重试并触发熔断
+    - **executor**: 与其他网关共用的线程池（如多商户路由），传入时 max_workers 不生效，close() 不关闭它
+    - 每次发往 Stripe 的请求（含重试）按 (操作, 结果) 记入 stripe.request 耗时，最终失败按错误类型计数
+    """
+
+    def __init__(self, api_key=None, account=None, max_workers=None, max_concurrency=None, limiter=None,
+                 executor=None):
+        self.api_key = api_key
+        self.account = account
+        self.limiter = limiter or StripeRateLimiter()
+        self.max_workers = max_workers or int(os.getenv("STRIPE_MAX_WORKERS", "32"))
+        self.max_concurrency = max_concurrency or int(os.getenv("STRIPE_MAX_CONCURRENCY", str(self.max_workers)))
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stripe-gateway")
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # 在途（已占用并发名额）与等待并发名额的请求数
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def call(self, func, *args, kind=KIND_READ, **kwargs):
+        """
+        在线程池中执行任意同步 Stripe SDK 调用，并自动带上密钥与连接账户。
+
+        - **kind**: 接口类别（create/refund/list/read），决定所用令牌桶与排队优先级；
+          写请求（create/refund）没有幂等键时自动生成一个，保证重试不会重复扣款或退款
+        """
+        if self.api_key is not None:
+            kwargs.setdefault("api_key", self.api_key)
+        if self.account is not None:
+            kwargs.setdefault("stripe_account", self.account)
+        if kind in (KIND_CREATE, KIND_REFUND) and not kwargs.get("idempotency_key"):
+            kwargs["idempotency_key"] = f"gw-{uuid.uuid4()}"
+        partial = functools.partial(func, *args, **kwargs)
+        operation = _operation(func, args)
+
+        async def attempt():
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            start = time.perf_counter()
+            outcome = "ok"
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, partial)
+            except Exception as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+                latency.observe("stripe.request", time.perf_counter() - start, operation=operation, outcome=outcome)
+
+        try:
+            if latency.tracer.enabled:
+                with latency.tracer.span("stripe.call", operation=operation, kind=kind):
+                    return await self.limiter.run(self.account, kind, attempt, idempotent=True)
+            return await self.limiter.run(self.account, kind, attempt, idempotent=True)
+        except stripe.error.StripeError as e:
+            counters.inc("stripe.errors", operation=operation, error=type(e).__name__)
+            raise
+
+    # PaymentMethod
+    async def create_payment_method(self, body=None, **params):
+        if body is not None:
+            return await self.call(_post_form, "/v1/payment_methods", body, kind=KIND_CREATE, **params)
+        return await self.call(stripe.PaymentMethod.create, kind=KIND_CREATE, **params)
+
+    async def retrieve_payment_method(self, payment_method_id, **params):
+        return await self.call(stripe.PaymentMethod.retrieve, payment_method_id, **params)
+
+    # PaymentIntent
+    async def create_payment_intent(self, body=None, **params):
+        if body is not None:
+            return await self.call(_post_form, "/v1/payment_intents", body, kind=KIND_CREATE, **params)
+        return await self.call(stripe.PaymentIntent.create, kind=KIND_CREATE, **params)
+
+    async def retrieve_payment_intent(self, payment_intent_id, **params):
+        return await self.call(stripe.PaymentIntent.retrieve, payment_intent_id, **params)
+
+    async def list_payment_intents(self, **params):
+        return await self.call(stripe.PaymentIntent.list, kind=KIND_LIST, **params)
+
+    async def cancel_payment_intent(self, payment_intent_id, **params):
+        return await self.call(stripe.PaymentIntent.cancel, payment_intent_id, kind=KIND_CREATE, **params)
+
+    async def capture_payment_intent(self, payment_intent_id, **params):
+        return await self.call(stripe.PaymentIntent.capture, payment_intent_id, kind=KIND_CREATE, **params)
+
+    # Refund
+    async def create_refund(self, body=None, **params):
+        if body is not None:
+            return await self.call(_post_form, "/v1/refunds", body, kind=KIND_REFUND, **params)
+        return await self.call(stripe.Refund.create, kind=KIND_REFUND, **params)
+
+    async def list_refunds(self, **params):
+        return await self.call(stripe.Refund.list, kind=KIND_LIST, **params)
+
+    async def find_refund(self, payment_intent_id, external_refund_id):
+        """分页遍历 PaymentIntent 的全部退款，按 metadata.external_refund_id 查找"""
+        return await self.call(_find_refund, payment_intent_id, external_refund_id, kind=KIND_LIST)
+
+    # Charge
+    async def list_charges(self, **params):
+        return await self.call(stripe.Charge.list, kind=KIND_LIST, **params)
+
+    def close(self):
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
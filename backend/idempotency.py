@@ -0,0 +1,128 @@
+# 本地幂等存储 - 幂等键 -> (上游对象 ID, 请求指纹, 最终响应)，重放请求无需访问 Stripe
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from backend.state import MemoryStateBackend
+
+KIND_PAYMENT = "payment"
+KIND_REFUND = "refund"
+
+IdempotencyRecord = namedtuple("IdempotencyRecord", ["object_id", "fingerprint", "response", "created_at"])
+
+
+class IdempotencyStore:
+    """
+    保存 external_request_order_id / external_refund_id 对应的上游对象与最终响应。
+
+    - 内存层为有界 LRU，命中时在微秒级返回；SQLite 层保证重启后仍然有效
+    - 请求指纹为请求参数的 HMAC-SHA256（以 STRIPE_SECRET_KEY 为密钥），不保存卡号等明文
+    - 同一幂等键的参数不一致时，调用方可直接判定冲突，无需请求 Stripe
+    - claim() 在状态后端占用进行中的幂等键：同一幂等键的并发请求（可能落在不同 worker 进程）
+      只有一个访问 Stripe，其余等待它的结果
+    """
+
+    def __init__(self, path=None, max_entries=None, ttl=None, secret=None, state=None, claim_ttl=None):
+        self.path = path or os.getenv("STRIPE_LEDGER_PATH", "payment_ledger.db")
+        self.max_entries = max_entries or int(os.getenv("STRIPE_IDEMPOTENCY_MAX_ENTRIES", "50000"))
+        self.ttl = ttl or float(os.getenv("STRIPE_IDEMPOTENCY_TTL", str(30 * 24 * 3600)))
+        self._secret = (secret or os.getenv("STRIPE_SECRET_KEY") or "idempotency").encode()
+        self.state = state or MemoryStateBackend()
+        # 占用的最长时间（秒），持有者异常退出时到期自动释放
+        self.claim_ttl = claim_ttl or float(os.getenv("STRIPE_IDEMPOTENCY_CLAIM_TTL", "60"))
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+            " kind TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " object_id TEXT,"
+            " fingerprint TEXT NOT NULL,"
+            " response TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (kind, key))"
+        )
+        self._writes = 0
+
+    def fingerprint(self, params: dict):
+        canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+        return hmac.new(self._secret, canonical.encode(), hashlib.sha256).hexdigest()
+
+    def lookup(self, kind, key):
+        if not key:
+            return None
+        now = time.time()
+        with self._lock:
+            record = self._memory.get((kind, key))
+            if record is None:
+                row = self._conn.execute(
+                    "SELECT object_id, fingerprint, response, created_at FROM idempotency_keys"
+                    " WHERE kind = ? AND key = ?", (kind, key)
+                ).fetchone()
+                if row is None:
+                    return None
+                record = IdempotencyRecord(row[0], row[1], json.loads(row[2]), row[3])
+                self._remember((kind, key), record)
+            else:
+                self._memory.move_to_end((kind, key))
+        if now - record.created_at > self.ttl:
+            return None
+        return record
+
+    def save(self, kind, key, object_id, fingerprint, response: dict):
+        if not key:
+            return
+        now = time.time()
+        record = IdempotencyRecord(object_id, fingerprint, response, now)
+        with self._lock:
+            self._remember((kind, key), record)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (kind, key, object_id, fingerprint, response, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, object_id, fingerprint, json.dumps(response), now),
+            )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (now - self.ttl,))
+
+    def claim(self, kind, key):
+        """占用进行中的幂等键，成功返回 True；已被其他请求占用时返回 False"""
+        return self.state.add(f"idempotency:{kind}:{key}", str(os.getpid()), ttl=self.claim_ttl)
+
+    def release(self, kind, key):
+        self.state.delete(f"idempotency:{kind}:{key}")
+
+    async def wait(self, kind, key, poll_interval=0.05):
+        """
+        等待占用者保存结果并返回该记录；占用者未保存结果就释放（请求失败）或占用超时时返回 None，
+        调用方可自行请求 Stripe（Stripe 侧的幂等键仍然生效）。
+        """
+        deadline = time.monotonic() + self.claim_ttl
+        while time.monotonic() < deadline:
+            # 未命中内存层时读 SQLite，在线程中进行，不阻塞事件循环
+            record = await asyncio.to_thread(self.lookup, kind, key)
+            if record is not None:
+                return record
+            if await asyncio.to_thread(self.state.get, f"idempotency:{kind}:{key}") is None:
+                return await asyncio.to_thread(self.lookup, kind, key)
+            await asyncio.sleep(poll_interval)
+        return None
+
+    def _remember(self, cache_key, record):
+        self._memory[cache_key] = record
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,102 @@
+# 接口埋点 - 每个 HTTP 请求的耗时、状态码与在途数，以及请求校验、处理与响应序列化三个阶段的耗时
+import contextvars
+import functools
+import time
+
+from fastapi.routing import APIRoute
+
+from backend.metrics import latency, tracer
+
+# 当前请求的阶段时间点，由 InstrumentedRoute 写入
+_route_marks = contextvars.ContextVar("route_marks", default=None)
+
+
+class RequestMetricsMiddleware:
+    """
+    纯 ASGI 中间件（不缓冲响应体，流式导出不受影响）：按 (方法, 路由模板, 状态码) 记录 http.request 耗时，
+    路由模板而非原始路径作为标签，保持序列数有界。开启调用链时每个请求是一条 trace 的根 span，
+    并在响应头 X-Trace-Id 中返回 trace ID。
+    """
+    # 进程内所有实例共用的在途请求数
+    in_flight = 0
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        trace_id = None
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if trace_id is not None:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", trace_id.encode())]
+            await send(message)
+
+        RequestMetricsMiddleware.in_flight += 1
+        start = time.perf_counter()
+        try:
+            if tracer.enabled:
+                with tracer.span("http.request", method=scope["method"], path=scope["path"]) as span:
+                    trace_id = span["trace_id"]
+                    await self.app(scope, receive, send_with_status)
+                    span["attributes"]["status"] = status
+            else:
+                await self.app(scope, receive, send_with_status)
+        finally:
+            RequestMetricsMiddleware.in_flight -= 1
+            route = scope.get("route")
+            latency.observe("http.request", time.perf_counter() - start, method=scope["method"],
+                            route=route.path if route is not None else "unmatched", status=status)
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    把 FastAPI 的一次路由处理拆成三个阶段记入 http.phase：
+    validation（读取请求体并校验参数）、handler（接口函数本身）、serialization（按 response_model 序列化响应）。
+    """
+
+    def __init__(self, path, endpoint, **kwargs):
+        # include_router 会用已包装的 endpoint 重新创建路由，不重复包装
+        if getattr(endpoint, "_instrumented", False):
+            super().__init__(path, endpoint, **kwargs)
+            return
+
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **params):
+            marks = _route_marks.get()
+            if marks is not None:
+                marks.append(time.perf_counter())
+            try:
+                return await endpoint(*args, **params)
+            finally:
+                if marks is not None:
+                    marks.append(time.perf_counter())
+
+        timed_endpoint._instrumented = True
+        super().__init__(path, timed_endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            marks = []
+            token = _route_marks.set(marks)
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                _route_marks.reset(token)
+                end = time.perf_counter()
+                if len(marks) == 2:
+                    entered, returned = marks
+                    latency.observe("http.phase", entered - start, route=self.path, phase="validation")
+                    latency.observe("http.phase", returned - entered, route=self.path, phase="handler")
+                    latency.observe("http.phase", end - returned, route=self.path, phase="serialization")
+
+        return timed_handler
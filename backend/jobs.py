@@ -0,0 +1,279 @@
+# 批量任务 - 持久化进度的后台作业（批量退款等），支持限速、并发与重启续跑
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from backend.state import MemoryStateBackend
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+
+ITEM_PENDING = "pending"
+ITEM_DONE = "done"
+
+# 可在其他作业中复用的结果状态；失败的结果（如 Stripe 5xx、网络错误）不复用，再次提交时重新发往 Stripe，
+# 由 Stripe 侧的幂等键保证不会重复执行
+REUSABLE_OUTCOMES = ("success", "pending")
+
+
+class RateLimiter:
+    """简单的令牌桶，限制每秒发往 Stripe 的请求数"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class JobStore:
+    """作业与作业项的 SQLite 存储；每项完成即落库，进程崩溃后不会重复执行已完成的项"""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("STRIPE_LEDGER_PATH", "payment_ledger.db")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " total INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_items ("
+            " job_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " item_key TEXT,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " result TEXT,"
+            " done_order INTEGER,"
+            " PRIMARY KEY (job_id, seq))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_items_key ON job_items (kind, item_key, status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_items_done ON job_items (job_id, done_order)")
+
+    def create(self, kind, items):
+        """items 为 [(item_key, payload_dict), ...]，返回 job_id"""
+        job_id = f"job_{uuid.uuid4().hex}"
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, kind, status, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, JOB_PENDING, len(items), now, now),
+            )
+            self._conn.executemany(
+                "INSERT INTO job_items (job_id, seq, kind, item_key, payload, status) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, seq, kind, key, json.dumps(payload), ITEM_PENDING) for seq, (key, payload) in enumerate(items)],
+            )
+            self._conn.execute("COMMIT")
+        return job_id
+
+    def set_status(self, job_id, status):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?",
+                               (status, time.time(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, kind, status, total, created_at, updated_at FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            done = self._conn.execute(
+                "SELECT COUNT(*) FROM job_items WHERE job_id = ? AND status = ?", (job_id, ITEM_DONE)
+            ).fetchone()[0]
+            outcomes = dict(self._conn.execute(
+                "SELECT json_extract(result, '$.status'), COUNT(*) FROM job_items"
+                " WHERE job_id = ? AND status = ? GROUP BY 1", (job_id, ITEM_DONE)
+            ).fetchall())
+        keys = ("job_id", "kind", "status", "total", "created_at", "updated_at")
+        return dict(zip(keys, row), completed=done, pending=row[3] - done, outcomes=outcomes)
+
+    def unfinished_jobs(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status != ? ORDER BY created_at", (JOB_COMPLETED,)
+            ).fetchall()]
+
+    def pending_items(self, job_id):
+        with self._lock:
+            return [(seq, key, json.loads(payload)) for seq, key, payload in self._conn.execute(
+                "SELECT seq, item_key, payload FROM job_items WHERE job_id = ? AND status = ? ORDER BY seq",
+                (job_id, ITEM_PENDING),
+            ).fetchall()]
+
+    def finished_result(self, kind, item_key):
+        """同一幂等键在任意作业中已成功（或处理中）时返回其结果；只有失败结果时返回 None，重新执行"""
+        if item_key is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM job_items WHERE kind = ? AND item_key = ? AND status = ?"
+                f" AND json_extract(result, '$.status') IN ({', '.join('?' * len(REUSABLE_OUTCOMES))}) LIMIT 1",
+                (kind, item_key, ITEM_DONE, *REUSABLE_OUTCOMES),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def complete_item(self, job_id, seq, result):
+        """
+        记录一项的结果。done_order 在同一条 UPDATE 语句中取该作业当前最大值加一：语句持有 SQLite 写锁，
+        多个进程续跑同一作业时完成顺序也严格递增，按 done_order 增量读取结果的客户端不会漏掉后完成的项。
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE job_items SET status = ?, result = ?,"
+                " done_order = (SELECT COALESCE(MAX(done_order), 0) + 1 FROM job_items WHERE job_id = ?)"
+                " WHERE job_id = ? AND seq = ?",
+                (ITEM_DONE, json.dumps(result), job_id, job_id, seq),
+            )
+
+    def results_after(self, job_id, done_order, limit=500):
+        """按完成顺序返回 done_order 之后的结果 [(done_order, seq, result), ...]"""
+        with self._lock:
+            return [(order, seq, json.loads(result)) for order, seq, result in self._conn.execute(
+                "SELECT done_order, seq, result FROM job_items WHERE job_id = ? AND done_order > ?"
+                " ORDER BY done_order LIMIT ?",
+                (job_id, done_order, limit),
+            ).fetchall()]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobRunner:
+    """
+    在后台执行作业：每个作业由 workers 个协程消费待处理项，并共享同一个限速器。
+
+    - **handlers**: {kind: async handler(payload) -> result_dict}
+    - 启动时自动续跑未完成的作业，只执行尚未完成的项
+    - 幂等键（如 external_refund_id）已在任意作业中成功或处理中的项直接复用原结果，失败的项重新执行
+    - 执行作业前在状态后端取得租约并定期续期：多 worker 部署时，同一作业只由一个进程执行，
+      持有租约的进程退出后，租约到期，其他进程重启时可以续跑
+    """
+
+    def __init__(self, store, handlers, workers=8, rate=20.0, state=None, lease_ttl=None):
+        self.store = store
+        self.handlers = handlers
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.state = state or MemoryStateBackend()
+        self.lease_ttl = lease_ttl or float(os.getenv("STRIPE_JOB_LEASE_TTL", "30"))
+        self._owner = str(os.getpid())
+        self._tasks = {}
+
+    async def start(self):
+        for job_id in self.store.unfinished_jobs():
+            logger.info("Resuming job %s", job_id, extra={"event": "job.resumed", "job_id": job_id})
+            self.launch(job_id)
+
+    @property
+    def running(self):
+        """本进程正在执行的作业数"""
+        return sum(1 for task in self._tasks.values() if not task.done())
+
+    async def submit(self, kind, items):
+        job_id = await asyncio.to_thread(self.store.create, kind, items)
+        self.launch(job_id)
+        return job_id
+
+    def launch(self, job_id):
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+
+    async def _run(self, job_id):
+        lease = f"job:{job_id}"
+        # 租约读写可能等待共享状态的 SQLite 锁，在线程中进行，不阻塞事件循环
+        if not await asyncio.to_thread(self.state.add, lease, self._owner, ttl=self.lease_ttl):
+            logger.info("Job %s is held by another worker, skipping", job_id,
+                        extra={"event": "job.skipped", "job_id": job_id})
+            return
+
+        async def renew():
+            while True:
+                await asyncio.sleep(self.lease_ttl / 3)
+                await asyncio.to_thread(self.state.set, lease, self._owner, ttl=self.lease_ttl)
+
+        heartbeat = asyncio.create_task(renew())
+        try:
+            await self._execute(job_id)
+        finally:
+            heartbeat.cancel()
+            await asyncio.to_thread(self.state.delete, lease)
+
+    async def _execute(self, job_id):
+        # 作业存储的读写在线程中进行，逐项落库不阻塞事件循环
+        job = await asyncio.to_thread(self.store.get, job_id)
+        handler = self.handlers[job["kind"]]
+        await asyncio.to_thread(self.store.set_status, job_id, JOB_RUNNING)
+        queue = asyncio.Queue()
+        for item in await asyncio.to_thread(self.store.pending_items, job_id):
+            queue.put_nowait(item)
+
+        async def worker():
+            while not queue.empty():
+                seq, key, payload = queue.get_nowait()
+                result = await asyncio.to_thread(self.store.finished_result, job["kind"], key)
+                if result is None:
+                    await self.limiter.acquire()
+                    try:
+                        result = await handler(payload)
+                    except Exception as e:
+                        logger.error("Job %s item %d failed: %s: %s", job_id, seq, type(e).__name__, e,
+                                     extra={"event": "job.item_failed", "job_id": job_id, "error": type(e).__name__})
+                        result = {"status": "failed", "detail": {"message": f"服务器错误: {str(e)}"}}
+                await asyncio.to_thread(self.store.complete_item, job_id, seq, result)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        await asyncio.to_thread(self.store.set_status, job_id, JOB_COMPLETED)
+        logger.info("Job %s completed", job_id, extra={"event": "job.completed", "job_id": job_id})
+
+    async def stream_results(self, job_id, poll_interval=0.2):
+        """以 NDJSON 逐行输出已完成项的结果，直到作业完成"""
+        last = 0
+        while True:
+            rows = self.store.results_after(job_id, last)
+            for order, seq, result in rows:
+                last = order
+                yield json.dumps({"seq": seq, **result}, ensure_ascii=False) + "\n"
+            if rows:
+                continue
+            job = self.store.get(job_id)
+            if job is None or (job["status"] == JOB_COMPLETED and not self.store.results_after(job_id, last, 1)):
+                return
+            await asyncio.sleep(poll_interval)
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
@@ -0,0 +1,312 @@
+# 本地支付台账 - PaymentIntent 详情的读穿缓存（内存 LRU + SQLite）
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from backend.state import MemoryStateBackend
+from backend.schema import PaymentDetailsResponseSchema, PaymentDetailsSummarySchema, ChargeSummarySchema, \
+    RefundSummarySchema, PaymentMethodSummarySchema
+
+logger = logging.getLogger(__name__)
+
+# 查询支付详情时需要 Stripe 展开的字段
+PAYMENT_DETAILS_EXPAND = ['charges.data', 'payment_method']
+
+# fields= 可选的字段，以及每个字段需要 Stripe 展开的对象；未选中的对象不展开
+DETAIL_FIELDS = {
+    "status": (),
+    "amount": (),
+    "currency": (),
+    "metadata": (),
+    "created": (),
+    "payment_method": ("payment_method",),
+    "charges": ("charges.data",),
+    "refunds": ("charges.data",),
+}
+
+# 不同状态的缓存时间（秒）；终态不会再变化（本服务发起的退款会主动失效缓存），可以保存更久
+DEFAULT_STATUS_TTLS = {
+    "succeeded": 3600.0,
+    "canceled": 3600.0,
+    "requires_capture": 60.0,
+    "requires_payment_method": 30.0,
+    "requires_action": 2.0,
+    "requires_confirmation": 2.0,
+    "processing": 2.0,
+}
+
+
+def build_payment_details(payment_intent):
+    """由展开了 charges 与 payment_method 的 PaymentIntent 构建支付详情"""
+    charges = []
+    refunds = []
+    if hasattr(payment_intent, 'charges') and payment_intent.charges and payment_intent.charges.data:
+        charges = [charge.to_dict() for charge in payment_intent.charges.data]
+        for charge in payment_intent.charges.data:
+            if hasattr(charge, 'refunds') and charge.refunds and charge.refunds.data:
+                refunds.extend([refund.to_dict() for refund in charge.refunds.data])
+    else:
+        logger.warning("No charges data found for PaymentIntent: %s", payment_intent.id,
+                       extra={"event": "payment.details_incomplete", "payment_id": payment_intent.id})
+
+    payment_method_details = {}
+    if hasattr(payment_intent, 'payment_method') and payment_intent.payment_method:
+        payment_method = payment_intent.payment_method if isinstance(payment_intent.payment_method,
+                                                                     dict) else payment_intent.payment_method.to_dict()
+        payment_method_details = payment_method
+    else:
+        logger.warning("No payment_method available for PaymentIntent: %s", payment_intent.id,
+                       extra={"event": "payment.details_incomplete", "payment_id": payment_intent.id})
+
+    return PaymentDetailsResponseSchema(
+        channel_order_id=payment_intent.id,
+        status=payment_intent.status,
+        amount=payment_intent.amount,
+        currency=payment_intent.currency,
+        metadata=payment_intent.metadata,
+        payment_method=payment_method_details,
+        created=payment_intent.created,
+        charges=charges,
+        refunds=refunds
+    )
+
+
+def parse_fields(fields):
+    """解析逗号分隔的 fields 参数，返回字段集合；含未知字段时抛出 ValueError"""
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected - DETAIL_FIELDS.keys()
+    if unknown:
+        raise ValueError(f"未知字段: {', '.join(sorted(unknown))}，可选: {', '.join(DETAIL_FIELDS)}")
+    return frozenset(selected)
+
+
+def expand_for(fields):
+    return sorted({expand for field in fields for expand in DETAIL_FIELDS[field]})
+
+
+def _card(obj, key):
+    # Charge 的卡信息在 payment_method_details.card，PaymentMethod 的在 card
+    details = obj.get(key) or {}
+    return (details.get("card") if key == "payment_method_details" else details) or {}
+
+
+def charge_summary(charge):
+    card = _card(charge, "payment_method_details")
+    return ChargeSummarySchema(
+        id=charge["id"],
+        amount=charge["amount"],
+        amount_refunded=charge.get("amount_refunded") or 0,
+        currency=charge["currency"],
+        status=charge["status"],
+        paid=bool(charge.get("paid")),
+        refunded=bool(charge.get("refunded")),
+        created=charge["created"],
+        failure_code=charge.get("failure_code"),
+        failure_message=charge.get("failure_message"),
+        card_brand=card.get("brand"),
+        card_last4=card.get("last4"),
+    )
+
+
+def refund_summary(refund):
+    return RefundSummarySchema(
+        id=refund["id"],
+        charge=refund.get("charge"),
+        amount=refund["amount"],
+        currency=refund["currency"],
+        status=refund.get("status"),
+        reason=refund.get("reason"),
+        created=refund["created"],
+        metadata=refund.get("metadata") or {},
+    )
+
+
+def payment_method_summary(payment_method):
+    if not payment_method:
+        return None
+    if isinstance(payment_method, str):
+        return PaymentMethodSummarySchema(id=payment_method)
+    card = _card(payment_method, "card")
+    return PaymentMethodSummarySchema(
+        id=payment_method["id"],
+        type=payment_method.get("type"),
+        card_brand=card.get("brand"),
+        card_last4=card.get("last4"),
+        card_exp_month=card.get("exp_month"),
+        card_exp_year=card.get("exp_year"),
+        billing_name=(payment_method.get("billing_details") or {}).get("name"),
+    )
+
+
+def project_payment_details(source, fields):
+    """
+    由 PaymentIntent（只展开了所需对象）或台账中的完整详情构建只含 fields 的精简详情。
+    """
+    if isinstance(source, PaymentDetailsResponseSchema):
+        payment_intent_id, charges, refunds = source.channel_order_id, source.charges, source.refunds
+        values = source.__dict__
+    else:
+        payment_intent_id, values = source.id, source
+        charges = source.get("charges").data if fields & {"charges", "refunds"} and source.get("charges") else []
+        refunds = [refund for charge in charges if charge.get("refunds") for refund in charge.get("refunds").data]
+    selected = {field: values.get(field) for field in ("status", "amount", "currency", "metadata", "created")
+                if field in fields}
+    if "payment_method" in fields:
+        selected["payment_method"] = payment_method_summary(values.get("payment_method"))
+    if "charges" in fields:
+        selected["charges"] = [charge_summary(charge) for charge in charges]
+    if "refunds" in fields:
+        selected["refunds"] = [refund_summary(refund) for refund in refunds]
+    return PaymentDetailsSummarySchema(channel_order_id=payment_intent_id, **selected)
+
+
+class PaymentLedger:
+    """
+    以 PaymentIntent ID 为键缓存已构建好的 PaymentDetailsResponseSchema。
+
+    - 内存层为有界 LRU，命中时不访问 SQLite，也不访问 Stripe
+    - SQLite 层持久化缓存，进程重启后仍可命中
+    - 每条记录的有效期取决于 PaymentIntent 的状态，终态保存更久
+    - 多 worker 部署时（共享状态后端），写入与失效会记录一个时间戳，
+      其他进程的内存层只在缓存时间晚于该时间戳时命中，否则回到 SQLite 读取最新记录
+    - 每条记录带有写入时的 scope（商户隔离范围，见 MerchantRegistry.scope），
+      只有相同 scope 的查询才会命中，一个商户的缓存不会返回给以其他商户身份的查询
+    """
+
+    def __init__(self, path=None, max_entries=None, status_ttls=None, default_ttl=None, state=None):
+        self.path = path or os.getenv("STRIPE_LEDGER_PATH", "payment_ledger.db")
+        self.max_entries = max_entries or int(os.getenv("STRIPE_LEDGER_MAX_ENTRIES", "10000"))
+        self.status_ttls = dict(DEFAULT_STATUS_TTLS, **(status_ttls or {}))
+        self.default_ttl = default_ttl if default_ttl is not None else float(os.getenv("STRIPE_LEDGER_DEFAULT_TTL", "5"))
+        self.state = state or MemoryStateBackend()
+        # 失效时间戳至少保留到任何内存记录都已过期
+        self._stamp_ttl = max(max(self.status_ttls.values()), self.default_ttl)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS payment_details ("
+            " payment_intent_id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " body TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " scope TEXT)"
+        )
+        # 早期版本创建的表没有 scope 列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(payment_details)")}
+        if "scope" not in columns:
+            self._conn.execute("ALTER TABLE payment_details ADD COLUMN scope TEXT")
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+    def ttl_for(self, status):
+        return self.status_ttls.get(status, self.default_ttl)
+
+    def get(self, payment_intent_id, scope=None):
+        """返回 scope 写入的未过期缓存详情，未命中（或属于其他 scope）返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(payment_intent_id)
+            if entry is not None:
+                expires_at, cached_at, owner, details = entry
+                if owner != scope:
+                    self.misses += 1
+                    return None
+                if expires_at > now and not self._changed_since(payment_intent_id, cached_at):
+                    self._memory.move_to_end(payment_intent_id)
+                    self.hits += 1
+                    return details
+                del self._memory[payment_intent_id]
+
+            row = self._conn.execute(
+                "SELECT body, expires_at, scope FROM payment_details WHERE payment_intent_id = ?",
+                (payment_intent_id,),
+            ).fetchone()
+            if row is None or row[1] <= now or row[2] != scope:
+                self.misses += 1
+                return None
+            details = PaymentDetailsResponseSchema.model_validate_json(row[0])
+            self._remember(payment_intent_id, row[1], now, scope, details)
+            self.hits += 1
+            return details
+
+    def put(self, details: PaymentDetailsResponseSchema, scope=None):
+        now = time.time()
+        expires_at = now + self.ttl_for(details.status)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO payment_details (payment_intent_id, status, body, expires_at, updated_at, scope)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (details.channel_order_id, details.status, details.model_dump_json(), expires_at, now, scope),
+            )
+            self._remember(details.channel_order_id, expires_at, self._mark_changed(details.channel_order_id), scope,
+                           details)
+            self._writes += 1
+            # 定期清理 SQLite 中的过期记录，保持表大小有界
+            if self._writes % 1000 == 0:
+                self._conn.execute("DELETE FROM payment_details WHERE expires_at <= ?", (now,))
+
+    async def refresh(self, gateway, payment_intent_id, scope=None):
+        """从 Stripe 拉取最新详情并以 scope 写入台账；gateway 应为 scope 对应的网关"""
+        payment_intent = await gateway.retrieve_payment_intent(payment_intent_id, expand=PAYMENT_DETAILS_EXPAND)
+        details = build_payment_details(payment_intent)
+        await asyncio.to_thread(self.put, details, scope)
+        return details
+
+    async def summary(self, gateway, payment_intent_id, fields, scope=None):
+        """
+        返回只含 fields 的精简详情：台账命中时直接投影；
+        未命中时只请求这些字段需要的展开，需要完整展开时顺带写入台账。
+        """
+        details = await asyncio.to_thread(self.get, payment_intent_id, scope)
+        if details is None:
+            expand = expand_for(fields)
+            if expand == sorted(PAYMENT_DETAILS_EXPAND):
+                details = await self.refresh(gateway, payment_intent_id, scope)
+            else:
+                payment_intent = await gateway.retrieve_payment_intent(payment_intent_id,
+                                                                       **({"expand": expand} if expand else {}))
+                return project_payment_details(payment_intent, fields)
+        return project_payment_details(details, fields)
+
+    def invalidate(self, payment_intent_id):
+        with self._lock:
+            self._memory.pop(payment_intent_id, None)
+            self._conn.execute("DELETE FROM payment_details WHERE payment_intent_id = ?", (payment_intent_id,))
+            self._mark_changed(payment_intent_id)
+
+    def _mark_changed(self, payment_intent_id):
+        # 时间戳取在写入 SQLite 之后：在此之前读到旧记录的进程，其缓存时间一定早于时间戳
+        now = time.time()
+        if self.state.shared:
+            self.state.set(f"ledger:{payment_intent_id}", repr(now), ttl=self._stamp_ttl)
+        return now
+
+    def _changed_since(self, payment_intent_id, cached_at):
+        if not self.state.shared:
+            return False
+        stamp = self.state.get(f"ledger:{payment_intent_id}")
+        return stamp is not None and float(stamp) > cached_at
+
+    def _remember(self, payment_intent_id, expires_at, cached_at, scope, details):
+        self._memory[payment_intent_id] = (expires_at, cached_at, scope, details)
+        self._memory.move_to_end(payment_intent_id)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._memory), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,233 @@
+# 日志管道 - 队列 + 后台写线程输出结构化 JSON 日志，按事件采样、重复告警限频，并对卡号与密钥脱敏
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from backend.metrics import counters
+
+FORMAT_JSON = "json"
+FORMAT_TEXT = "text"
+
+# LogRecord 自带的属性；其余属性都来自 extra=，作为结构化字段输出
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+# 结构化字段中值需要整体隐藏的键
+SENSITIVE_KEYS = frozenset({"card_number", "number", "cvc", "cvv", "api_key", "secret", "password",
+                            "authorization", "client_secret", "stripe_secret_key", "webhook_secret"})
+
+_CARD_NUMBER = re.compile(r"(?<![\w.])(?:\d[ -]?){12,18}\d(?![\w.])")
+_SECRET_KEY = re.compile(r"\b((?:sk|rk)_(?:live|test)_|whsec_)[0-9A-Za-z]+")
+_CLIENT_SECRET = re.compile(r"(_secret_)[0-9A-Za-z]+")
+_CVC = re.compile(r"((?:cvc|cvv)\W{0,3}[:=]\W{0,2})\d{3,4}", re.IGNORECASE)
+
+
+def _luhn(digits):
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if i % 2:
+            value = value * 2 - 9 if value > 4 else value * 2
+        total += value
+    return total % 10 == 0
+
+
+def _mask_card(match):
+    digits = re.sub(r"\D", "", match.group())
+    # 只遮盖通过 Luhn 校验的数字串，时间戳、订单号等不受影响
+    if not 13 <= len(digits) <= 19 or not _luhn(digits):
+        return match.group()
+    return "*" * (len(digits) - 4) + digits[-4:]
+
+
+def redact(text):
+    """遮盖卡号（保留后四位）、CVC、Stripe 密钥、Webhook 密钥与 client_secret"""
+    text = _CARD_NUMBER.sub(_mask_card, text)
+    text = _SECRET_KEY.sub(r"\1***", text)
+    text = _CLIENT_SECRET.sub(r"\1***", text)
+    return _CVC.sub(r"\1***", text)
+
+
+def _redact_value(key, value):
+    if key in SENSITIVE_KEYS:
+        return "***"
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, dict):
+        return {k: _redact_value(k, v) for k, v in value.items()}
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一个 JSON 对象：时间、级别、logger、消息，以及 extra= 传入的字段（payment_id、status 等）"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = _redact_value(key, value)
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """本地开发用的单行文本格式，结构化字段以 key=value 附在消息后"""
+
+    def __init__(self):
+        super().__init__("%(levelname)s:%(name)s:%(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = " ".join(f"{key}={_redact_value(key, value)}" for key, value in record.__dict__.items()
+                          if key not in _RECORD_ATTRIBUTES and not key.startswith("_"))
+        return redact(f"{text} {fields}" if fields else text)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    按事件类别（extra 中的 event）对 WARNING 以下的记录采样，如 {"payment.details": 0.01}；
+    保留的记录带 sample_rate 字段，便于按比例还原总量。WARNING 及以上的记录不采样。
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None), 1.0)
+        if rate >= 1.0:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    同一类告警（logger + event，没有 event 时为消息模板）每个时间窗口最多输出 limit 条，其余丢弃；
+    下一个窗口输出的第一条记录带 suppressed 字段，给出上个窗口被丢弃的条数。
+    """
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, getattr(record, "event", None) or record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                if len(self._windows) > 10000:
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.limit:
+                window[1] += 1
+                return True
+            window[2] += 1
+            counters.inc("logs.suppressed", logger=record.name)
+            return False
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    把记录原样放入队列：消息拼接、JSON 序列化、脱敏与写出都在后台线程完成，事件循环线程只做入队。
+    队列已满时丢弃记录并计数，不阻塞调用方。
+    """
+
+    def __init__(self, maxsize):
+        # SimpleQueue 入队不经过 Condition，比 queue.Queue 便宜；上限由 qsize() 检查
+        super().__init__(queue.SimpleQueue())
+        self.maxsize = maxsize
+
+    def prepare(self, record):
+        # 同一进程内的队列无需序列化记录；参数在写线程中才格式化
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.maxsize:
+            counters.inc("logs.dropped", logger=record.name)
+            return
+        self.queue.put_nowait(record)
+
+
+def _parse_sampling(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+_listener = None
+
+
+def configure_logging(level=None, log_format=None, sampling=None, rate_limit=None, queue_size=None, stream=None):
+    """
+    为根 logger 安装队列日志管道，重复调用时替换之前安装的管道。
+
+    - **level**: STRIPE_LOG_LEVEL，默认 INFO
+    - **log_format**: STRIPE_LOG_FORMAT，json 或 text
+    - **sampling**: STRIPE_LOG_SAMPLING，如 "payment.details=0.01,card_payments.retrieved=0.1"
+    - **rate_limit**: STRIPE_LOG_RATE_LIMIT，"条数/秒数"，同一类告警每个窗口最多输出的条数
+    - **queue_size**: STRIPE_LOG_QUEUE_SIZE，队列上限，写线程跟不上时丢弃新记录
+    """
+    global _listener
+    level = level or os.getenv("STRIPE_LOG_LEVEL", "INFO")
+    log_format = log_format or os.getenv("STRIPE_LOG_FORMAT", FORMAT_JSON)
+    sampling = sampling if sampling is not None else _parse_sampling(os.getenv("STRIPE_LOG_SAMPLING", ""))
+    limit, _, interval = (rate_limit or os.getenv("STRIPE_LOG_RATE_LIMIT", "20/60")).partition("/")
+    queue_size = queue_size or int(os.getenv("STRIPE_LOG_QUEUE_SIZE", "10000"))
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if log_format == FORMAT_JSON else TextFormatter())
+    handler = LazyQueueHandler(queue_size)
+    handler.addFilter(SamplingFilter(sampling))
+    handler.addFilter(RateLimitFilter(int(limit), float(interval or 60)))
+
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+        for existing in [h for h in root.handlers if isinstance(h, LazyQueueHandler)]:
+            root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def flush_logging():
+    """停止写线程并写出队列中剩余的记录"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(flush_logging)
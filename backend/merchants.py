@@ -0,0 +1,232 @@
+# 商户路由 - merchant_id -> 商户独立的 Stripe 网关（密钥、连接账户、并发名额、限流预算与熔断状态），配置文件热加载
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.gateway import StripeGateway
+from backend.ratelimit import StripeRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# 单个商户配置中允许的字段
+_CONFIG_FIELDS = {"api_key", "api_key_env", "account_id", "max_concurrency", "rates", "account_rate", "callback_url"}
+
+
+class UnknownMerchantError(KeyError):
+    """严格模式下 merchant_id 不在商户配置中"""
+
+
+def _parse_config(raw):
+    """
+    校验并规整配置文件内容，返回 {merchant_id: 配置字典}。
+    api_key_env 在这里解析为实际密钥，便于比较前后两次加载的配置是否变化。
+    """
+    merchants = raw.get("merchants", raw) if isinstance(raw, dict) else None
+    if not isinstance(merchants, dict):
+        raise ValueError("merchant config must be an object of merchant_id -> settings")
+    configs = {}
+    for merchant_id, settings in merchants.items():
+        if not isinstance(settings, dict):
+            raise ValueError(f"merchant {merchant_id}: settings must be an object")
+        unknown = set(settings) - _CONFIG_FIELDS
+        if unknown:
+            raise ValueError(f"merchant {merchant_id}: unknown fields {sorted(unknown)}")
+        api_key = settings.get("api_key")
+        if settings.get("api_key_env"):
+            api_key = os.getenv(settings["api_key_env"])
+            if not api_key:
+                raise ValueError(f"merchant {merchant_id}: environment variable {settings['api_key_env']} is not set")
+        configs[str(merchant_id)] = {
+            "api_key": api_key,
+            "account_id": settings.get("account_id"),
+            "max_concurrency": int(settings["max_concurrency"]) if settings.get("max_concurrency") else None,
+            "rates": {kind: float(rate) for kind, rate in (settings.get("rates") or {}).items()},
+            "account_rate": float(settings["account_rate"]) if settings.get("account_rate") else None,
+            "callback_url": settings.get("callback_url"),
+        }
+    return configs
+
+
+class MerchantRegistry:
+    """
+    多商户路由：每个商户一个独立的 StripeGateway，按 merchant_id 在字典中 O(1) 查找。
+
+    各商户的网关使用自己的密钥与连接账户（传输层据此使用独立的长连接池）、自己的并发名额，
+    以及自己的限流调度器（令牌桶预算与熔断器），一个商户被 Stripe 限流、变慢或熔断不会占用其他商户的名额。
+    所有商户网关共用一个有界线程池，进程内的线程数不随商户数增长。
+
+    配置文件（STRIPE_MERCHANTS_PATH）为 JSON：
+        {"merchants": {"m_1001": {"api_key_env": "STRIPE_SECRET_KEY_M1001", "account_id": "acct_xxx",
+                                  "max_concurrency": 8, "rates": {"create": 20}, "account_rate": 50}}}
+    省略 api_key / api_key_env 时使用平台密钥（stripe.api_key），即以连接账户身份调用。
+    callback_url 为该商户异步创建支付（Prefer: respond-async）的默认结果回调地址。
+
+    - **default**: 未配置的商户使用的网关（即 STRIPE_ACCOUNT_ID 对应的默认网关）
+    - **strict**: STRIPE_MERCHANTS_STRICT，为 1 时未配置的 merchant_id 直接拒绝，而不是落到默认网关
+    - **max_workers**: STRIPE_MERCHANT_MAX_WORKERS，商户网关共用的线程池大小
+    - **max_concurrency**: STRIPE_MERCHANT_MAX_CONCURRENCY，单个商户默认的在途请求上限
+    - **state**: 状态后端，多 worker 部署时各商户的令牌桶按商户隔离地在进程间共享
+    """
+
+    def __init__(self, default, path=None, strict=None, max_workers=None, max_concurrency=None, state=None):
+        self.default = default
+        self.path = path if path is not None else os.getenv("STRIPE_MERCHANTS_PATH")
+        self.strict = strict if strict is not None else os.getenv("STRIPE_MERCHANTS_STRICT", "0") == "1"
+        self.max_workers = max_workers or int(os.getenv("STRIPE_MERCHANT_MAX_WORKERS", "64"))
+        self.max_concurrency = max_concurrency or int(os.getenv("STRIPE_MERCHANT_MAX_CONCURRENCY", "8"))
+        self.state = state
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stripe-merchant")
+        # merchant_id -> (配置, 网关)；重新加载时整体替换，查找方不会看到加载了一半的配置
+        self._merchants = {}
+        # 连接账户 -> merchant_id，用于按 Stripe 推送的 account 字段路由
+        self._accounts = {}
+        self._mtime = None
+        self.reloads = 0
+        self.reload_errors = 0
+
+    def gateway(self, merchant_id):
+        """返回商户的网关；未配置的商户在非严格模式下使用默认网关"""
+        entry = self._merchants.get(merchant_id)
+        if entry is not None:
+            return entry[1]
+        if self.strict and merchant_id is not None:
+            raise UnknownMerchantError(merchant_id)
+        return self.default
+
+    def scope(self, merchant_id):
+        """本地台账与卡索引的隔离范围：已配置的商户为其 merchant_id，使用默认网关的请求为 None"""
+        return merchant_id if merchant_id in self._merchants else None
+
+    def owner(self, merchant_id=None, account=None):
+        """
+        Stripe 推送或列出的对象所属的已配置商户：先按 metadata.merchant_id、再按连接账户匹配，
+        都未匹配时为 None（默认网关）。
+        """
+        if merchant_id in self._merchants:
+            return merchant_id
+        return self._accounts.get(account) if account else None
+
+    def resolve(self, merchant_id=None, account=None):
+        """
+        为 Stripe 推送或列出的对象选择网关（匹配规则同 owner）。
+        用于 webhook 等无法拒绝请求的场景，不受严格模式影响。
+        """
+        entry = self._merchants.get(self.owner(merchant_id, account))
+        return entry[1] if entry is not None else self.default
+
+    def scoped_key(self, merchant_id, key):
+        """
+        本地幂等存储使用的键：已配置的商户加上 merchant_id 前缀，不同商户可以使用相同的外部订单号；
+        默认网关上的请求保持原键。发往 Stripe 的幂等键不变（Stripe 的幂等键本身按账户隔离）。
+        """
+        if key and merchant_id in self._merchants:
+            return f"{merchant_id}:{key}"
+        return key
+
+    def callback_url(self, merchant_id):
+        """商户配置的异步支付结果回调地址，未配置时为 None"""
+        entry = self._merchants.get(merchant_id)
+        return entry[0]["callback_url"] if entry is not None else None
+
+    def _build(self, merchant_id, config):
+        limiter = StripeRateLimiter(rates=config["rates"], account_rate=config["account_rate"], state=self.state,
+                                    namespace=f"merchant:{merchant_id}")
+        return StripeGateway(api_key=config["api_key"], account=config["account_id"],
+                             max_concurrency=config["max_concurrency"] or self.max_concurrency,
+                             limiter=limiter, executor=self._executor)
+
+    def load(self, configs):
+        """
+        应用一份新的商户配置。配置未变化的商户沿用原网关（保留限流与熔断状态），
+        新增或变化的商户创建新网关；原网关上的在途请求照常完成。返回各类变化的商户数。
+        """
+        current = self._merchants
+        merchants = {}
+        added = updated = 0
+        for merchant_id, config in configs.items():
+            entry = current.get(merchant_id)
+            if entry is not None and entry[0] == config:
+                merchants[merchant_id] = entry
+                continue
+            merchants[merchant_id] = (config, self._build(merchant_id, config))
+            if entry is None:
+                added += 1
+            else:
+                updated += 1
+        removed = len(set(current) - set(merchants))
+        accounts = {}
+        for merchant_id, (config, _) in merchants.items():
+            if config["account_id"]:
+                accounts.setdefault(config["account_id"], merchant_id)
+        self._merchants = merchants
+        self._accounts = accounts
+        self.reloads += 1
+        return {"merchants": len(merchants), "added": added, "updated": updated, "removed": removed}
+
+    def reload(self, force=False):
+        """
+        配置文件的修改时间变化（或 force）时重新读取并应用；文件未配置或未变化时返回 None。
+        配置无效时抛出 ValueError，保留当前配置。
+        """
+        if not self.path:
+            return None
+        mtime = os.stat(self.path).st_mtime_ns
+        if not force and mtime == self._mtime:
+            return None
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                configs = _parse_config(json.load(f))
+        except ValueError:
+            self.reload_errors += 1
+            # 记下这次的修改时间，文件再次修改前不重复报错
+            self._mtime = mtime
+            raise
+        self._mtime = mtime
+        result = self.load(configs)
+        logger.info("Merchant config loaded: %d merchants (%d added, %d updated, %d removed)",
+                    result["merchants"], result["added"], result["updated"], result["removed"],
+                    extra={"event": "merchants.reloaded"})
+        return result
+
+    async def watch_forever(self, interval):
+        """后台任务：定期检查配置文件的修改时间，变化时热加载，无需重启进程"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload)
+            except (OSError, ValueError) as e:
+                logger.error("Merchant config reload failed, keeping current config: %s", e,
+                             extra={"event": "merchants.reload_failed", "error": type(e).__name__})
+
+    def gateways(self):
+        """[(merchant_id, 网关)]，用于埋点与统计"""
+        return [(merchant_id, gateway) for merchant_id, (_, gateway) in list(self._merchants.items())]
+
+    def stats(self):
+        merchants = {}
+        for merchant_id, gateway in self.gateways():
+            limiter_stats = gateway.limiter.stats()
+            merchants[merchant_id] = {
+                "account_id": gateway.account,
+                "dedicated_key": gateway.api_key is not None,
+                "max_concurrency": gateway.max_concurrency,
+                "in_flight": gateway.in_flight,
+                "waiting": gateway.waiting,
+                "rates": limiter_stats["rates"],
+                "account_rate": limiter_stats["account_rate"],
+                "endpoints": limiter_stats["endpoints"],
+                "circuits": limiter_stats["circuits"],
+            }
+        return {
+            "path": self.path,
+            "strict": self.strict,
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+            "max_workers": self.max_workers,
+            "merchants": merchants,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
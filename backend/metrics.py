@@ -0,0 +1,249 @@
+# 延迟统计 - 按阶段记录 Stripe 调用等热点路径的耗时直方图、计数器与在途量，并以 Prometheus 文本格式导出
+import bisect
+import contextvars
+import itertools
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# 直方图分桶上界（秒），覆盖本地缓存命中到 Stripe 慢请求
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """
+    可选的轻量调用链：开启后每个 latency.time() 区间与每个 HTTP 请求都是一个 span，
+    同一请求内的 span 经由 contextvars 关联为一条 trace，最近 max_traces 条完成的 trace 保存在内存中。
+    默认关闭，关闭时不产生任何额外开销。
+    """
+
+    def __init__(self, enabled=False, max_traces=200):
+        self.enabled = enabled
+        self._traces = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def configure(self, enabled=None, max_traces=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if max_traces is not None and max_traces != self._traces.maxlen:
+            with self._lock:
+                self._traces = deque(self._traces, maxlen=max_traces)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """开启一个 span 并返回其字典，调用方可在区间内补充 attributes"""
+        parent = _current_span.get()
+        span = {
+            "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": parent["span_id"] if parent else None,
+            "name": name,
+            "attributes": attributes,
+            "start": time.time(),
+            "duration_ms": None,
+        }
+        spans = parent["_spans"] if parent else []
+        spans.append(span)
+        span["_spans"] = spans
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            span["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            _current_span.reset(token)
+            if parent is None:
+                with self._lock:
+                    self._traces.append(spans)
+
+    def recent(self, limit=20):
+        """最近完成的 trace，新的在前；每条 trace 为按开始顺序排列的 span 列表"""
+        with self._lock:
+            traces = list(itertools.islice(reversed(self._traces), limit))
+        return [[{key: value for key, value in span.items() if key != "_spans"} for span in spans]
+                for spans in traces]
+
+
+class LatencyRecorder:
+    """
+    线程安全的轻量耗时统计，按 (名称, 标签) 聚合次数、总耗时、最大耗时与分桶计数。
+
+    用法：
+        with latency.time("create_payment.phase", mode="single", phase="payment_intent_create"):
+            ...
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, tracer=None):
+        self.buckets = tuple(buckets)
+        self.tracer = tracer or Tracer()
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+            series[0] += 1
+            series[1] += seconds
+            if seconds > series[2]:
+                series[2] = seconds
+            series[3][index] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            if self.tracer.enabled:
+                with self.tracer.span(name, **labels):
+                    yield
+            else:
+                yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        """返回单个序列的 {count, avg_ms, max_ms}，不存在时返回 None"""
+        with self._lock:
+            series = self._series.get((name, tuple(sorted(labels.items()))))
+            if series is None:
+                return None
+            count, total, maximum, _ = series
+        return {"count": count, "avg_ms": round(total * 1000 / count, 3), "max_ms": round(maximum * 1000, 3)}
+
+    def summary(self):
+        with self._lock:
+            items = [(name, labels, list(series)) for (name, labels), series in self._series.items()]
+        result = {}
+        for name, labels, (count, total, maximum, _) in items:
+            label = ",".join(f"{k}={v}" for k, v in labels) or "-"
+            result.setdefault(name, {})[label] = {
+                "count": count,
+                "avg_ms": round(total * 1000 / count, 3),
+                "max_ms": round(maximum * 1000, 3),
+            }
+        return result
+
+    def snapshot(self):
+        """[(名称, 标签元组, 次数, 总耗时, 分桶计数)]，分桶计数不累加"""
+        with self._lock:
+            return [(name, labels, series[0], series[1], list(series[3]))
+                    for (name, labels), series in self._series.items()]
+
+
+class CounterSet:
+    """按 (名称, 标签) 累加的计数器，如各类 Stripe 错误次数、各支付状态的结果数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return [(name, labels, value) for (name, labels), value in self._values.items()]
+
+
+class GaugeSet:
+    """
+    抓取时才取值的瞬时量（在途请求数、排队深度等），注册一个无参函数，
+    返回单个数值，或 [(标签字典, 数值)] 列表。
+    """
+
+    def __init__(self):
+        self._collectors = {}
+
+    def register(self, name, collect):
+        self._collectors[name] = collect
+
+    def snapshot(self):
+        result = []
+        for name, collect in list(self._collectors.items()):
+            try:
+                values = collect()
+            except Exception:
+                # 依赖的服务对象已关闭或尚未启动时跳过
+                continue
+            if isinstance(values, (int, float)):
+                values = [({}, values)]
+            result.extend((name, tuple(sorted(labels.items())), value) for labels, value in values)
+        return result
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _series_key(item):
+    # 同名序列的标签值可能类型不同（如状态码与字符串），按文本排序
+    return item[0], repr(item[1])
+
+
+def render_prometheus(recorder, counter_set, gauge_set, prefix="stripe_payment_"):
+    """以 Prometheus 文本格式（0.0.4）导出直方图、计数器与瞬时量"""
+    lines = []
+    declared = set()
+
+    def declare(metric, kind):
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f"# TYPE {metric} {kind}")
+
+    for name, labels, count, total, buckets in sorted(recorder.snapshot(), key=_series_key):
+        metric = f"{prefix}{_metric_name(name)}_seconds"
+        declare(metric, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(recorder.buckets, buckets):
+            cumulative += bucket_count
+            lines.append(f"{metric}_bucket{_labels(labels, le=bound)} {cumulative}")
+        lines.append(f"{metric}_bucket{_labels(labels, le='+Inf')} {count}")
+        lines.append(f"{metric}_sum{_labels(labels)} {total:.6f}")
+        lines.append(f"{metric}_count{_labels(labels)} {count}")
+    for name, labels, value in sorted(counter_set.snapshot(), key=_series_key):
+        metric = f"{prefix}{_metric_name(name)}_total"
+        declare(metric, "counter")
+        lines.append(f"{metric}{_labels(labels)} {value}")
+    for name, labels, value in sorted(gauge_set.snapshot(), key=_series_key):
+        metric = f"{prefix}{_metric_name(name)}"
+        declare(metric, "gauge")
+        lines.append(f"{metric}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def tracing_from_env():
+    """按 STRIPE_TRACING（1/0）与 STRIPE_TRACING_MAX_TRACES 配置进程级调用链"""
+    tracer.configure(enabled=os.getenv("STRIPE_TRACING", "0") == "1",
+                     max_traces=int(os.getenv("STRIPE_TRACING_MAX_TRACES", "200")))
+
+
+# 进程级默认实例
+tracer = Tracer()
+latency = LatencyRecorder(tracer=tracer)
+counters = CounterSet()
+gauges = GaugeSet()
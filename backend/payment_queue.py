@@ -0,0 +1,532 @@
+# 异步支付队列 - 受理后立即返回，由后台 worker 调用 Stripe，最终结果批量回调商户（SQLite WAL 持久化、失败重试）
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import requests
+
+from backend.metrics import counters, latency
+from backend.webhooks import sign_payload
+
+logger = logging.getLogger(__name__)
+
+QUEUE_QUEUED = "queued"
+QUEUE_PROCESSING = "processing"
+QUEUE_DONE = "done"
+
+CALLBACK_PENDING = "pending"
+CALLBACK_DELIVERED = "delivered"
+CALLBACK_DEAD = "dead"
+
+# 已完成的支付与已结束的回调在存储中的保留时间（秒），超过后由维护任务删除
+PAYMENT_QUEUE_RETENTION = float(os.getenv("STRIPE_PAYMENT_QUEUE_RETENTION", "604800"))
+# 清理间隔（秒）与单个删除事务的行数，避免长时间占用写锁
+PURGE_INTERVAL = 600.0
+PURGE_BATCH = 1000
+
+# 不写入磁盘的卡片字段，只随内存中的队列项传给 worker
+CARD_SECRET_FIELDS = {"order": {"payment_method": {"payment_data": {"card_number", "cvv"}}}}
+
+
+class QueueFullError(Exception):
+    """本进程待处理的支付数已达上限，调用方应稍后重试"""
+
+
+class PaymentQueueStore:
+    """
+    异步支付与回调发件箱的 SQLite 存储，与台账共用同一个文件。
+
+    队列表只保存去掉卡号与 CVV 的请求（用于查询与异常恢复），卡片数据不落盘；
+    支付完成与写入回调发件箱在同一事务中完成，结果不会只落一半。
+    受理进程的心跳也保存在这个文件中：共用该文件的所有进程都能看到彼此的心跳，与状态后端的配置无关。
+    """
+
+    def __init__(self, path=None, busy_timeout=None):
+        self.path = path or os.getenv("STRIPE_LEDGER_PATH", "payment_ledger.db")
+        busy_timeout = busy_timeout or float(os.getenv("STRIPE_STATE_BUSY_TIMEOUT", "5"))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS payment_queue ("
+            " queue_id TEXT PRIMARY KEY,"
+            " queue_key TEXT NOT NULL,"
+            " merchant_id TEXT,"
+            " system_order_id TEXT,"
+            " external_request_order_id TEXT,"
+            " payload TEXT NOT NULL,"
+            " callback_url TEXT,"
+            " owner TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " result TEXT,"
+            " enqueued_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_payment_queue_status ON payment_queue (status, owner)")
+        # 只对未完成的支付去重：已完成的订单再次提交时照常受理，由幂等存储直接给出原结果
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_queue_key ON payment_queue (queue_key)"
+                           " WHERE status != 'done'")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS payment_queue_owners ("
+            " owner TEXT PRIMARY KEY,"
+            " expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS payment_callbacks ("
+            " callback_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " queue_id TEXT NOT NULL,"
+            " url TEXT NOT NULL,"
+            " body TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " claimed_until REAL NOT NULL DEFAULT 0,"
+            " last_error TEXT,"
+            " created_at REAL NOT NULL,"
+            " delivered_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_payment_callbacks_due ON payment_callbacks (status, next_attempt_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_payment_callbacks_queue ON payment_callbacks (queue_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_payment_queue_finished ON payment_queue (status, finished_at)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_payment_callbacks_created ON payment_callbacks (status, created_at)")
+
+    def _transaction(self, run):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = run(time.time())
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def add(self, queue_id, queue_key, payload, callback_url, owner):
+        """写入一笔待处理支付；同一 queue_key 尚有未完成的支付时不重复写入。返回 (queue_id, 是否新写入)"""
+        def run(now):
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO payment_queue (queue_id, queue_key, merchant_id, system_order_id,"
+                " external_request_order_id, payload, callback_url, owner, status, enqueued_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (queue_id, queue_key, payload.get("merchant_id"), payload.get("system_order_id"),
+                 payload.get("external_request_order_id"), json.dumps(payload, ensure_ascii=False), callback_url,
+                 owner, QUEUE_QUEUED, now),
+            )
+            if cursor.rowcount == 1:
+                return queue_id, True
+            row = self._conn.execute("SELECT queue_id FROM payment_queue WHERE queue_key = ? AND status != ?",
+                                     (queue_key, QUEUE_DONE)).fetchone()
+            return row[0], False
+
+        return self._transaction(run)
+
+    def mark_processing(self, queue_id):
+        with self._lock:
+            self._conn.execute("UPDATE payment_queue SET status = ?, started_at = ? WHERE queue_id = ?",
+                               (QUEUE_PROCESSING, time.time(), queue_id))
+
+    def complete(self, queue_id, result, callback_item):
+        """
+        记录最终结果，并在配置了回调地址时写入回调发件箱。
+        已完成的支付不会再次完成（多个进程同时恢复同一笔遗留支付时只有一个生效），返回是否生效。
+        """
+        def run(now):
+            cursor = self._conn.execute(
+                "UPDATE payment_queue SET status = ?, result = ?, finished_at = ? WHERE queue_id = ? AND status != ?",
+                (QUEUE_DONE, json.dumps(result, ensure_ascii=False), now, queue_id, QUEUE_DONE),
+            )
+            if cursor.rowcount != 1:
+                return False
+            row = self._conn.execute("SELECT callback_url FROM payment_queue WHERE queue_id = ?", (queue_id,)).fetchone()
+            if row[0]:
+                self._conn.execute(
+                    "INSERT INTO payment_callbacks (queue_id, url, body, status, next_attempt_at, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (queue_id, row[0], json.dumps(callback_item, ensure_ascii=False), CALLBACK_PENDING, now, now),
+                )
+            return True
+
+        return self._transaction(run)
+
+    def get(self, queue_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT queue_id, merchant_id, system_order_id, external_request_order_id, status, result,"
+                " enqueued_at, started_at, finished_at FROM payment_queue WHERE queue_id = ?", (queue_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            callback = self._conn.execute(
+                "SELECT status, attempts, last_error, delivered_at FROM payment_callbacks WHERE queue_id = ?"
+                " ORDER BY callback_id DESC LIMIT 1", (queue_id,)
+            ).fetchone()
+        keys = ("queue_id", "merchant_id", "system_order_id", "external_request_order_id", "status", "result",
+                "enqueued_at", "started_at", "finished_at")
+        entry = dict(zip(keys, row))
+        entry["result"] = json.loads(entry["result"]) if entry["result"] else None
+        entry["callback"] = dict(zip(("status", "attempts", "last_error", "delivered_at"), callback)) if callback else None
+        return entry
+
+    def heartbeat(self, owner, ttl):
+        """记录受理进程仍在运行，ttl 秒内未再次记录即视为已退出"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO payment_queue_owners (owner, expires_at) VALUES (?, ?)",
+                               (owner, now + ttl))
+            self._conn.execute("DELETE FROM payment_queue_owners WHERE expires_at <= ?", (now,))
+
+    def remove_owner(self, owner):
+        with self._lock:
+            self._conn.execute("DELETE FROM payment_queue_owners WHERE owner = ?", (owner,))
+
+    def orphaned(self, exclude_owner):
+        """心跳已过期的进程受理、尚未完成的支付 [(queue_id, payload)]"""
+        with self._lock:
+            return [(queue_id, json.loads(payload)) for queue_id, payload in self._conn.execute(
+                "SELECT queue_id, payload FROM payment_queue AS q WHERE status != ? AND owner != ? AND NOT EXISTS"
+                " (SELECT 1 FROM payment_queue_owners AS o WHERE o.owner = q.owner AND o.expires_at > ?)",
+                (QUEUE_DONE, exclude_owner, time.time()),
+            ).fetchall()]
+
+    def claim_callbacks(self, limit, lease):
+        """取出到期的待投递回调并占用 lease 秒，多个进程不会同时投递同一条。返回 [(callback_id, url, body, attempts)]"""
+        def run(now):
+            rows = self._conn.execute(
+                "SELECT callback_id, url, body, attempts FROM payment_callbacks"
+                " WHERE status = ? AND next_attempt_at <= ? AND claimed_until <= ? ORDER BY next_attempt_at LIMIT ?",
+                (CALLBACK_PENDING, now, now, limit),
+            ).fetchall()
+            self._conn.executemany("UPDATE payment_callbacks SET claimed_until = ? WHERE callback_id = ?",
+                                   [(now + lease, row[0]) for row in rows])
+            return [(callback_id, url, json.loads(body), attempts) for callback_id, url, body, attempts in rows]
+
+        return self._transaction(run)
+
+    def callbacks_delivered(self, callback_ids):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE payment_callbacks SET status = ?, attempts = attempts + 1, delivered_at = ?, last_error = NULL"
+                " WHERE callback_id = ?", [(CALLBACK_DELIVERED, now, callback_id) for callback_id in callback_ids])
+
+    def callbacks_failed(self, updates):
+        """updates 为 [(callback_id, 状态, 下次投递时间, 错误信息)]"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE payment_callbacks SET status = ?, attempts = attempts + 1, next_attempt_at = ?,"
+                " claimed_until = 0, last_error = ? WHERE callback_id = ?",
+                [(status, next_attempt_at, error, callback_id) for callback_id, status, next_attempt_at, error in updates])
+
+    def purge(self, before, batch=PURGE_BATCH):
+        """
+        删除 before 之前结束的回调（已投递或已放弃），以及 before 之前完成、且没有待投递回调的支付。
+        每个事务最多删除 batch 行，返回删除的 (支付数, 回调数)。
+        """
+        def delete(sql, params):
+            total = 0
+            while True:
+                with self._lock:
+                    deleted = self._conn.execute(sql, (*params, batch)).rowcount
+                total += deleted
+                if deleted < batch:
+                    return total
+
+        callbacks = delete(
+            "DELETE FROM payment_callbacks WHERE callback_id IN (SELECT callback_id FROM payment_callbacks"
+            " WHERE status IN (?, ?) AND created_at < ? LIMIT ?)", (CALLBACK_DELIVERED, CALLBACK_DEAD, before))
+        queue = delete(
+            "DELETE FROM payment_queue WHERE queue_id IN (SELECT queue_id FROM payment_queue AS q"
+            " WHERE status = ? AND finished_at < ? AND NOT EXISTS (SELECT 1 FROM payment_callbacks AS c"
+            " WHERE c.queue_id = q.queue_id AND c.status = ?) LIMIT ?)", (QUEUE_DONE, before, CALLBACK_PENDING))
+        return queue, callbacks
+
+    def counts(self):
+        with self._lock:
+            queue = dict(self._conn.execute("SELECT status, COUNT(*) FROM payment_queue GROUP BY status").fetchall())
+            callbacks = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM payment_callbacks GROUP BY status").fetchall())
+        return {"queue": queue, "callbacks": callbacks}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CallbackDispatcher:
+    """
+    把支付结果投递到商户的回调地址：同一地址的结果合并为一个请求 {"results": [...]}，
+    非 2xx 或网络错误时按全抖动指数退避重试，超过最大次数后标记为 dead 并记录错误日志。
+
+    - **secret**: STRIPE_CALLBACK_SECRET，配置后请求头 X-Callback-Signature 带与 Stripe-Signature 相同格式的签名
+    - **batch_size**: STRIPE_CALLBACK_BATCH_SIZE，单个请求最多包含的结果数
+    - **max_attempts**: STRIPE_CALLBACK_MAX_ATTEMPTS
+    - **timeout**: STRIPE_CALLBACK_TIMEOUT，单个请求的超时（秒）
+    - **flush_interval**: STRIPE_CALLBACK_FLUSH_INTERVAL，有新结果后等待多久再投递，用于攒批
+    """
+
+    def __init__(self, store, secret=None, batch_size=None, max_attempts=None, timeout=None, flush_interval=None,
+                 poll_interval=1.0, backoff_base=1.0, backoff_cap=300.0):
+        self.store = store
+        self.secret = secret if secret is not None else os.getenv("STRIPE_CALLBACK_SECRET")
+        self.batch_size = batch_size or int(os.getenv("STRIPE_CALLBACK_BATCH_SIZE", "50"))
+        self.max_attempts = max_attempts or int(os.getenv("STRIPE_CALLBACK_MAX_ATTEMPTS", "8"))
+        self.timeout = timeout or float(os.getenv("STRIPE_CALLBACK_TIMEOUT", "10"))
+        self.flush_interval = flush_interval if flush_interval is not None else float(
+            os.getenv("STRIPE_CALLBACK_FLUSH_INTERVAL", "0.2"))
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._session = requests.Session()
+        self._wake = asyncio.Event()
+        self._loop = None
+        self._task = None
+
+    def wake(self):
+        """通知有新结果待投递；可在任意线程调用（如在线程中恢复遗留支付时），事件在事件循环中置位"""
+        if self._loop is None:
+            self._wake.set()
+            return
+        self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _post(self, url, items):
+        """在线程中执行；成功返回 None，失败返回错误信息"""
+        payload = json.dumps({"results": items}, ensure_ascii=False)
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers["X-Callback-Signature"] = sign_payload(payload, self.secret)
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            response = self._session.post(url, data=payload.encode(), headers=headers, timeout=self.timeout)
+            if not 200 <= response.status_code < 300:
+                outcome = str(response.status_code)
+                return f"HTTP {response.status_code}"
+            return None
+        except requests.RequestException as e:
+            outcome = type(e).__name__
+            return f"{type(e).__name__}: {str(e)}"
+        finally:
+            latency.observe("callbacks.post", time.perf_counter() - start, outcome=outcome)
+
+    def _backoff(self, attempts):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempts)))
+
+    async def flush(self):
+        """投递当前所有到期的回调，返回投递成功的条数"""
+        delivered = 0
+        while True:
+            # 发件箱的读写是 SQLite 写事务，可能等待其他进程的写锁，在线程中进行
+            rows = await asyncio.to_thread(self.store.claim_callbacks, self.batch_size * 8, lease=self.timeout * 2)
+            if not rows:
+                return delivered
+            by_url = defaultdict(list)
+            for row in rows:
+                by_url[row[1]].append(row)
+            batches = [(url, group[i:i + self.batch_size])
+                       for url, group in by_url.items() for i in range(0, len(group), self.batch_size)]
+            errors = await asyncio.gather(*(asyncio.to_thread(self._post, url, [row[2] for row in batch])
+                                            for url, batch in batches))
+            ok, failed = [], []
+            now = time.time()
+            for (url, batch), error in zip(batches, errors):
+                if error is None:
+                    ok.extend(row[0] for row in batch)
+                    continue
+                for callback_id, _, body, attempts in batch:
+                    dead = attempts + 1 >= self.max_attempts
+                    failed.append((callback_id, CALLBACK_DEAD if dead else CALLBACK_PENDING,
+                                   now + self._backoff(attempts), error))
+                    if dead:
+                        counters.inc("callbacks.dead")
+                        logger.error("Payment callback to %s abandoned after %d attempts: %s", url, attempts + 1, error,
+                                     extra={"event": "callback.dead", "payment_id": body.get("channel_order_id"),
+                                            "merchant_id": body.get("merchant_id")})
+            if ok:
+                await asyncio.to_thread(self.store.callbacks_delivered, ok)
+                counters.inc("callbacks.delivered", len(ok))
+                delivered += len(ok)
+            if failed:
+                await asyncio.to_thread(self.store.callbacks_failed, failed)
+                counters.inc("callbacks.failed", len(failed))
+                logger.warning("Payment callback delivery failed for %d results: %s", len(failed), failed[0][3],
+                               extra={"event": "callback.failed"})
+            if len(rows) < self.batch_size * 8:
+                return delivered
+
+    async def run_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+                # 有新结果时稍等片刻，把同一时段完成的结果合并投递
+                await asyncio.sleep(self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.error("Payment callback flush failed: %s", e, extra={"event": "callback.flush_failed"})
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def close(self):
+        self._session.close()
+
+
+class PaymentQueue:
+    """
+    受理后排队执行的创建支付：workers 个协程从本进程的有界队列中取出支付并调用 handler，
+    队列已满（max_depth）时 submit 抛出 QueueFullError，由接口返回 503，形成背压。
+
+    卡号与 CVV 只存在于内存中的队列项里，持久化的只是去掉卡片数据的请求与处理状态：
+    受理它的进程退出后（心跳在队列存储中过期），其他进程或重启后的本进程调用 recover(payload)
+    为遗留的支付给出最终结果（例如已在幂等存储中完成的结果，或要求商户重新提交），并照常回调。
+
+    - **handler**: async handler(data) -> ChannelPaymentResponseSchema 字段字典
+    - **workers**: STRIPE_PAYMENT_QUEUE_WORKERS，同时处理的支付数
+    - **max_depth**: STRIPE_PAYMENT_QUEUE_MAX_DEPTH，本进程排队中的支付数上限
+    - **heartbeat_ttl**: 进程心跳的有效期（秒），超过后其受理的未完成支付视为遗留
+    - **retention**: STRIPE_PAYMENT_QUEUE_RETENTION，已完成的支付与已结束的回调保留多久（秒）后删除
+    """
+
+    def __init__(self, store, handler, recover, dispatcher=None, workers=None, max_depth=None, heartbeat_ttl=30.0,
+                 retention=None):
+        self.store = store
+        self.handler = handler
+        self.recover = recover
+        self.dispatcher = dispatcher
+        self.workers = workers or int(os.getenv("STRIPE_PAYMENT_QUEUE_WORKERS", "8"))
+        self.max_depth = max_depth or int(os.getenv("STRIPE_PAYMENT_QUEUE_MAX_DEPTH", "1000"))
+        self.heartbeat_ttl = heartbeat_ttl
+        self.retention = retention if retention is not None else PAYMENT_QUEUE_RETENTION
+        self._purged_at = None
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._queue = asyncio.Queue(self.max_depth)
+        # 已通过容量检查、正在写入存储的支付数，写入期间不会被其他请求挤占队列位置
+        self._reserved = 0
+        self._tasks = []
+        self.processing = 0
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    async def submit(self, data, queue_key, callback_url):
+        """受理一笔支付，返回 (queue_id, 是否新受理)；同一 queue_key 的支付尚未完成时返回原来的 queue_id"""
+        if self._queue.qsize() + self._reserved >= self.max_depth:
+            counters.inc("payment_queue.rejected")
+            raise QueueFullError()
+        payload = data.model_dump(mode="json", exclude=CARD_SECRET_FIELDS)
+        self._reserved += 1
+        try:
+            # SQLite 写事务可能等待其他进程的写锁，在线程中进行，不阻塞事件循环
+            queue_id, created = await asyncio.to_thread(self.store.add, f"pq_{uuid.uuid4().hex}", queue_key, payload,
+                                                        callback_url, self.owner)
+        finally:
+            self._reserved -= 1
+        if created:
+            self._queue.put_nowait((queue_id, data, time.perf_counter()))
+            counters.inc("payment_queue.accepted")
+        return queue_id, created
+
+    def _finish(self, queue_id, payload, result):
+        """在线程中执行（写入结果与回调发件箱是 SQLite 写事务）"""
+        callback_item = {
+            "queue_id": queue_id,
+            "merchant_id": payload.get("merchant_id"),
+            "system_order_id": payload.get("system_order_id"),
+            "external_request_order_id": payload.get("external_request_order_id"),
+            **result,
+        }
+        if self.store.complete(queue_id, result, callback_item):
+            counters.inc("payment_queue.completed", status=result.get("status"))
+            if self.dispatcher is not None:
+                self.dispatcher.wake()
+
+    async def _worker(self):
+        while True:
+            queue_id, data, enqueued = await self._queue.get()
+            latency.observe("payment_queue.wait", time.perf_counter() - enqueued)
+            self.processing += 1
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.store.mark_processing, queue_id)
+                try:
+                    result = await self.handler(data)
+                except Exception as e:
+                    logger.error("Queued payment %s failed: %s", queue_id, e, exc_info=True,
+                                 extra={"event": "payment_queue.failed", "merchant_id": data.merchant_id})
+                    result = {"channel_order_id": None, "status": "failed",
+                              "detail": {"message": f"服务器错误: {str(e)}"}}
+                await asyncio.to_thread(self._finish, queue_id, {
+                    "merchant_id": data.merchant_id, "system_order_id": data.system_order_id,
+                    "external_request_order_id": data.external_request_order_id}, result)
+            finally:
+                self.processing -= 1
+                latency.observe("payment_queue.run", time.perf_counter() - start)
+
+    def recover_orphans(self):
+        """为心跳已过期的进程遗留的未完成支付给出结果，返回处理的条数"""
+        recovered = 0
+        for queue_id, payload in self.store.orphaned(self.owner):
+            self._finish(queue_id, payload, self.recover(payload))
+            recovered += 1
+        if recovered:
+            logger.warning("Recovered %d queued payments left by stopped workers", recovered,
+                           extra={"event": "payment_queue.recovered"})
+        return recovered
+
+    async def _maintain(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.store.heartbeat, self.owner, self.heartbeat_ttl)
+                await asyncio.to_thread(self.recover_orphans)
+                if self._purged_at is None or time.monotonic() - self._purged_at >= PURGE_INTERVAL:
+                    await asyncio.to_thread(self.purge)
+            except sqlite3.Error as e:
+                logger.error("Queued payment recovery failed: %s", e, extra={"event": "payment_queue.recovery_failed"})
+            await asyncio.sleep(self.heartbeat_ttl / 3)
+
+    def purge(self):
+        """删除超过保留时间的已完成支付与已结束回调，避免表无限增长、统计查询逐渐变慢"""
+        queue, callbacks = self.store.purge(time.time() - self.retention)
+        self._purged_at = time.monotonic()
+        if queue or callbacks:
+            logger.info("Purged %d finished queued payments and %d callbacks", queue, callbacks,
+                        extra={"event": "payment_queue.purged"})
+        return queue, callbacks
+
+    async def start(self):
+        # 先记录心跳再受理支付，其他进程不会把本进程刚受理的支付当作遗留
+        await asyncio.to_thread(self.store.heartbeat, self.owner, self.heartbeat_ttl)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # 尚未处理的支付留在存储中，心跳过期后由其他进程或重启后的本进程恢复
+        await asyncio.to_thread(self.store.remove_owner, self.owner)
+
+    def stats(self):
+        return dict(self.store.counts(), depth=self.depth, max_depth=self.max_depth, processing=self.processing,
+                    workers=self.workers)
@@ -0,0 +1,317 @@
+# 客户端限流与重试调度 - 按账户与接口类别的令牌桶、优先级通道、抖动指数退避与熔断
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+import stripe
+
+from backend.state import MemoryStateBackend
+
+# 接口类别，数值越小优先级越高：结账优先于退款，退款优先于列表与详情查询
+KIND_CREATE = "create"
+KIND_REFUND = "refund"
+KIND_LIST = "list"
+KIND_READ = "read"
+PRIORITIES = {KIND_CREATE: 0, KIND_REFUND: 1, KIND_LIST: 2, KIND_READ: 3}
+
+# 各类别的默认每秒请求数；账户级总预算默认与 Stripe 线上账户的 100 次/秒一致
+DEFAULT_RATES = {KIND_CREATE: 50.0, KIND_REFUND: 25.0, KIND_LIST: 10.0, KIND_READ: 40.0}
+DEFAULT_ACCOUNT_RATE = 100.0
+
+
+class CircuitOpenError(stripe.error.APIConnectionError):
+    """熔断器打开期间直接失败，不再请求 Stripe；继承 StripeError 以沿用各接口现有的错误处理"""
+
+
+class PriorityTokenBucket:
+    """
+    支持优先级排队的异步令牌桶。
+
+    令牌不足时请求按 (优先级, 到达顺序) 排队，令牌补充后总是先唤醒优先级最高的等待者。
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority=0):
+        """取得一个令牌，返回排队等待的秒数"""
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._schedule(loop)
+        start = time.monotonic()
+        await future
+        return time.monotonic() - start
+
+    def _schedule(self, loop):
+        if self._timer is None and self._waiters:
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            self._timer = loop.call_later(delay, self._wake, loop)
+
+    def _wake(self, loop):
+        self._timer = None
+        self._refill()
+        self._grant()
+        self._schedule(loop)
+
+    def _grant(self):
+        """按优先级把本地令牌分给等待者"""
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        # 丢弃已取消的等待者，避免为它们继续计时
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+    @property
+    def queue_depth(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+
+class SharedTokenBucket(PriorityTokenBucket):
+    """
+    令牌存放在共享状态后端的令牌桶：多个 worker 进程共同遵守同一个速率，进程内仍按优先级排队。
+
+    本地只按当前等待者的数量从共享桶中取令牌，不囤积，其余令牌留给其他进程。
+    访问状态后端（SQLite 事务，可能等待其他进程的写锁）在线程中进行，不阻塞事件循环；
+    同一时间只有一个取令牌的任务，一次为全部等待者取令牌，并发请求不会各自占用一次写锁。
+    """
+
+    def __init__(self, state, key, rate, burst=None):
+        super().__init__(rate, burst)
+        self.state = state
+        self.key = key
+        self._tokens = 0.0
+
+    def _refill(self):
+        # 令牌只由 _take 在线程中取得
+        pass
+
+    def _schedule(self, loop):
+        if self._timer is None and self._waiters:
+            self._timer = loop.create_task(self._take())
+
+    async def _take(self):
+        """为等待者从共享桶取令牌；共享桶暂时不足时按速率间隔再取"""
+        try:
+            while self.queue_depth:
+                wanted = self.queue_depth - int(self._tokens)
+                if wanted > 0:
+                    self._tokens += await asyncio.to_thread(self.state.take, self.key, self.rate, self.capacity,
+                                                            wanted)
+                self._grant()
+                if self.queue_depth:
+                    await asyncio.sleep(min(0.1, max(1.0, self.queue_depth - self._tokens) / self.rate))
+        except Exception as e:
+            # 状态后端不可用：让等待者的 acquire 抛出原异常，而不是一直等待
+            for _, _, future in self._waiters:
+                if not future.done():
+                    future.set_exception(e)
+            self._waiters.clear()
+        finally:
+            self._timer = None
+
+
+class CircuitBreaker:
+    """
+    连续失败达到阈值后打开，冷却期内直接失败；冷却结束后进入半开状态，
+    只放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        # 探测请求被取消时不会回报结果，超过冷却时间后允许再发一个探测
+        if self.state == self.HALF_OPEN and (not self._probe_in_flight
+                                             or time.monotonic() - self._probe_started >= self.cooldown):
+            self._probe_in_flight = True
+            self._probe_started = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.opens += 1
+            self._probe_in_flight = False
+
+
+def is_retryable(error):
+    """429、5xx 与可重试的网络错误可以重试；卡被拒、参数错误、幂等冲突等不重试"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, stripe.error.RateLimitError):
+        return True
+    if isinstance(error, stripe.error.APIConnectionError):
+        return getattr(error, "should_retry", False)
+    headers = getattr(error, "headers", None) or {}
+    # Stripe 会在响应头中明确给出是否值得重试（例如同一幂等键的并发请求返回 409 且可重试）
+    if headers.get("Stripe-Should-Retry") in ("true", "false"):
+        return headers["Stripe-Should-Retry"] == "true"
+    status = getattr(error, "http_status", None)
+    return isinstance(error, stripe.error.APIError) or (status is not None and status >= 500)
+
+
+def _counts_as_outage(error):
+    # 限流说明 Stripe 正常工作，只计入熔断的应是 5xx 与网络故障
+    return not isinstance(error, stripe.error.RateLimitError)
+
+
+class StripeRateLimiter:
+    """
+    网关共享的限流与重试调度器，按 (连接账户, 接口类别) 维护令牌桶，
+    并为每个账户维护一个带优先级通道的总预算与熔断器。
+
+    - **rates**: {类别: 每秒请求数}，默认读取 STRIPE_RATE_<CREATE|REFUND|LIST|READ>
+    - **account_rate**: 单个账户的总预算，默认读取 STRIPE_RATE_ACCOUNT
+    - **max_retries** / **backoff_base** / **backoff_cap**: 全抖动指数退避参数
+    - **state**: 状态后端；为共享后端时令牌桶由所有 worker 进程共享，速率即整个部署的总速率
+    - **namespace**: 共享令牌桶键的前缀，使用同一连接账户的多个调度器（如各商户各自的调度器）互不占用预算
+    """
+
+    def __init__(self, rates=None, account_rate=None, max_retries=None, backoff_base=None, backoff_cap=None,
+                 failure_threshold=None, cooldown=None, state=None, namespace=None):
+        self.rates = {kind: float(os.getenv(f"STRIPE_RATE_{kind.upper()}", rate)) for kind, rate in DEFAULT_RATES.items()}
+        self.rates.update(rates or {})
+        self.account_rate = account_rate or float(os.getenv("STRIPE_RATE_ACCOUNT", DEFAULT_ACCOUNT_RATE))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("STRIPE_MAX_RETRIES", "3"))
+        self.backoff_base = backoff_base or float(os.getenv("STRIPE_BACKOFF_BASE", "0.25"))
+        self.backoff_cap = backoff_cap or float(os.getenv("STRIPE_BACKOFF_CAP", "4"))
+        self.failure_threshold = failure_threshold or int(os.getenv("STRIPE_BREAKER_THRESHOLD", "5"))
+        self.cooldown = cooldown or float(os.getenv("STRIPE_BREAKER_COOLDOWN", "30"))
+        self.state = state or MemoryStateBackend()
+        self.namespace = namespace
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    @classmethod
+    def unlimited(cls):
+        """不限速、不重试的调度器，用于只关心网关本身吞吐量的场景"""
+        return cls(rates=dict.fromkeys(DEFAULT_RATES, 1e9), account_rate=1e9, max_retries=0)
+
+    def _bucket(self, account, kind):
+        key = (account, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = self.account_rate if kind is None else self.rates[kind]
+            if self.state.shared:
+                prefix = f"ratelimit:{self.namespace}:" if self.namespace else "ratelimit:"
+                bucket = SharedTokenBucket(self.state, f"{prefix}{account or '-'}:{kind or 'account'}", rate)
+            else:
+                bucket = PriorityTokenBucket(rate)
+            self._buckets[key] = bucket
+        return bucket
+
+    def breaker(self, account):
+        breaker = self._breakers.get(account)
+        if breaker is None:
+            breaker = self._breakers[account] = CircuitBreaker(self.failure_threshold, self.cooldown)
+        return breaker
+
+    def _count(self, kind, name, value=1):
+        with self._lock:
+            metrics = self._metrics.setdefault(kind, {"calls": 0, "retries": 0, "throttled": 0, "failures": 0,
+                                                      "rejected_open_circuit": 0, "wait_seconds": 0.0})
+            metrics[name] += value
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    async def run(self, account, kind, call, idempotent):
+        """
+        在限流、重试与熔断保护下执行 call()（返回可等待对象的零参函数）。
+
+        - **idempotent**: 请求可以安全重发（读请求或带幂等键的写请求）；
+          非幂等请求只在 429（Stripe 未执行该请求）时重试
+        """
+        breaker = self.breaker(account)
+        priority = PRIORITIES[kind]
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self._count(kind, "rejected_open_circuit")
+                raise CircuitOpenError(f"Stripe circuit open for account {account or '-'}, failing fast")
+            waited = await self._bucket(account, kind).acquire(priority)
+            waited += await self._bucket(account, None).acquire(priority)
+            self._count(kind, "calls")
+            self._count(kind, "wait_seconds", waited)
+            try:
+                result = await call()
+            except stripe.error.StripeError as e:
+                if isinstance(e, stripe.error.RateLimitError):
+                    self._count(kind, "throttled")
+                retryable = is_retryable(e) and (idempotent or isinstance(e, stripe.error.RateLimitError))
+                if is_retryable(e) and _counts_as_outage(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if not retryable or attempt >= self.max_retries:
+                    self._count(kind, "failures")
+                    raise
+                self._count(kind, "retries")
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            metrics = {kind: dict(values, wait_seconds=round(values["wait_seconds"], 3))
+                       for kind, values in self._metrics.items()}
+        return {
+            "rates": self.rates,
+            "account_rate": self.account_rate,
+            "endpoints": metrics,
+            "queue_depth": {f"{account or '-'}:{kind or 'account'}": bucket.queue_depth
+                            for (account, kind), bucket in list(self._buckets.items())},
+            "circuits": {account or "-": {"state": breaker.state, "opens": breaker.opens}
+                         for account, breaker in list(self._breakers.items())},
+        }
@@ -0,0 +1,299 @@
+# 对账 - 批量拉取时间窗口内的 PaymentIntent 与 Refund，按 metadata 键建立哈希索引，与订单文件做列式关联
+import asyncio
+import csv
+import logging
+import os
+import time
+from array import array
+from operator import itemgetter
+
+from backend.exports import EXPORT_PAGE_SIZE, stripe_pages
+
+logger = logging.getLogger(__name__)
+
+# create_payment 写入 PaymentIntent metadata 的订单键，均可作为关联键
+MATCH_KEYS = ("external_request_order_id", "system_order_id", "merchant_order_id")
+# 计入已退款金额的退款状态
+REFUNDED_STATUSES = frozenset(("succeeded", "pending"))
+# 接口返回的每类差异明细条数上限，计数不受影响
+RECONCILE_MAX_ITEMS = int(os.getenv("STRIPE_RECONCILE_MAX_ITEMS", "1000"))
+# 上传的订单文件在内存中保留的最大字节数，超过后转存到临时文件
+RECONCILE_SPOOL_SIZE = int(os.getenv("STRIPE_RECONCILE_SPOOL_SIZE", str(8 * 1024 * 1024)))
+
+
+class StripeColumns:
+    """
+    窗口内 Stripe 数据的列式存储：已成功 PaymentIntent 的每个字段一列，金额用 array 紧凑存放；
+    退款按 payment_intent 汇总为已退款金额。
+
+    - **merchant_id**: 只保留该商户的 PaymentIntent
+    """
+
+    def __init__(self, merchant_id=None):
+        self.merchant_filter = merchant_id
+        self.intent_id = []
+        self.amount = array("q")
+        self.currency = []
+        self.merchant_id = []
+        self.keys = {key: [] for key in MATCH_KEYS}
+        # 未成功的 PaymentIntent 只记录状态，用于说明订单为何缺失
+        self.other_status = {key: {} for key in MATCH_KEYS}
+        self.refunded = {}
+        self.refund_count = 0
+
+    def __len__(self):
+        return len(self.intent_id)
+
+    def add_intents(self, intents):
+        keys = self.keys
+        for intent in intents:
+            metadata = intent.get("metadata") or {}
+            merchant_id = metadata.get("merchant_id")
+            if self.merchant_filter is not None and merchant_id != self.merchant_filter:
+                continue
+            if intent["status"] != "succeeded":
+                for key, statuses in self.other_status.items():
+                    value = metadata.get(key)
+                    if value is not None:
+                        statuses.setdefault((merchant_id, value), intent["status"])
+                continue
+            self.intent_id.append(intent["id"])
+            received = intent.get("amount_received")
+            self.amount.append(received if received is not None else intent["amount"])
+            self.currency.append(intent["currency"])
+            self.merchant_id.append(merchant_id)
+            for key, column in keys.items():
+                column.append(metadata.get(key))
+
+    def add_refunds(self, refunds):
+        refunded = self.refunded
+        for refund in refunds:
+            self.refund_count += 1
+            if refund["status"] in REFUNDED_STATUSES:
+                intent = refund.get("payment_intent")
+                refunded[intent] = refunded.get(intent, 0) + refund["amount"]
+
+    def key_column(self, key, scoped):
+        """关联键列；scoped 时为 (merchant_id, 键值)"""
+        if scoped:
+            return list(zip(self.merchant_id, self.keys[key]))
+        return self.keys[key]
+
+
+async def pull(gateway, created_gte, created_lt, merchant_id=None, page_size=EXPORT_PAGE_SIZE):
+    """
+    并发翻页拉取窗口内的 PaymentIntent 与 Refund，逐页写入列式存储。
+    退款只限定下限：窗口内的支付可能在窗口结束后才退款。
+    """
+    columns = StripeColumns(merchant_id)
+
+    async def intents():
+        params = {"created": {"gte": created_gte, "lt": created_lt}}
+        async for page in stripe_pages(gateway.list_payment_intents, params, page_size=page_size):
+            columns.add_intents(page)
+
+    async def refunds():
+        async for page in stripe_pages(gateway.list_refunds, {"created": {"gte": created_gte}}, page_size=page_size):
+            columns.add_refunds(page)
+
+    await asyncio.gather(intents(), refunds())
+    return columns
+
+
+class OrderColumns:
+    """
+    订单文件的列式表示。CSV 需包含关联键列与 amount（最小货币单位），
+    可选 currency、refunded_amount（已退款金额）与 merchant_id（有此列时按 (merchant_id, 键) 关联）。
+    """
+
+    def __init__(self, keys, amount, currency=None, refunded=None, scoped=False, lines=None):
+        self.keys = keys
+        self.amount = amount
+        self.currency = currency
+        self.refunded = refunded
+        self.scoped = scoped
+        # 每行在文件中的行号（从 1 开始，表头为第 1 行），用于报告重复订单的位置
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def load_orders(lines, key):
+    """读取订单 CSV（可迭代的文本行），整体转置为列，不逐行构造字典"""
+    if key not in MATCH_KEYS:
+        raise ValueError(f"不支持的关联键: {key}，可选 {', '.join(MATCH_KEYS)}")
+    reader = csv.reader(lines)
+    header = [name.strip() for name in next(reader, [])]
+    missing = [name for name in (key, "amount") if name not in header]
+    if missing:
+        raise ValueError(f"订单文件缺少列: {', '.join(missing)}")
+    # 跳过空行，同时记下每行的物理行号（含空行与引号内换行）
+    rows, lines = [], array("q")
+    append_row, append_line = rows.append, lines.append
+    for row in reader:
+        if row:
+            append_row(row)
+            append_line(reader.line_num)
+    if len(set(map(len, rows)) - {len(header)}):
+        raise ValueError(f"订单文件每行必须有 {len(header)} 列")
+    # 按列取出（itemgetter 在 C 中完成），比 zip(*rows) 整体转置快得多
+    columns = {name: list(map(itemgetter(position), rows)) for position, name in enumerate(header)}
+    del rows
+
+    try:
+        amount = array("q", map(int, columns["amount"]))
+        refunded = None
+        if "refunded_amount" in columns:
+            refunded = array("q", (int(value) if value else 0 for value in columns["refunded_amount"]))
+    except ValueError:
+        raise ValueError("amount、refunded_amount 列必须为整数（最小货币单位）")
+    currency = list(map(str.lower, columns["currency"])) if "currency" in columns else None
+    scoped = "merchant_id" in columns
+    keys = list(zip(columns["merchant_id"], columns[key])) if scoped else list(columns[key])
+    return OrderColumns(keys, amount, currency, refunded, scoped, lines)
+
+
+def _index(keys):
+    """键 -> 首次出现的行号，以及重复键 -> 全部行号"""
+    index = {}
+    duplicates = {}
+    for row, value in enumerate(keys):
+        first = index.setdefault(value, row)
+        if first != row:
+            duplicates.setdefault(value, [first]).append(row)
+    return index, duplicates
+
+
+def _display(value, scoped):
+    return {"merchant_id": value[0], "key": value[1]} if scoped else {"key": value}
+
+
+def reconcile(orders, stripe_columns, key, max_items=RECONCILE_MAX_ITEMS):
+    """
+    以订单文件为左表、成功的 PaymentIntent 为右表做哈希关联，返回差异报告：
+
+    - **missing**: 订单在 Stripe 中没有成功的支付（stripe_status 为找到的未成功状态）
+    - **unexpected**: Stripe 中成功的支付不在订单文件中
+    - **duplicated**: 同一订单键在 Stripe 中有多笔成功支付（side=stripe），或在订单文件中出现多次（side=orders）
+    - **amount_mismatch**: 金额或币种不一致
+    - **refund_mismatch**: 订单文件的 refunded_amount 与 Stripe 已退款金额不一致（文件无此列时不检查）
+    """
+    start = time.perf_counter()
+    scoped = orders.scoped
+    stripe_keys = stripe_columns.key_column(key, scoped)
+    unkeyed = sum(1 for value in stripe_keys if (value[1] if scoped else value) is None)
+    stripe_index, stripe_duplicates = _index(stripe_keys)
+    order_index, order_duplicates = _index(orders.keys)
+    other_status = stripe_columns.other_status[key]
+    if not scoped:
+        other_status = {value: status for (_, value), status in other_status.items()}
+
+    report = {name: [] for name in ("missing", "unexpected", "duplicated", "amount_mismatch", "refund_mismatch")}
+    counts = dict.fromkeys(report, 0)
+
+    def add(name, item):
+        counts[name] += 1
+        if len(report[name]) < max_items:
+            report[name].append(item)
+
+    intent_id, stripe_amount, stripe_currency = stripe_columns.intent_id, stripe_columns.amount, stripe_columns.currency
+    refunded = stripe_columns.refunded
+    matched = 0
+    # 只遍历订单键的首次出现；重复行单独报告
+    for value, row in order_index.items():
+        i = stripe_index.get(value)
+        if i is None:
+            add("missing", {**_display(value, scoped), "amount": orders.amount[row],
+                            "stripe_status": other_status.get(value)})
+            continue
+        matched += 1
+        currency_differs = orders.currency is not None and orders.currency[row] != stripe_currency[i]
+        if orders.amount[row] != stripe_amount[i] or currency_differs:
+            add("amount_mismatch", {**_display(value, scoped), "payment_intent": intent_id[i],
+                                    "expected_amount": orders.amount[row], "stripe_amount": stripe_amount[i],
+                                    "expected_currency": orders.currency[row] if orders.currency else None,
+                                    "stripe_currency": stripe_currency[i]})
+        if orders.refunded is not None and orders.refunded[row] != refunded.get(intent_id[i], 0):
+            add("refund_mismatch", {**_display(value, scoped), "payment_intent": intent_id[i],
+                                    "expected_refunded": orders.refunded[row],
+                                    "stripe_refunded": refunded.get(intent_id[i], 0)})
+
+    for value in stripe_index.keys() - order_index.keys():
+        if (value[1] if scoped else value) is None:
+            continue
+        i = stripe_index[value]
+        add("unexpected", {**_display(value, scoped), "payment_intent": intent_id[i], "amount": stripe_amount[i]})
+    for value, rows in stripe_duplicates.items():
+        if (value[1] if scoped else value) is not None:
+            add("duplicated", {**_display(value, scoped), "side": "stripe",
+                               "payment_intents": [intent_id[i] for i in rows]})
+    for value, rows in order_duplicates.items():
+        add("duplicated", {**_display(value, scoped), "side": "orders",
+                           "rows": [orders.lines[row] if orders.lines is not None else row + 2 for row in rows]})
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "key": key,
+        "orders": len(orders),
+        "stripe_payments": len(stripe_columns),
+        "stripe_refunds": stripe_columns.refund_count,
+        "stripe_unkeyed": unkeyed,
+        "matched": matched,
+        **counts,
+        "elapsed": round(elapsed, 3),
+    }
+    logger.info("Reconciled %d orders against %d payments in %.2fs", len(orders), len(stripe_columns), elapsed,
+                extra={"event": "reconciliation.finished"})
+    return {"summary": summary, **report}
+
+
+async def run(gateway, order_lines, key, created_gte, created_lt, merchant_id=None, max_items=RECONCILE_MAX_ITEMS):
+    """
+    解析订单文件（先于网络请求，格式错误立即返回）后拉取 Stripe 数据并关联。
+    解析与关联是大量行的纯 CPU 操作，在线程中进行，不阻塞事件循环。
+    """
+    orders = await asyncio.to_thread(load_orders, order_lines, key)
+    stripe_columns = await pull(gateway, created_gte, created_lt, merchant_id)
+    return await asyncio.to_thread(reconcile, orders, stripe_columns, key, max_items)
+
+
+def _reconcile_file(args):
+    """命令行对账：读取本地订单 CSV，拉取窗口内的 Stripe 数据，输出 JSON 报告"""
+    import json
+
+    import stripe
+    from dotenv import load_dotenv
+
+    from backend.gateway import StripeGateway
+
+    load_dotenv()
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    gateway = StripeGateway(account=os.getenv("STRIPE_ACCOUNT_ID"))
+    try:
+        with open(args.file, encoding="utf-8-sig", newline="") as f:
+            report = asyncio.run(run(gateway, f, args.key, args.created_gte, args.created_lt,
+                                     args.merchant_id, args.max_items))
+    finally:
+        gateway.close()
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(json.dumps(report["summary"], ensure_ascii=False))
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="订单文件与 Stripe 支付、退款对账")
+    parser.add_argument("file", help="订单 CSV：关联键列、amount，可选 currency、refunded_amount、merchant_id")
+    parser.add_argument("--created-gte", type=int, required=True, help="窗口起点（含），Unix 时间戳")
+    parser.add_argument("--created-lt", type=int, required=True, help="窗口终点（不含），Unix 时间戳")
+    parser.add_argument("--key", default="external_request_order_id", choices=MATCH_KEYS)
+    parser.add_argument("--merchant-id", help="只对账该商户的支付")
+    parser.add_argument("--max-items", type=int, default=RECONCILE_MAX_ITEMS, help="每类差异明细条数上限")
+    parser.add_argument("--output", help="报告写入该文件，标准输出只打印汇总")
+    _reconcile_file(parser.parse_args())
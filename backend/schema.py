@@ -1,75 +1,108 @@
 # 基础模型类 - 实现自动去除字符串前后空格功能
+import functools
+import os
+import time
 from datetime import datetime
-from typing import Optional, Literal, Dict, List, Any
+from typing import Optional, Literal, Dict, List, Any, Annotated
 
-from pydantic import BaseModel, Field, EmailStr, model_validator
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, EmailStr, StringConstraints, model_validator
+from pydantic.networks import validate_email
+
+
+def _strip(value):
+    return value.strip() if isinstance(value, str) else value
+
+
+def _not_blank(value):
+    # 与原先的必填校验一致：按原始值判断，因此 0 与 False 也视为空，而字符串 "0" 不是
+    if not value or not str(value).strip():
+        raise ValueError("不能为空或空字符串")
+    return _strip(value)
+
+
+def _not_empty(value):
+    if not value:
+        raise ValueError("不能为空")
+    return value
+
+
+# 字符串字段由 str_strip_whitespace 在 pydantic-core 中去空格；
+# 整数、布尔与枚举字段的核心校验器不接受带空格的字符串，需要先去空格
+TrimmedInt = Annotated[int, BeforeValidator(_strip)]
+TrimmedBool = Annotated[bool, BeforeValidator(_strip)]
+RequiredInt = Annotated[int, BeforeValidator(_not_blank)]
+# 元数据原样透传给 Stripe，不去空格
+RawStr = Annotated[str, StringConstraints(strip_whitespace=False)]
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_email(value):
+    return validate_email(value)[1]
+
+
+class CachedEmailStr(EmailStr):
+    """与 EmailStr 的校验和规范化完全相同，只是按输入缓存结果；email-validator 的 IDNA 检查占了校验耗时的大头"""
+
+    @classmethod
+    def _validate(cls, value):
+        return _normalize_email(value)
 
 
 class BaseModelWithTrim(BaseModel):
-    @model_validator(mode="before")
-    def trim_strings(cls, values):
-        for key, value in values.items():
-            if isinstance(value, str):
-                values[key] = value.strip()
-        return values
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+
+# 到期校验只需比较到月份，缓存当前年月直到下个月月初
+_current_month = (0.0, 0, 0)
+
+
+def _current_year_month():
+    global _current_month
+    until, year, month = _current_month
+    if time.time() >= until:
+        now = datetime.now()
+        next_month = datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+        _current_month = until, year, month = next_month.timestamp(), now.year, now.month
+    return year, month
 
 
 class DeviceInfoSchema(BaseModelWithTrim):
-    color_depth: Optional[int] = Field(None, description="用户浏览器的色彩深度")
-    screen_height: Optional[int] = Field(None, description="用户设备的屏幕高度")
-    screen_width: Optional[int] = Field(None, description="用户设备的屏幕宽度")
-    time_zone_offset: Optional[int] = Field(None, description="UTC 时间与用户浏览器本地时间的时差")
+    color_depth: Optional[TrimmedInt] = Field(None, description="用户浏览器的色彩深度")
+    screen_height: Optional[TrimmedInt] = Field(None, description="用户设备的屏幕高度")
+    screen_width: Optional[TrimmedInt] = Field(None, description="用户设备的屏幕宽度")
+    time_zone_offset: Optional[TrimmedInt] = Field(None, description="UTC 时间与用户浏览器本地时间的时差")
     device_token_id: Optional[str] = Field(None, max_length=256, description="设备的令牌标识")
     device_language: Optional[str] = Field(None, max_length=32, description="用户下单设备的语言")
 
 
 class BrowserInfoSchema(BaseModelWithTrim):
-    user_agent: str = Field(..., max_length=2048, description="用户的浏览器用户代理")
+    user_agent: str = Field(..., min_length=1, max_length=2048, description="用户的浏览器用户代理")
     accept_header: Optional[str] = Field(None, max_length=2048, description="用户浏览器的请求头信息")
-    java_enabled: Optional[bool] = Field(False, description="用户浏览器是否支持运行 Java")
-    java_script_enabled: Optional[bool] = Field(False, description="用户浏览器是否支持运行 JavaScript")
+    java_enabled: Optional[TrimmedBool] = Field(False, description="用户浏览器是否支持运行 Java")
+    java_script_enabled: Optional[TrimmedBool] = Field(False, description="用户浏览器是否支持运行 JavaScript")
     language: Optional[str] = Field(None, max_length=32, description="用户浏览器的语言")
 
-    @model_validator(mode="before")
-    def validate_required_fields(cls, values):
-        required_fields = ["user_agent"]
-        for field in required_fields:
-            if not values.get(field) or not str(values[field]).strip():
-                raise ValueError(f"{field} 不能为空或空字符串")
-        return values
-
 
 class EnvSchema(BaseModelWithTrim):
-    terminal_type: Literal["WEB", "MOBILE", "APP", "MINI_APP"] = Field(..., description="商户服务适用的终端类型")
-    client_ip: str = Field(..., max_length=45, description="客户 IP 地址（支持 IPv4 和 IPv6）")
+    terminal_type: Annotated[Literal["WEB", "MOBILE", "APP", "MINI_APP"], BeforeValidator(_strip)] = Field(
+        ..., description="商户服务适用的终端类型")
+    # 只拒绝原始值为空串的情况，纯空格去除后保留为空串，与原先的必填校验一致
+    client_ip: Annotated[str, BeforeValidator(_not_empty)] = Field(
+        ..., max_length=45, description="客户 IP 地址（支持 IPv4 和 IPv6）")
     browser_info: BrowserInfoSchema = Field(..., description="浏览器环境信息")
     device_info: Optional[DeviceInfoSchema] = Field(None, description="设备信息，包括屏幕分辨率、语言等")
 
-    @model_validator(mode="before")
-    def validate_required_fields(cls, values):
-        if not values.get("terminal_type") or not values.get("client_ip"):
-            raise ValueError("terminal_type 和 client_ip 为必填字段")
-        return values
-
 
 class GoodsSchema(BaseModelWithTrim):
-    goods_id: str = Field(..., max_length=64, description="商品唯一标识")
-    goods_name: str = Field(..., max_length=256, description="商品名称")
-    goods_category: str = Field(..., max_length=64, description="商品分类")
-    goods_quantity: int = Field(..., description="商品数量")
-    goods_url: str = Field(..., max_length=2048, description="商品链接")
+    goods_id: str = Field(..., min_length=1, max_length=64, description="商品唯一标识")
+    goods_name: str = Field(..., min_length=1, max_length=256, description="商品名称")
+    goods_category: str = Field(..., min_length=1, max_length=64, description="商品分类")
+    goods_quantity: RequiredInt = Field(..., description="商品数量")
+    goods_url: str = Field(..., min_length=1, max_length=2048, description="商品链接")
     goods_img_url: Optional[str] = Field(None, max_length=2048, description="商品图片链接")
-    goods_price: int = Field(..., description="商品单价，最小货币单位")
-    delivery_method_type: Literal['PHYSICAL', 'DIGITAL'] = Field(..., description="商品的配送方式")
-
-    @model_validator(mode="before")
-    def validate_required_fields(cls, values):
-        required_fields = ["goods_id", "goods_name", "goods_category", "goods_url", "delivery_method_type",
-                           "goods_price", "goods_quantity"]
-        for field in required_fields:
-            if not values.get(field) or not str(values[field]).strip():
-                raise ValueError(f"{field} 不能为空或空字符串")
-        return values
+    goods_price: RequiredInt = Field(..., description="商品单价，最小货币单位")
+    delivery_method_type: Annotated[Literal['PHYSICAL', 'DIGITAL'], BeforeValidator(_strip)] = Field(
+        ..., description="商品的配送方式")
 
 
 class ShippingAddressSchema(BaseModelWithTrim):
@@ -90,7 +123,7 @@ class ShippingNameSchema(BaseModelWithTrim):
 class ShippingSchema(BaseModelWithTrim):
     shipping_name: ShippingNameSchema
     shipping_address: ShippingAddressSchema
-    email: EmailStr = Field(..., max_length=64, description="客户电子邮件")
+    email: CachedEmailStr = Field(..., max_length=64, description="客户电子邮件")
     phone: str = Field(..., max_length=25, description="客户手机号")
     carrier: Optional[str] = Field(None, max_length=50, description="物流服务提供商")
 
@@ -100,7 +133,7 @@ class PaymentDataSchema(BaseModelWithTrim):
     expiry_year: str = Field(..., max_length=2, description="银行卡的到期年份 (两位数字，如 '24')", pattern=r"^\d{2}$")
     expiry_month: str = Field(..., max_length=2, description="银行卡的过期月份 (01-12)", pattern=r"^(0[1-9]|1[0-2])$")
     cvv: str = Field(..., min_length=3, max_length=4, description="银行卡的 CVV 码（3-4 位）", pattern=r"^\d{3,4}$")
-    requires_3ds: Optional[bool] = Field(None, description="是否需要 3DS 验证")
+    requires_3ds: Optional[TrimmedBool] = Field(None, description="是否需要 3DS 验证")
     country: str = Field(..., max_length=2, description="订单国家")
     card_holder_name: ShippingNameSchema
     billing_address: ShippingAddressSchema
@@ -111,8 +144,7 @@ class PaymentDataSchema(BaseModelWithTrim):
             try:
                 expiry_year = int("20" + values["expiry_year"])
                 expiry_month = int(values["expiry_month"])
-                now = datetime.now()
-                if expiry_year < now.year or (expiry_year == now.year and expiry_month < now.month):
+                if (expiry_year, expiry_month) < _current_year_month():
                     raise ValueError("银行卡已过期！")
             except ValueError:
                 raise ValueError("无效的到期年月！")
@@ -126,7 +158,7 @@ class PaymentMethodSchema(BaseModelWithTrim):
 
 class PaymentAmountSchema(BaseModelWithTrim):
     currency: str = Field(..., max_length=3, description="币种代码")
-    value: int = Field(..., description="金额值，最小货币单位")
+    value: TrimmedInt = Field(..., description="金额值，最小货币单位")
 
 
 class OrderSchema(BaseModelWithTrim):
@@ -135,7 +167,7 @@ class OrderSchema(BaseModelWithTrim):
     shipping: ShippingSchema
     payment_amount: PaymentAmountSchema
     payment_method: PaymentMethodSchema
-    metadata: Optional[Dict[str, str]] = Field(None, description="键值对形式的元数据")
+    metadata: Optional[Dict[RawStr, RawStr]] = Field(None, description="键值对形式的元数据")
 
 
 class PaymentRequestSchema(BaseModelWithTrim):
@@ -156,10 +188,50 @@ class ChannelPaymentResponseSchema(BaseModel):
     detail: Optional[Dict[str, str]] = Field(None, description="包含详细错误信息的字典（如错误码、错误消息）")
 
 
+# 批量创建支付
+BATCH_MAX_ITEMS = int(os.getenv("STRIPE_BATCH_MAX_ITEMS", "500"))
+
+
+class BatchPaymentRequestSchema(BaseModel):
+    items: List[PaymentRequestSchema] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS,
+                                              description=f"支付请求列表，单批最多 {BATCH_MAX_ITEMS} 笔")
+
+
+class BatchPaymentResponseSchema(BaseModel):
+    results: List[ChannelPaymentResponseSchema] = Field(..., description="与请求顺序一一对应的支付结果")
+
+
+# 异步创建支付（Prefer: respond-async）
+class PaymentAcceptedSchema(BaseModel):
+    queue_id: str = Field(..., description="队列 ID，用于查询处理结果")
+    system_order_id: Optional[str] = Field(None, description="系统订单 ID")
+    status: str = Field("queued", description="受理状态：queued、processing、done")
+
+
+class PaymentCallbackStatusSchema(BaseModel):
+    status: str = Field(..., description="回调状态：pending、delivered、dead")
+    attempts: int = Field(0, description="已投递次数")
+    last_error: Optional[str] = Field(None, description="最近一次投递失败的原因")
+    delivered_at: Optional[float] = Field(None, description="投递成功时间戳")
+
+
+class PaymentQueueStatusSchema(BaseModel):
+    queue_id: str = Field(..., description="队列 ID")
+    merchant_id: Optional[str] = Field(None, description="商户 ID")
+    system_order_id: Optional[str] = Field(None, description="系统订单 ID")
+    external_request_order_id: Optional[str] = Field(None, description="外部请求订单 ID")
+    status: str = Field(..., description="处理状态：queued、processing、done")
+    result: Optional[ChannelPaymentResponseSchema] = Field(None, description="处理完成后的支付结果")
+    callback: Optional[PaymentCallbackStatusSchema] = Field(None, description="回调投递状态，未配置回调地址时为空")
+    enqueued_at: float = Field(..., description="受理时间戳")
+    started_at: Optional[float] = Field(None, description="开始处理时间戳")
+    finished_at: Optional[float] = Field(None, description="处理完成时间戳")
+
+
 # 退款相关 Schema
 class RefundRequestSchema(BaseModelWithTrim):
     channel_order_id: str = Field(..., description="PaymentIntent ID")
-    refund_amount: Optional[int] = Field(None, description="退款金额（单位：分），为空则全额退款")
+    refund_amount: Optional[TrimmedInt] = Field(None, description="退款金额（单位：分），为空则全额退款")
     system_order_id: str = Field(..., description="系统订单 ID")
     external_refund_id: str = Field(..., description="外部退款 ID，用于幂等性")
     refund_request_id: str = Field(..., description="退款请求 ID")
@@ -171,6 +243,52 @@ class RefundResponseSchema(BaseModel):
     detail: Optional[Dict[str, str]] = Field(None, description="错误详情")
 
 
+# 批量退款作业
+class RefundJobRequestSchema(BaseModel):
+    items: List[RefundRequestSchema] = Field(..., min_length=1, description="退款请求列表")
+
+
+class JobStatusSchema(BaseModel):
+    job_id: str = Field(..., description="作业 ID")
+    kind: str = Field(..., description="作业类型")
+    status: str = Field(..., description="作业状态：pending、running、completed")
+    total: int = Field(..., description="作业项总数")
+    completed: int = Field(..., description="已完成的项数")
+    pending: int = Field(..., description="未完成的项数")
+    outcomes: Dict[str, int] = Field(default_factory=dict, description="已完成项按结果状态计数")
+    created_at: float = Field(..., description="创建时间戳")
+    updated_at: float = Field(..., description="最后更新时间戳")
+
+
+# 预授权扣款与撤销
+class CaptureRequestSchema(BaseModelWithTrim):
+    channel_order_id: str = Field(..., description="PaymentIntent ID（状态为 requires_capture）")
+    amount_to_capture: Optional[TrimmedInt] = Field(
+        None, description="扣款金额（单位：分），为空则按授权金额全额扣款；部分扣款后剩余授权自动释放")
+
+
+class CaptureResponseSchema(BaseModel):
+    channel_order_id: Optional[str] = Field(None, description="PaymentIntent ID")
+    status: str = Field(..., description="扣款后的 PaymentIntent 状态（通常为 succeeded），失败时为 failed")
+    amount_captured: Optional[int] = Field(None, description="实际扣款金额")
+    detail: Optional[Dict[str, str]] = Field(None, description="错误详情")
+
+
+class CancelRequestSchema(BaseModelWithTrim):
+    channel_order_id: str = Field(..., description="PaymentIntent ID")
+    cancellation_reason: Optional[Literal["duplicate", "fraudulent", "requested_by_customer", "abandoned"]] = Field(
+        None, description="撤销原因")
+
+
+# 批量扣款 / 撤销作业
+class CaptureJobRequestSchema(BaseModel):
+    items: List[CaptureRequestSchema] = Field(..., min_length=1, description="扣款请求列表")
+
+
+class CancelJobRequestSchema(BaseModel):
+    items: List[CancelRequestSchema] = Field(..., min_length=1, description="撤销请求列表")
+
+
 # 查询支付详情的响应 Schema
 class PaymentDetailsResponseSchema(BaseModel):
     channel_order_id: str = Field(..., description="PaymentIntent ID")
@@ -184,12 +302,66 @@ class PaymentDetailsResponseSchema(BaseModel):
     refunds: list = Field(..., description="退款记录")
 
 
+# 精简支付详情（fields= 稀疏字段集）
+class ChargeSummarySchema(BaseModel):
+    id: str = Field(..., description="Charge ID")
+    amount: int = Field(..., description="扣款金额")
+    amount_refunded: int = Field(0, description="已退款金额")
+    currency: str = Field(..., description="货币")
+    status: str = Field(..., description="扣款状态")
+    paid: bool = Field(False, description="是否已支付")
+    refunded: bool = Field(False, description="是否已全额退款")
+    created: int = Field(..., description="创建时间戳")
+    failure_code: Optional[str] = Field(None, description="失败码")
+    failure_message: Optional[str] = Field(None, description="失败原因")
+    card_brand: Optional[str] = Field(None, description="卡品牌")
+    card_last4: Optional[str] = Field(None, description="卡号后四位")
+
+
+class RefundSummarySchema(BaseModel):
+    id: str = Field(..., description="退款 ID")
+    charge: Optional[str] = Field(None, description="所属 Charge ID")
+    amount: int = Field(..., description="退款金额")
+    currency: str = Field(..., description="货币")
+    status: Optional[str] = Field(None, description="退款状态")
+    reason: Optional[str] = Field(None, description="退款原因")
+    created: int = Field(..., description="创建时间戳")
+    metadata: Dict[str, str] = Field(default_factory=dict, description="退款元数据")
+
+
+class PaymentMethodSummarySchema(BaseModel):
+    id: str = Field(..., description="PaymentMethod ID")
+    type: Optional[str] = Field(None, description="支付方式类型")
+    card_brand: Optional[str] = Field(None, description="卡品牌")
+    card_last4: Optional[str] = Field(None, description="卡号后四位")
+    card_exp_month: Optional[int] = Field(None, description="到期月份")
+    card_exp_year: Optional[int] = Field(None, description="到期年份")
+    billing_name: Optional[str] = Field(None, description="持卡人姓名")
+
+
+class PaymentDetailsSummarySchema(BaseModel):
+    """只包含 fields= 所选字段的支付详情；charges、refunds 与 payment_method 为精简摘要"""
+    channel_order_id: str = Field(..., description="PaymentIntent ID")
+    status: Optional[str] = Field(None, description="支付状态")
+    amount: Optional[int] = Field(None, description="支付金额")
+    currency: Optional[str] = Field(None, description="货币")
+    metadata: Optional[Dict[str, str]] = Field(None, description="支付元数据")
+    payment_method: Optional[PaymentMethodSummarySchema] = Field(None, description="支付方式摘要")
+    created: Optional[int] = Field(None, description="创建时间戳")
+    charges: Optional[List[ChargeSummarySchema]] = Field(None, description="扣款摘要")
+    refunds: Optional[List[RefundSummarySchema]] = Field(None, description="退款摘要")
+
+
 # 状态和错误映射
 class GatewayPaymentStatus:
     SUCCESS = "success"
     PENDING = "pending"
+    # 仅授权（手动扣款模式），待 /capture-payment 或扣款作业扣款
+    AUTHORIZED = "authorized"
     FAILED = "failed"
 
 
 class CardPaymentsResponseSchema(BaseModel):
     payments: list[dict] = Field(..., description="与此卡关联的所有支付订单")
+    has_more: bool = Field(False, description="是否还有更多记录")
+    next_cursor: Optional[str] = Field(None, description="下一页游标，作为 starting_after 传入")
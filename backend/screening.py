@@ -0,0 +1,385 @@
+# 支付前置风控 - 调用 Stripe 之前按 IP、设备、邮箱、卡 BIN 的滑动窗口频次与去重计数拦截盗刷试卡（固定内存的概率计数）
+import json
+import logging
+import math
+import os
+import time
+from array import array
+
+from backend.metrics import counters
+
+logger = logging.getLogger(__name__)
+
+# 规则可使用的维度
+KEY_IP = "ip"
+KEY_DEVICE = "device"
+KEY_EMAIL = "email"
+KEY_BIN = "bin"
+KEY_CARD = "card"
+KEYS = {KEY_IP, KEY_DEVICE, KEY_EMAIL, KEY_BIN, KEY_CARD}
+
+COUNT_ATTEMPTS = "attempts"
+COUNT_DECLINES = "declines"
+ACTION_BLOCK = "block"
+ACTION_FLAG = "flag"
+
+_RULE_FIELDS = {"name", "key", "distinct", "window", "limit", "count", "action", "capacity"}
+
+# 默认规则：单个 IP / 设备的请求频次、单个 IP / 设备 / 邮箱使用的不同卡数、单个 BIN 的拒付数。
+# 去重规则的 capacity 按窗口长度给出：一小时 10 万（单个 worker 持续约 28 笔/秒）、一天 50 万（约 6 笔/秒），
+# 默认规则的计数结构合计约 35MB / worker；流量更大时用规则文件调大（见 /screening/stats 的 distinct_fill）
+DEFAULT_RULES = [
+    {"name": "ip_velocity", "key": KEY_IP, "window": 60, "limit": 30},
+    {"name": "device_velocity", "key": KEY_DEVICE, "window": 60, "limit": 20},
+    {"name": "ip_cards", "key": KEY_IP, "distinct": KEY_CARD, "window": 3600, "limit": 8, "capacity": 100_000},
+    {"name": "device_cards", "key": KEY_DEVICE, "distinct": KEY_CARD, "window": 3600, "limit": 5, "capacity": 100_000},
+    {"name": "email_cards", "key": KEY_EMAIL, "distinct": KEY_CARD, "window": 86400, "limit": 5, "capacity": 500_000},
+    {"name": "bin_declines", "key": KEY_BIN, "count": COUNT_DECLINES, "window": 600, "limit": 50},
+]
+
+
+def _parse_rules(raw):
+    """校验并规整规则列表；无效时抛出 ValueError"""
+    if not isinstance(raw, list):
+        raise ValueError("screening rules must be a list")
+    rules, names = [], set()
+    for rule in raw:
+        if not isinstance(rule, dict):
+            raise ValueError("screening rule must be an object")
+        unknown = set(rule) - _RULE_FIELDS
+        if unknown:
+            raise ValueError(f"rule {rule.get('name')}: unknown fields {sorted(unknown)}")
+        name = rule.get("name")
+        if not name or name in names:
+            raise ValueError(f"rule {name}: name is missing or duplicated")
+        names.add(name)
+        if "window" not in rule or "limit" not in rule:
+            raise ValueError(f"rule {name}: window and limit are required")
+        if rule.get("key") not in KEYS or (rule.get("distinct") or KEY_CARD) not in KEYS:
+            raise ValueError(f"rule {name}: key and distinct must be one of {sorted(KEYS)}")
+        if rule.get("count", COUNT_ATTEMPTS) not in (COUNT_ATTEMPTS, COUNT_DECLINES):
+            raise ValueError(f"rule {name}: count must be {COUNT_ATTEMPTS} or {COUNT_DECLINES}")
+        if rule.get("action", ACTION_BLOCK) not in (ACTION_BLOCK, ACTION_FLAG):
+            raise ValueError(f"rule {name}: action must be {ACTION_BLOCK} or {ACTION_FLAG}")
+        if rule.get("capacity") is not None and (not rule.get("distinct") or int(rule["capacity"]) <= 0):
+            raise ValueError(f"rule {name}: capacity must be a positive number and requires distinct")
+        rules.append({
+            "name": name,
+            "key": rule["key"],
+            "distinct": rule.get("distinct"),
+            "window": float(rule["window"]),
+            "limit": int(rule["limit"]),
+            "count": rule.get("count", COUNT_ATTEMPTS),
+            "action": rule.get("action", ACTION_BLOCK),
+            "capacity": int(rule["capacity"]) if rule.get("capacity") is not None else None,
+        })
+    return rules
+
+
+class _BucketRing:
+    """
+    窗口时间片的轮转：buckets 个槽位覆盖窗口，另有一个刚滑出窗口的槽位，在之后的调用中每次清零 chunk 个单元，
+    把整片清零（约 1MB）的开销摊到多次请求上；估计时跳过该槽位。流量稀少、下一次轮转前未清完时在轮转时清完。
+    """
+
+    def __init__(self, window, buckets, cells, clear, clock, chunk=8192):
+        self.span = window / buckets
+        self.buckets = buckets
+        self.slots = buckets + 1
+        self.cells = cells
+        self.clock = clock
+        self.chunk = chunk
+        self._clear = clear
+        self._epochs = [None] * self.slots
+        self.epoch = None
+        # 已滑出窗口、尚未清零完的槽位
+        self.stale = None
+        self._cleared = 0
+
+    def advance(self):
+        """返回当前时间片的槽位"""
+        epoch = int(self.clock() / self.span)
+        if epoch != self.epoch:
+            self._rotate(epoch)
+        elif self.stale is not None:
+            end = min(self._cleared + self.chunk, self.cells)
+            self._clear(self.stale, self._cleared, end)
+            self._cleared = end
+            if end == self.cells:
+                self._epochs[self.stale] = None
+                self.stale = None
+        return epoch % self.slots
+
+    def _rotate(self, epoch):
+        if self.stale is not None:
+            self._clear(self.stale, self._cleared, self.cells)
+            self._epochs[self.stale] = None
+            self.stale = None
+        oldest = epoch - self.buckets + 1
+        spare = (epoch + 1) % self.slots
+        for slot, slot_epoch in enumerate(self._epochs):
+            if slot_epoch is not None and slot_epoch < oldest:
+                if slot == spare:
+                    self.stale, self._cleared = slot, 0
+                else:
+                    # 长时间没有请求，跳过了多个时间片
+                    self._clear(slot, 0, self.cells)
+                    self._epochs[slot] = None
+        self._epochs[epoch % self.slots] = epoch
+        self.epoch = epoch
+
+
+class SlidingCountMin:
+    """
+    滑动窗口内按键的近似计数：窗口切成 buckets 个时间片，每片一个 count-min sketch（depth 行 × width 列）。
+    同一计数器在各时间片的值连续存放，估计值为每行在窗口内各时间片之和的最小值，一次切片求和即可。
+    内存固定为 (buckets + 1) × depth × width 个 16 位计数器，与键的数量无关；单个时间片的计数在 65535 饱和，远高于任何限额。
+    只会高估，采用保守更新后误差通常远小于 e / width × 窗口内总计数：窗口内总计数远超 width 时，
+    正常键的估计值会被碰撞抬高，width 应与窗口内的计数量相称（见 SlidingDistinct 的 capacity）。
+    """
+
+    def __init__(self, window, buckets=6, width=65536, depth=4, clock=time.monotonic):
+        self.width = width
+        self.depth = depth
+        self.ring = _BucketRing(window, buckets, width * depth, self._clear, clock)
+        self._table = array("H", bytes(2 * width * depth * self.ring.slots))
+
+    def _clear(self, slot, start, end):
+        slots = self.ring.slots
+        self._table[start * slots + slot:end * slots + slot:slots] = array("H", bytes(2 * (end - start)))
+
+    def _bases(self, key):
+        # 双重哈希得到每行的列号；str 的哈希值由解释器缓存，同一对象重复使用不会重复计算
+        h1 = hash(key)
+        h2 = hash((key, 0x5bd1e995)) | 1
+        width, slots = self.width, self.ring.slots
+        return [(row * width + (h1 + row * h2) % width) * slots for row in range(self.depth)]
+
+    def _window_total(self, bases):
+        table, slots, stale = self._table, self.ring.slots, self.ring.stale
+        if stale is None:
+            return min([sum(table[base:base + slots]) for base in bases])
+        return min([sum(table[base:base + slots]) - table[base + stale] for base in bases])
+
+    def estimate(self, key):
+        self.ring.advance()
+        return self._window_total(self._bases(key))
+
+    def add(self, key, count=1):
+        """计数并返回窗口内的估计值"""
+        slot = self.ring.advance()
+        bases = self._bases(key)
+        table = self._table
+        cells = [base + slot for base in bases]
+        # 保守更新：只抬高低于新估计值的计数器
+        target = min(min([table[cell] for cell in cells]) + count, 0xFFFF)
+        for cell in cells:
+            if table[cell] < target:
+                table[cell] = target
+        return self._window_total(bases)
+
+    @property
+    def memory_bytes(self):
+        return self._table.itemsize * len(self._table)
+
+
+def _bloom_positions(capacity, buckets, hashes, error):
+    """
+    窗口内最多 capacity 个不同组合时，使误判率不超过 error 所需的过滤器位置数：
+    每个时间片约 capacity / buckets 个组合，组合在任一时间片误判即视为已出现，故每片的误判率按 error / buckets 计算。
+    """
+    per_bucket = capacity / buckets
+    return max(1024, math.ceil(-hashes * per_bucket / math.log(1 - (error / buckets) ** (1 / hashes))))
+
+
+class SlidingDistinct:
+    """
+    滑动窗口内按键的近似去重计数（如一个 IP 使用过的不同卡数）：
+    以 Bloom 过滤器记录各时间片见过的 (键, 值) 组合，组合在窗口内首次出现时才计入 count-min 计数。
+    过滤器每个位置一个字节，第 s 位表示在槽位 s 的时间片中出现过（因此 buckets 不超过 7），
+    查询只需 hashes 次按位与。
+
+    两个结构都按窗口内预计的不同组合数 capacity 定长：过滤器为 1% 误判率（约 4 字节 / 组合），
+    count-min 的列数至少为 capacity / 2，窗口内每列平均不超过 2 个组合，正常键的估计值不会被碰撞抬高到限额以上
+    （合计约 32 字节 / 组合）。组合数远超 capacity 时，过滤器饱和使新组合被误判为已出现而少计（规则失效、放行），
+    count-min 过载使正常键被高估（误拦截），此时应调大 capacity（见 fill 与 /metrics 中的 screening.distinct_fill）。
+    同一组合跨时间片反复出现时在其首次出现的时间片过期后也会少计。
+    """
+
+    def __init__(self, window, buckets=6, width=65536, depth=4, capacity=100_000, hashes=3, error=0.01,
+                 clock=time.monotonic):
+        if buckets > 7:
+            raise ValueError("distinct counting supports at most 7 buckets per window")
+        self.counts = SlidingCountMin(window, buckets, max(width, capacity // 2), depth, clock)
+        self.capacity = capacity
+        self.positions = _bloom_positions(capacity, buckets, hashes, error)
+        self.hashes = hashes
+        self.ring = _BucketRing(window, buckets, self.positions, self._clear, clock)
+        self._marks = bytearray(self.positions)
+        self._clear_tables = [bytes(value & ~(1 << slot) for value in range(256)) for slot in range(self.ring.slots)]
+
+    def _clear(self, slot, start, end):
+        self._marks[start:end] = self._marks[start:end].translate(self._clear_tables[slot])
+
+    def add(self, key, value):
+        """记录组合并返回键在窗口内的不同值个数估计"""
+        ring = self.ring
+        bit = 1 << ring.advance()
+        pair = (key, value)
+        h1 = hash(pair)
+        h2 = hash((pair, 0x27d4eb2f)) | 1
+        positions = [(h1 + i * h2) % self.positions for i in range(self.hashes)]
+        marks = self._marks
+        # 各位置在窗口内的同一时间片都出现过，即组合已出现
+        seen = 0xFF if ring.stale is None else 0xFF & ~(1 << ring.stale)
+        for position in positions:
+            seen &= marks[position]
+        for position in positions:
+            marks[position] |= bit
+        if seen:
+            return self.counts.estimate(key)
+        return self.counts.add(key)
+
+    def estimate(self, key):
+        return self.counts.estimate(key)
+
+    @property
+    def fill(self):
+        """过滤器中非零位置的比例；接近 1 时新组合几乎都被误判为已出现"""
+        return 1 - self._marks.count(0) / self.positions
+
+    @property
+    def memory_bytes(self):
+        return self.counts.memory_bytes + len(self._marks)
+
+
+def _screen_keys(data):
+    """
+    从支付请求中取出各维度的键，带上维度前缀，不同维度的相同字符串（如 IP 与设备号）互不影响；
+    每个请求只拼接一次，同一维度的多条规则共用同一个字符串对象及其缓存的哈希值。卡号只在内存中参与哈希，不保存。
+    """
+    card = data.order.payment_method.payment_data.card_number
+    ip = data.env.client_ip
+    device = data.env.device_info.device_token_id if data.env.device_info else None
+    return {
+        KEY_IP: f"ip:{ip}" if ip else None,
+        KEY_DEVICE: f"device:{device}" if device else None,
+        KEY_EMAIL: f"email:{data.order.shipping.email.lower()}",
+        KEY_BIN: f"bin:{card[:6]}",
+        KEY_CARD: f"card:{card}",
+    }
+
+
+class PaymentScreener:
+    """
+    创建支付的前置风控：在调用 Stripe 之前按规则检查滑动窗口计数，明显的试卡洪峰
+    （同一 IP / 设备短时间大量请求、轮换大量卡号、同一 BIN 大量拒付）直接拒绝，不消耗 Stripe 限流预算与拒付手续费。
+
+    每条规则：{"name", "key", "window"（秒）, "limit", "distinct"（可选）, "count", "action"}
+    - key 为计数维度：ip、device、email、bin、card
+    - distinct 为空时计数请求次数；否则计数该维度下不同 distinct 值的个数（如 ip 下不同的 card）
+    - count 为 attempts（每次请求计数，默认）或 declines（只计 Stripe 拒付，由 record_decline 记录）
+    - 计数超过 limit 时，action 为 block（默认）拒绝本次请求，为 flag 只记录日志与指标
+    - capacity 为去重规则的窗口内预计不同组合数（如一天内不同的 邮箱-卡 组合），决定去重过滤器的大小；
+      组合数不超过请求数，按单个 worker 在一个窗口内处理的支付数估算即可（约 32 字节 / 组合）
+
+    计数结构内存固定（见 SlidingCountMin / SlidingDistinct），与 IP、卡号等键的数量无关；
+    计数在进程内存中，多 worker 部署时每个进程各自计数（各自看到的流量约为 1 / worker 数）。
+
+    - **rules**: 规则列表，默认读取 STRIPE_SCREEN_RULES_PATH（JSON 文件），未配置时使用 DEFAULT_RULES
+    - **width** / **depth**: STRIPE_SCREEN_SKETCH_WIDTH / STRIPE_SCREEN_SKETCH_DEPTH，每个 count-min sketch 的列数与行数
+    - **buckets**: STRIPE_SCREEN_BUCKETS，每个窗口的时间片数
+    - **distinct_capacity**: STRIPE_SCREEN_DISTINCT_CAPACITY，未设置 capacity 的去重规则的窗口内预计不同组合数
+    """
+
+    def __init__(self, rules=None, width=None, depth=None, buckets=None, distinct_capacity=None, clock=time.monotonic):
+        if rules is None:
+            path = os.getenv("STRIPE_SCREEN_RULES_PATH")
+            if path:
+                with open(path, encoding="utf-8") as f:
+                    rules = json.load(f)
+            else:
+                rules = DEFAULT_RULES
+        self.rules = _parse_rules(rules)
+        self.width = width or int(os.getenv("STRIPE_SCREEN_SKETCH_WIDTH", "65536"))
+        self.depth = depth or int(os.getenv("STRIPE_SCREEN_SKETCH_DEPTH", "4"))
+        self.buckets = buckets or int(os.getenv("STRIPE_SCREEN_BUCKETS", "6"))
+        self.distinct_capacity = distinct_capacity or int(os.getenv("STRIPE_SCREEN_DISTINCT_CAPACITY", "100000"))
+        self._sketches = {}
+        for rule in self.rules:
+            if rule["distinct"]:
+                sketch = SlidingDistinct(rule["window"], self.buckets, self.width, self.depth,
+                                         capacity=rule["capacity"] or self.distinct_capacity, clock=clock)
+            else:
+                sketch = SlidingCountMin(rule["window"], self.buckets, self.width, self.depth, clock=clock)
+            self._sketches[rule["name"]] = sketch
+        self._attempt_rules = [rule for rule in self.rules if rule["count"] == COUNT_ATTEMPTS]
+        self._decline_rules = [rule for rule in self.rules if rule["count"] == COUNT_DECLINES]
+        self.screened = 0
+        self.blocked = 0
+        # 各规则的触发次数（含 flag）
+        self.hits = {rule["name"]: 0 for rule in self.rules}
+
+    def _record(self, rule, keys):
+        key = keys[rule["key"]]
+        if key is None:
+            return None
+        sketch = self._sketches[rule["name"]]
+        if rule["distinct"]:
+            value = keys[rule["distinct"]]
+            return sketch.add(key, value) if value is not None else sketch.estimate(key)
+        return sketch.add(key)
+
+    def screen(self, data):
+        """
+        计入本次请求并检查全部规则，返回触发的 block 规则名；未触发时返回 None。
+        被拒绝的请求同样计数，持续的洪峰会一直被拒绝直到窗口滑过。
+        """
+        keys = _screen_keys(data)
+        self.screened += 1
+        hit = None
+        for rule in self._attempt_rules:
+            value = self._record(rule, keys)
+            if value is not None and value > rule["limit"]:
+                hit = self._trip(rule, keys, value) or hit
+        for rule in self._decline_rules:
+            key = keys[rule["key"]]
+            if key is None:
+                continue
+            value = self._sketches[rule["name"]].estimate(key)
+            if value >= rule["limit"]:
+                hit = self._trip(rule, keys, value) or hit
+        if hit is not None:
+            self.blocked += 1
+        return hit
+
+    def _trip(self, rule, keys, value):
+        self.hits[rule["name"]] += 1
+        counters.inc("screening.hits", rule=rule["name"], action=rule["action"])
+        if rule["action"] == ACTION_FLAG:
+            logger.warning("Screening rule %s flagged %s (%d > %d)", rule["name"], rule["key"], value, rule["limit"],
+                           extra={"event": "screening.flagged", "rule": rule["name"]})
+            return None
+        return rule["name"]
+
+    def record_decline(self, data):
+        """Stripe 拒付后调用，计入 count 为 declines 的规则"""
+        if self._decline_rules:
+            keys = _screen_keys(data)
+            for rule in self._decline_rules:
+                self._record(rule, keys)
+
+    def stats(self):
+        return {
+            "screened": self.screened,
+            "blocked": self.blocked,
+            "memory_bytes": sum(sketch.memory_bytes for sketch in self._sketches.values()),
+            "hits": self.hits,
+            "distinct_fill": self.distinct_fill(),
+            "rules": self.rules,
+        }
+
+    def distinct_fill(self):
+        """{去重规则名: 过滤器填充率}"""
+        return {name: round(sketch.fill, 4) for name, sketch in self._sketches.items()
+                if isinstance(sketch, SlidingDistinct)}
@@ -0,0 +1,189 @@
+# Stripe 参数序列化 - 声明式字段映射，启动时编译为扁平访问计划，直接生成 Stripe 表单编码参数
+import re
+from urllib.parse import quote_plus
+
+# quote_plus 不会改写的字符；绝大多数参数值（金额、币种、ID、卡号）命中这个快速路径
+_SAFE_VALUE = re.compile(r"[A-Za-z0-9_.~-]*")
+
+
+class Param:
+    """
+    映射中的一个 Stripe 参数。
+
+    - **source**: 请求模型上的属性路径，如 "order.payment_amount.value"
+    - **convert**: 可选的转换函数，在判空之前调用；结果为 None 的参数不发送（与 SDK 的行为一致）
+    """
+    __slots__ = ("source", "convert")
+
+    def __init__(self, source, convert=None):
+        self.source = source
+        self.convert = convert
+
+
+class StripeParamsSerializer:
+    """
+    将请求模型直接序列化为 Stripe 的扁平参数，如 {"payment_method_data[card][number]": "4242..."}。
+
+    映射在构造时编译一次：所有属性路径的公共前缀只解析一次并放入槽位，
+    每个参数只剩一次 getattr；输出已是方括号形式的键，SDK 编码时不必再递归展开嵌套字典。
+
+    - **fields**: {Stripe 参数名: Param 或属性路径字符串}
+    - **constants**: 每次请求都相同的参数
+    """
+
+    def __init__(self, fields, constants=None):
+        self.fields = {key: Param(param) if isinstance(param, str) else param for key, param in fields.items()}
+        self.constants = dict(constants or {})
+        self._parents = []
+        self._fields = []
+        slots = {"": 0}
+        for key, param in self.fields.items():
+            *path, name = param.source.split(".")
+            self._fields.append((key, self._slot(slots, path), name, param.convert))
+        # 编码用的计划：参数名在编译时就转义好并带上 "="
+        self._encoded_fields = [(_encode_key(key) + "=", slot, name, convert)
+                                for key, slot, name, convert in self._fields]
+        self._encoded_constants = [_encode_key(key) + "=" + _encode_value(value)
+                                   for key, value in self.constants.items() if value is not None]
+
+    def _slot(self, slots, path):
+        prefix = ".".join(path)
+        if prefix not in slots:
+            parent = self._slot(slots, path[:-1])
+            self._parents.append((parent, path[-1]))
+            slots[prefix] = len(slots)
+        return slots[prefix]
+
+    def prefixed(self, prefix):
+        """返回把全部参数嵌套到 prefix 之下的序列化器，如 card[number] -> payment_method_data[card][number]"""
+        return StripeParamsSerializer(
+            {_nest_key(prefix, key): param for key, param in self.fields.items()},
+            {_nest_key(prefix, key): value for key, value in self.constants.items()},
+        )
+
+    def __add__(self, other):
+        # 合并后重新编译，两个映射共用的属性路径前缀仍只解析一次
+        return StripeParamsSerializer({**self.fields, **other.fields}, {**self.constants, **other.constants})
+
+    def params(self, obj):
+        slots = [obj]
+        for parent, name in self._parents:
+            source = slots[parent]
+            slots.append(None if source is None else getattr(source, name))
+        params = dict(self.constants)
+        for key, slot, name, convert in self._fields:
+            source = slots[slot]
+            if source is None:
+                continue
+            value = getattr(source, name)
+            if convert is not None:
+                value = convert(value)
+            if value is not None:
+                params[key] = value
+        return params
+
+    def encode(self, obj):
+        """
+        直接生成 application/x-www-form-urlencoded 请求体，不经过中间字典，
+        结果与 SDK 对 params(obj) 的编码一致。
+        """
+        slots = [obj]
+        for parent, name in self._parents:
+            source = slots[parent]
+            slots.append(None if source is None else getattr(source, name))
+        parts = self._encoded_constants.copy()
+        for key, slot, name, convert in self._encoded_fields:
+            source = slots[slot]
+            if source is None:
+                continue
+            value = getattr(source, name)
+            if convert is not None:
+                value = convert(value)
+            if value is not None:
+                parts.append(key + _encode_value(value))
+        return "&".join(parts)
+
+
+def _encode_key(key):
+    # 与 SDK 一致：方括号保留原样，便于阅读
+    return quote_plus(key).replace("%5B", "[").replace("%5D", "]")
+
+
+def _encode_value(value):
+    if not isinstance(value, str):
+        value = str(value)
+    if _SAFE_VALUE.fullmatch(value):
+        return value
+    return quote_plus(value).replace("%5B", "[").replace("%5D", "]")
+
+
+def _nest_key(prefix, key):
+    head, bracket, rest = key.partition("[")
+    return f"{prefix}[{head}]{bracket}{rest}"
+
+
+def _expiry_year(value):
+    return int("20" + value)
+
+
+def _three_d_secure(requires_3ds):
+    return "challenge" if requires_3ds else "automatic"
+
+
+_PAYMENT_DATA = "order.payment_method.payment_data"
+_BILLING_ADDRESS = f"{_PAYMENT_DATA}.billing_address"
+
+# PaymentRequestSchema -> PaymentMethod 参数（两步流程直接使用，单次往返嵌套在 payment_method_data 下）
+PAYMENT_METHOD = StripeParamsSerializer(
+    {
+        "card[number]": f"{_PAYMENT_DATA}.card_number",
+        "card[exp_month]": Param(f"{_PAYMENT_DATA}.expiry_month", int),
+        "card[exp_year]": Param(f"{_PAYMENT_DATA}.expiry_year", _expiry_year),
+        "card[cvc]": f"{_PAYMENT_DATA}.cvv",
+        "billing_details[name]": f"{_PAYMENT_DATA}.card_holder_name.full_name",
+        "billing_details[email]": "order.shipping.email",
+        "billing_details[address][line1]": f"{_BILLING_ADDRESS}.address1",
+        "billing_details[address][line2]": f"{_BILLING_ADDRESS}.address2",
+        "billing_details[address][city]": f"{_BILLING_ADDRESS}.city",
+        "billing_details[address][state]": f"{_BILLING_ADDRESS}.state",
+        "billing_details[address][postal_code]": f"{_BILLING_ADDRESS}.zip_code",
+        "billing_details[address][country]": f"{_BILLING_ADDRESS}.country",
+    },
+    constants={"type": "card"},
+)
+
+# PaymentRequestSchema -> PaymentIntent 参数（不含支付方式）
+PAYMENT_INTENT = StripeParamsSerializer(
+    {
+        "amount": "order.payment_amount.value",
+        "currency": "order.payment_amount.currency",
+        "return_url": "system_three_ds_return_url",
+        "payment_method_options[card][request_three_d_secure]": Param(f"{_PAYMENT_DATA}.requires_3ds",
+                                                                      _three_d_secure),
+        "metadata[system_order_id]": "system_order_id",
+        "metadata[merchant_order_id]": "order.merchant_order_id",
+        "metadata[external_request_order_id]": "external_request_order_id",
+        "metadata[merchant_id]": "merchant_id",
+    },
+    constants={"confirmation_method": "automatic", "confirm": True, "metadata[source]": "DD"},
+)
+
+# 单次往返：创建并确认 PaymentIntent 时内联 payment_method_data
+PAYMENT_INTENT_WITH_METHOD = PAYMENT_INTENT + PAYMENT_METHOD.prefixed("payment_method_data")
+
+# 幂等指纹所用的参数：发往 Stripe 的参数去掉 CVC，客户端重试时的网络环境、设备与商品展示信息不影响指纹
+PAYMENT_FINGERPRINT = StripeParamsSerializer(
+    {key: param for key, param in PAYMENT_INTENT_WITH_METHOD.fields.items() if key != "payment_method_data[card][cvc]"},
+    PAYMENT_INTENT_WITH_METHOD.constants,
+)
+
+# RefundRequestSchema -> Refund 参数
+REFUND = StripeParamsSerializer(
+    {
+        "payment_intent": "channel_order_id",
+        "amount": "refund_amount",
+        "metadata[system_order_id]": "system_order_id",
+        "metadata[external_refund_id]": "external_refund_id",
+        "metadata[refund_request_id]": "refund_request_id",
+    }
+)
@@ -0,0 +1,58 @@
+# 请求合并 - 相同键的并发读请求共享同一个进行中的上游调用及其结果
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    按键合并并发调用：同一个键已有调用在进行时，后到的请求直接等待它的结果（或异常），不再发起新的上游调用。
+    调用结束后键即移除，之后的请求重新发起，不会返回过期的结果。
+
+    键的第一个元素作为统计分组，如 ("payment_details", payment_id)。
+
+    共享的调用在独立的 Task 中运行：发起它的请求被取消（客户端断开）时，其余等待者不受影响。
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._stats = {}
+
+    async def do(self, key, call):
+        """
+        - **key**: 可哈希的请求标识，须包含所有影响结果的参数
+        - **call**: 无参协程函数，只在没有进行中的同键调用时执行
+        """
+        stats = self._stats.get(key[0])
+        if stats is None:
+            stats = self._stats[key[0]] = {"calls": 0, "upstream": 0}
+        stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            stats["upstream"] += 1
+            task = self._inflight[key] = asyncio.ensure_future(call())
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都已取消时，避免 "exception was never retrieved" 警告
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("Coalesced call %s failed: %s", key[0], task.exception(),
+                         extra={"event": "coalescing.failed", "error": type(task.exception()).__name__})
+
+    def stats(self):
+        """各分组的请求数、实际上游调用数、被合并的请求数与合并比例，以及当前进行中的调用数"""
+        result = {}
+        for group, stats in self._stats.items():
+            calls, upstream = stats["calls"], stats["upstream"]
+            result[group] = {
+                "calls": calls,
+                "upstream": upstream,
+                "coalesced": calls - upstream,
+                "coalescing_ratio": round((calls - upstream) / calls, 4) if calls else 0.0,
+                "inflight": sum(1 for key in self._inflight if key[0] == group),
+            }
+        return result
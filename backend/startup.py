@@ -0,0 +1,105 @@
+# 启动预热 - 在开始接收流量前解析 Stripe 域名、建立连接池，并让校验器与序列化器走一遍首次调用的初始化
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit
+
+import stripe
+
+from backend import serializers
+from backend.ledger import build_payment_details
+from backend.schema import ChannelPaymentResponseSchema, PaymentRequestSchema, RefundRequestSchema, \
+    RefundResponseSchema
+
+logger = logging.getLogger(__name__)
+
+_NAME = {"first_name": "Warm", "last_name": "Up", "full_name": "Warm Up"}
+_ADDRESS = {"country": "US", "state": "CA", "city": "San Francisco", "address1": "1 Market St", "zip_code": "94105"}
+
+# 覆盖请求模型全部嵌套结构与自定义校验器的示例请求，只在本地校验与序列化，不会发往 Stripe
+WARMUP_PAYMENT = {
+    "env": {"terminal_type": "WEB", "client_ip": "127.0.0.1",
+            "browser_info": {"user_agent": "warmup", "java_enabled": False, "java_script_enabled": True},
+            "device_info": {"color_depth": 24, "screen_height": 1080, "screen_width": 1920}},
+    "order": {
+        "merchant_order_id": "warmup",
+        "goods": [{"goods_id": "warmup", "goods_name": "warmup", "goods_category": "warmup", "goods_quantity": 1,
+                   "goods_url": "https://example.com", "goods_price": 100, "delivery_method_type": "DIGITAL"}],
+        "shipping": {"shipping_name": _NAME, "shipping_address": _ADDRESS, "email": "warmup@example.com",
+                     "phone": "+14155550100"},
+        "payment_amount": {"currency": "USD", "value": 100},
+        "payment_method": {"payment_type": "card", "payment_data": {
+            "card_number": "4242424242424242", "expiry_year": "99", "expiry_month": "12", "cvv": "123",
+            "requires_3ds": False, "country": "US", "card_holder_name": _NAME, "billing_address": _ADDRESS}},
+        "metadata": {"warmup": "1"},
+    },
+    "merchant_id": "warmup",
+    "redirect_url": "https://example.com",
+    "external_request_order_id": "warmup",
+}
+WARMUP_REFUND = {"channel_order_id": "pi_warmup", "refund_amount": 100, "system_order_id": "warmup",
+                 "external_refund_id": "warmup", "refund_request_id": "warmup"}
+WARMUP_PAYMENT_INTENT = {
+    "id": "pi_warmup", "object": "payment_intent", "amount": 100, "currency": "usd", "status": "succeeded",
+    "created": 0, "metadata": {"source": "DD"},
+    "payment_method": {"id": "pm_warmup", "object": "payment_method", "type": "card", "card": {"last4": "4242"}},
+    "charges": {"object": "list", "data": [{
+        "id": "ch_warmup", "object": "charge", "amount": 100, "currency": "usd", "created": 0, "status": "succeeded",
+        "refunds": {"object": "list", "data": [{"id": "re_warmup", "object": "refund", "amount": 100,
+                                                "currency": "usd", "created": 0}]},
+    }]},
+}
+
+
+def warm_models():
+    """
+    校验、序列化各走一遍：email-validator 的 IDNA 表、Stripe 对象类型表等都在首次调用时才初始化，
+    放在启动阶段完成，不计入第一笔真实请求的耗时。
+    """
+    payment = PaymentRequestSchema.model_validate(WARMUP_PAYMENT)
+    serializers.PAYMENT_INTENT_WITH_METHOD.encode(payment)
+    serializers.PAYMENT_INTENT.encode(payment)
+    serializers.PAYMENT_METHOD.encode(payment)
+    serializers.REFUND.encode(RefundRequestSchema.model_validate(WARMUP_REFUND))
+    payment_intent = stripe.util.convert_to_stripe_object(WARMUP_PAYMENT_INTENT, stripe.api_key, None, None)
+    build_payment_details(payment_intent).model_dump_json()
+    ChannelPaymentResponseSchema(channel_order_id="pi_warmup", status="success").model_dump_json()
+    RefundResponseSchema(channel_refund_id="re_warmup", status="succeeded").model_dump_json()
+
+
+async def resolve_api_host(api_base=None):
+    """预先解析 Stripe 域名，失败时尽早在日志中暴露 DNS 问题"""
+    parts = urlsplit(api_base or stripe.api_base)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    return await asyncio.get_running_loop().getaddrinfo(parts.hostname, port)
+
+
+async def prewarm(transport, account=None, connections=4):
+    """
+    启动阶段的预热，返回各步骤耗时（毫秒）。任何一步失败都只记录日志，不阻止服务启动。
+
+    - **connections**: 为默认密钥与连接账户预先建立的连接数
+    """
+    timings = {}
+
+    async def step(name, run):
+        start = time.perf_counter()
+        try:
+            result = await run()
+        except Exception as e:
+            logger.warning("Prewarm step %s failed: %s", name, e,
+                           extra={"event": "prewarm.step_failed", "error": type(e).__name__})
+            result = None
+        timings[name] = round((time.perf_counter() - start) * 1000, 3)
+        return result
+
+    async def models():
+        warm_models()
+
+    await step("models", models)
+    await step("dns", resolve_api_host)
+    if stripe.api_key:
+        opened = await step("connections", lambda: transport.warm((stripe.api_key, account), connections))
+        timings["connections_opened"] = opened or 0
+    logger.info("Prewarm finished: %s", timings, extra={"event": "prewarm.finished"})
+    return timings
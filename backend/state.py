@@ -0,0 +1,167 @@
+# 共享状态后端 - 多 worker 进程之间共享的缓存失效标记、幂等键占用、限流令牌与作业租约
+import os
+import sqlite3
+import threading
+import time
+
+STATE_MEMORY = "memory"
+STATE_SQLITE = "sqlite"
+
+
+class MemoryStateBackend:
+    """
+    进程内状态后端，单 worker 部署的默认选项。
+
+    所有后端提供相同的方法：get / set / add / delete 操作带过期时间的字符串键值，
+    take 按令牌桶算法扣减共享令牌。shared 为 False 表示状态只在本进程可见，
+    调用方可以跳过只为跨进程一致性而做的检查。
+    """
+    shared = False
+
+    def __init__(self):
+        self._values = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        """键不存在（或已过期）时写入并返回 True，否则返回 False"""
+        now = time.time()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                return False
+            self._values[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def take(self, bucket, rate, burst, count=1):
+        """从令牌桶 bucket 中最多取 count 个令牌，返回实际取得的个数"""
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(bucket, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            granted = min(count, int(tokens))
+            self._buckets[bucket] = (tokens - granted, now)
+            return granted
+
+    def close(self):
+        pass
+
+
+class SQLiteStateBackend:
+    """
+    基于 SQLite（WAL）的共享状态后端，同一台机器上的多个 worker 进程打开同一个文件即可共享状态。
+
+    读-改-写操作（add / take）在 BEGIN IMMEDIATE 事务中完成，跨进程原子；
+    接口与 MemoryStateBackend 一致，换用 Redis 等外部存储时实现同样的方法即可。
+    """
+    shared = True
+
+    def __init__(self, path=None, busy_timeout=None):
+        self.path = path or os.getenv("STRIPE_STATE_PATH") or os.getenv("STRIPE_LEDGER_PATH", "payment_ledger.db")
+        busy_timeout = busy_timeout or float(os.getenv("STRIPE_STATE_BUSY_TIMEOUT", "5"))
+        self._conn = sqlite3.connect(self.path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_state ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_buckets ("
+            " key TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _transaction(self, run):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = run(time.time())
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._writes += 1
+            # 定期清理过期的键，保持表大小有界
+            if self._writes % 1000 == 0:
+                self._conn.execute("DELETE FROM shared_state WHERE expires_at <= ?", (time.time(),))
+            return result
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM shared_state WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl=None):
+        def run(now):
+            self._conn.execute("INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                               (key, value, now + ttl if ttl else None))
+
+        self._transaction(run)
+
+    def add(self, key, value, ttl=None):
+        def run(now):
+            self._conn.execute("DELETE FROM shared_state WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl if ttl else None),
+            )
+            return cursor.rowcount == 1
+
+        return self._transaction(run)
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+    def take(self, bucket, rate, burst, count=1):
+        def run(now):
+            row = self._conn.execute("SELECT tokens, updated FROM shared_buckets WHERE key = ?", (bucket,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            granted = min(count, int(tokens))
+            self._conn.execute("INSERT OR REPLACE INTO shared_buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                               (bucket, tokens - granted, now))
+            return granted
+
+        return self._transaction(run)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def from_env():
+    """按 STRIPE_STATE_BACKEND（memory / sqlite）创建状态后端"""
+    backend = os.getenv("STRIPE_STATE_BACKEND", STATE_MEMORY)
+    if backend == STATE_MEMORY:
+        return MemoryStateBackend()
+    if backend == STATE_SQLITE:
+        return SQLiteStateBackend()
+    raise ValueError(f"Unknown STRIPE_STATE_BACKEND: {backend}")
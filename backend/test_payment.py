@@ -1,32 +1,352 @@
 # 配置日志
+import asyncio
+import io
 import logging
 import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Literal, Optional, Union
+from urllib.parse import urlsplit
+
 import stripe
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import ValidationError
 
+from backend import serializers, startup, state as shared_state
+from backend.batch import run_batch
+from backend.card_index import CardPaymentIndex, payment_summary
+from backend.gateway import StripeGateway
+from backend.idempotency import IdempotencyStore, KIND_PAYMENT, KIND_REFUND
+from backend.jobs import JobRunner, JobStore
+from backend.logs import configure_logging
+from backend.ledger import PaymentLedger, parse_fields
+from backend.merchants import MerchantRegistry, UnknownMerchantError
+from backend.instrumentation import InstrumentedRoute, RequestMetricsMiddleware
+from backend.metrics import counters, gauges, latency, render_prometheus, tracing_from_env
+from backend.payment_queue import CallbackDispatcher, PaymentQueue, PaymentQueueStore, QueueFullError
+from backend.ratelimit import StripeRateLimiter
+from backend.screening import PaymentScreener
+from backend.singleflight import SingleFlight
+from backend.transport import PooledTransport
+from backend.webhooks import WebhookProcessor, WebhookSignatureError
 from backend.schema import PaymentRequestSchema, ChannelPaymentResponseSchema, GatewayPaymentStatus, \
-    PaymentDetailsResponseSchema, RefundResponseSchema, RefundRequestSchema, CardPaymentsResponseSchema
+    PaymentDetailsResponseSchema, RefundResponseSchema, RefundRequestSchema, CardPaymentsResponseSchema, \
+    BatchPaymentRequestSchema, BatchPaymentResponseSchema, RefundJobRequestSchema, JobStatusSchema, \
+    PaymentDetailsSummarySchema, PaymentAcceptedSchema, PaymentQueueStatusSchema, CaptureRequestSchema, \
+    CaptureResponseSchema, CancelRequestSchema, CaptureJobRequestSchema, CancelJobRequestSchema
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # 加载环境变量
 load_dotenv()
-logger.info(f"STRIPE_SECRET_KEY: {os.getenv('STRIPE_SECRET_KEY')}")
-logger.info(f"STRIPE_ACCOUNT_ID: {os.getenv('STRIPE_ACCOUNT_ID')}")
 
-app = FastAPI(
-    title="Stripe Payment API",
-    description="使用 FastAPI 和 Stripe 实现的支付与退款服务",
-    version="1.0.0",
+# 配置日志：队列 + 后台写线程输出结构化 JSON 日志，采样、限频与脱敏见 backend.logs
+configure_logging()
+
+# 创建支付的模式：single 为单次往返（内联 payment_method_data），two_step 为先建 PaymentMethod 再建 PaymentIntent
+CREATE_MODE_SINGLE = "single"
+CREATE_MODE_TWO_STEP = "two_step"
+CREATE_PAYMENT_MODE = os.getenv("STRIPE_CREATE_PAYMENT_MODE", CREATE_MODE_SINGLE)
+# 扣款方式：automatic 为授权即扣款；manual 为只授权，发货时再扣款；physical 为订单含实物商品时只授权
+CAPTURE_AUTOMATIC = "automatic"
+CAPTURE_MANUAL = "manual"
+CAPTURE_PHYSICAL = "physical"
+CAPTURE_METHOD = os.getenv("STRIPE_CAPTURE_METHOD", CAPTURE_AUTOMATIC)
+# 批量创建支付：并发上限与单项超时（秒），单批上限见 schema.BATCH_MAX_ITEMS
+BATCH_CONCURRENCY = int(os.getenv("STRIPE_BATCH_CONCURRENCY", "8"))
+BATCH_ITEM_TIMEOUT = float(os.getenv("STRIPE_BATCH_ITEM_TIMEOUT", "30"))
+IDEMPOTENCY_CONFLICT_MESSAGE = "Idempotency key used with different parameters. Use a new key."
+# 批量退款、扣款与撤销作业
+JOB_KIND_REFUND = "refund"
+JOB_KIND_CAPTURE = "capture"
+JOB_KIND_CANCEL = "cancel"
+# 异步创建支付的默认结果回调地址（请求参数与商户配置中的 callback_url 优先）
+PAYMENT_CALLBACK_URL = os.getenv("STRIPE_PAYMENT_CALLBACK_URL")
+# 请求参数 callback_url 允许指向的主机（逗号分隔）；商户配置与默认回调地址的主机始终允许
+CALLBACK_ALLOWED_HOSTS = frozenset(
+    host.strip().lower() for host in os.getenv("STRIPE_CALLBACK_ALLOWED_HOSTS", "").split(",") if host.strip()
 )
 
-# 调用Stripe API 所需的密钥
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# 以下服务对象由 create_app() 创建，导入本模块时不建立连接、不打开数据库
 # 账户ID
-account_id = os.getenv("STRIPE_ACCOUNT_ID")
+account_id = None
+# 状态后端：单进程为内存，多 worker 部署时由各进程共享（缓存失效、幂等键占用、限流令牌、作业租约）
+state = None
+# 长连接池传输层，按密钥与连接账户复用到 Stripe 的 TLS 连接
+transport = None
+# 所有 Stripe 调用都经由异步网关在线程池中执行，不阻塞事件循环
+gateway = None
+# 商户路由：merchant_id -> 商户独立的网关；未配置的商户使用上面的默认网关
+merchants = None
+# 本地支付台账，缓存 GET /payment/{payment_id} 的结果
+ledger = None
+# 卡 -> 支付订单二级索引
+card_index = None
+# 读接口的请求合并：同一支付 / 同一张卡的并发查询共享一次 Stripe 调用
+reads = None
+# Webhook 事件管道，推送的状态变更直接刷新本地台账
+webhook_processor = None
+# 本地幂等存储：external_request_order_id / external_refund_id -> 上游对象与最终响应
+idempotency = None
+# 批量作业（批量退款等）的持久化存储
+job_store = None
+job_runner = None
+# 异步创建支付（Prefer: respond-async）：持久化队列、worker 池与结果回调
+payment_queue_store = None
+payment_queue = None
+callback_dispatcher = None
+# 调用 Stripe 之前的风控预筛（STRIPE_SCREENING=1 时启用）
+screener = None
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+def _build_services():
+    global account_id, state, transport, gateway, merchants, ledger, card_index, reads, webhook_processor, \
+        idempotency, job_store, job_runner, payment_queue_store, payment_queue, callback_dispatcher, screener
+    # 密钥只记录是否配置及模式，任何情况下都不写入日志
+    secret_key = os.getenv("STRIPE_SECRET_KEY") or ""
+    logger.info("STRIPE_SECRET_KEY: %s", "not set" if not secret_key else "live mode" if "_live_" in secret_key else "test mode")
+    logger.info("STRIPE_ACCOUNT_ID: %s", os.getenv("STRIPE_ACCOUNT_ID"))
+    tracing_from_env()
+    # 调用Stripe API 所需的密钥；STRIPE_API_BASE 可指向 stripe-mock 或本地替身
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    stripe.api_base = os.getenv("STRIPE_API_BASE", stripe.api_base)
+    account_id = os.getenv("STRIPE_ACCOUNT_ID")
+    state = shared_state.from_env()
+    transport = PooledTransport.from_env()
+    stripe.default_http_client = transport
+    gateway = StripeGateway(account=account_id, limiter=StripeRateLimiter(state=state))
+    merchants = MerchantRegistry(gateway, state=state)
+    merchants.reload(force=True)
+    ledger = PaymentLedger(state=state)
+    card_index = CardPaymentIndex()
+    reads = SingleFlight()
+    webhook_processor = WebhookProcessor(gateway, ledger, card_index, merchants=merchants)
+    idempotency = IdempotencyStore(state=state)
+    job_store = JobStore()
+    job_runner = JobRunner(
+        job_store,
+        handlers={JOB_KIND_REFUND: _refund_job_item, JOB_KIND_CAPTURE: _capture_job_item,
+                  JOB_KIND_CANCEL: _cancel_job_item},
+        workers=int(os.getenv("STRIPE_JOB_WORKERS", "8")),
+        rate=float(os.getenv("STRIPE_JOB_RATE", "20")),
+        state=state,
+    )
+    screener = PaymentScreener() if os.getenv("STRIPE_SCREENING", "0") == "1" else None
+    payment_queue_store = PaymentQueueStore()
+    callback_dispatcher = CallbackDispatcher(payment_queue_store)
+    payment_queue = PaymentQueue(payment_queue_store, handler=_queued_payment, recover=_recover_queued_payment,
+                                 dispatcher=callback_dispatcher)
+    _register_gauges()
+
+
+def _register_gauges():
+    """/metrics 抓取时才读取的在途请求数与各类排队深度"""
+    gauges.register("http.requests_in_flight", lambda: RequestMetricsMiddleware.in_flight)
+    gauges.register("stripe.requests_in_flight", lambda: gateway.in_flight)
+    gauges.register("stripe.requests_waiting", lambda: gateway.waiting)
+    gauges.register("ratelimit.queue_depth", lambda: [
+        ({"bucket": bucket}, depth) for bucket, depth in gateway.limiter.stats()["queue_depth"].items()])
+    gauges.register("ratelimit.circuit_open", lambda: [
+        ({"account": account}, int(circuit["state"] != "closed"))
+        for account, circuit in gateway.limiter.stats()["circuits"].items()])
+    gauges.register("merchant.requests_in_flight", lambda: [
+        ({"merchant": merchant_id}, merchant_gateway.in_flight) for merchant_id, merchant_gateway in merchants.gateways()])
+    gauges.register("merchant.requests_waiting", lambda: [
+        ({"merchant": merchant_id}, merchant_gateway.waiting) for merchant_id, merchant_gateway in merchants.gateways()])
+    gauges.register("merchant.circuit_open", lambda: [
+        ({"merchant": merchant_id, "account": account}, int(circuit["state"] != "closed"))
+        for merchant_id, merchant_gateway in merchants.gateways()
+        for account, circuit in merchant_gateway.limiter.stats()["circuits"].items()])
+    gauges.register("coalescing.in_flight", lambda: [
+        ({"group": group}, group_stats["inflight"]) for group, group_stats in reads.stats().items()])
+    gauges.register("webhook.queue_depth", lambda: webhook_processor.queue.qsize())
+    gauges.register("jobs.running", lambda: job_runner.running)
+    gauges.register("payment_queue.depth", lambda: payment_queue.depth)
+    gauges.register("payment_queue.processing", lambda: payment_queue.processing)
+    gauges.register("callbacks.pending", lambda: payment_queue_store.counts()["callbacks"].get("pending", 0))
+    gauges.register("ledger.entries", lambda: ledger.stats()["entries"])
+    gauges.register("screening.distinct_fill", lambda: [] if screener is None else [
+        ({"rule": rule}, fill) for rule, fill in screener.distinct_fill().items()])
+
+
+@asynccontextmanager
+async def lifespan(app):
+    interval = float(os.getenv("STRIPE_POOL_MAINTENANCE_INTERVAL", "60"))
+    transport_maintenance = asyncio.create_task(transport.maintain_forever(interval))
+    merchants_watch = None
+    if merchants.path:
+        reload_interval = float(os.getenv("STRIPE_MERCHANTS_RELOAD_INTERVAL", "10"))
+        merchants_watch = asyncio.create_task(merchants.watch_forever(reload_interval))
+    await webhook_processor.start()
+    await job_runner.start()
+    await payment_queue.start()
+    callback_dispatcher.start()
+    # 预热完成前 uvicorn 不会开始接收请求
+    app.state.prewarm = {}
+    if os.getenv("STRIPE_PREWARM", "1") == "1":
+        connections = int(os.getenv("STRIPE_PREWARM_CONNECTIONS", "4"))
+        app.state.prewarm = await startup.prewarm(transport, account_id, connections)
+    yield
+    transport_maintenance.cancel()
+    if merchants_watch is not None:
+        merchants_watch.cancel()
+    await webhook_processor.stop()
+    webhook_processor.close()
+    await job_runner.stop()
+    job_store.close()
+    await payment_queue.stop()
+    await callback_dispatcher.stop()
+    callback_dispatcher.close()
+    payment_queue_store.close()
+    idempotency.close()
+    gateway.close()
+    merchants.close()
+    transport.close()
+    ledger.close()
+    card_index.close()
+    state.close()
+
+
+def create_app():
+    """
+    创建应用及其依赖的全部服务对象；启动（lifespan）时预热到 Stripe 的连接与校验器。
+    服务对象是进程级的，一个进程只应创建一个应用：uvicorn --factory backend.test_payment:create_app
+    多 worker 部署：python -m backend.test_payment --workers 4（每个 worker 进程各自创建一个应用）
+    """
+    _build_services()
+    app = FastAPI(
+        title="Stripe Payment API",
+        description="使用 FastAPI 和 Stripe 实现的支付与退款服务",
+        version="1.0.0",
+        lifespan=lifespan,
+    )
+    app.add_middleware(RequestMetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name):
+    # 兼容 uvicorn backend.test_payment:app：首次访问 app 时才创建
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@router.get("/health", summary="就绪检查")
+async def health(request: Request):
+    """启动预热完成后返回，附带各预热步骤的耗时（毫秒）"""
+    return {"status": "ok", "prewarm": request.app.state.prewarm}
+
+
+@router.get("/transport/stats", summary="查询 Stripe 连接池统计")
+async def get_transport_stats():
+    """
+    按 (密钥, 连接账户) 返回连接池统计：请求数、连接复用次数、新建连接数、等待时间等。
+    """
+    return transport.stats()
+
+
+@router.get("/ratelimit/stats", summary="查询 Stripe 限流、重试与熔断统计")
+async def get_ratelimit_stats():
+    """
+    按接口类别返回调用数、重试数、429 次数、排队等待时间，以及各账户的排队深度与熔断状态。
+    """
+    return gateway.limiter.stats()
+
+
+@router.get("/merchants", summary="查询商户路由配置与各商户网关状态")
+async def get_merchants():
+    """
+    返回商户配置文件路径、热加载次数，以及每个已配置商户的连接账户、并发名额占用、限流预算与熔断状态。
+    """
+    return merchants.stats()
+
+
+@router.post("/merchants/reload", summary="立即重新加载商户配置")
+async def reload_merchants():
+    """
+    不等待定期检查，立即重新读取 STRIPE_MERCHANTS_PATH；配置无效时返回 400 并保留当前配置。
+    多 worker 部署时只作用于处理该请求的进程，其余进程在下一次定期检查时加载。
+    """
+    if not merchants.path:
+        raise HTTPException(status_code=400, detail="未配置 STRIPE_MERCHANTS_PATH")
+    try:
+        return await asyncio.to_thread(merchants.reload, True)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"商户配置无效: {str(e)}")
+
+
+@router.get("/screening/stats", summary="查询支付前置风控统计")
+async def get_screening_stats():
+    """
+    返回预筛的请求数、拒绝数、各规则的触发次数、计数结构占用的内存（字节）、去重过滤器的填充率与生效的规则。
+    """
+    if screener is None:
+        return {"enabled": False}
+    return dict(screener.stats(), enabled=True)
+
+
+@router.get("/coalescing/stats", summary="查询读接口请求合并统计")
+async def get_coalescing_stats():
+    """
+    按接口返回请求数、实际发往 Stripe 的调用数、被合并的请求数与合并比例。
+    """
+    return reads.stats()
+
+
+@router.get("/ledger/stats", summary="查询本地支付台账命中情况")
+async def get_ledger_stats():
+    return ledger.stats()
+
+
+@router.get("/metrics", summary="Prometheus 指标")
+async def get_metrics():
+    """
+    Prometheus 文本格式的指标：
+
+    - stripe_payment_http_request_seconds / stripe_payment_http_phase_seconds: 各接口耗时及校验、处理、序列化阶段耗时
+    - stripe_payment_stripe_request_seconds: 每次发往 Stripe 的请求耗时，按操作与结果（ok 或错误类型）
+    - stripe_payment_create_payment_phase_seconds: 创建支付各阶段耗时
+    - stripe_payment_payment_outcomes_total / stripe_payment_stripe_errors_total: 映射后的支付状态与错误类型计数
+    - 在途请求数、并发名额等待数、限流排队深度、熔断状态、Webhook 队列深度等瞬时量
+    """
+    return Response(render_prometheus(latency, counters, gauges), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/traces", summary="查询最近的调用链")
+async def get_traces(limit: int = Query(20, ge=1, le=200, description="返回的 trace 条数")):
+    """
+    STRIPE_TRACING=1 时返回最近完成的请求调用链（新的在前），每条为该请求内全部 span；
+    响应头 X-Trace-Id 即对应的 trace_id。未开启时返回空列表。
+    """
+    return {"enabled": latency.tracer.enabled, "traces": latency.tracer.recent(limit)}
+
+
+@router.get("/metrics/latency", summary="查询热点路径分阶段耗时")
+async def get_latency_metrics():
+    """
+    返回各阶段耗时统计；同时运行过两种创建模式时，
+    create_payment_savings 给出单次往返相对两步流程的平均节省（毫秒）。
+    """
+    summary = latency.summary()
+    two_step = latency.get("create_payment.phase", mode=CREATE_MODE_TWO_STEP, phase="total")
+    single = latency.get("create_payment.phase", mode=CREATE_MODE_SINGLE, phase="total")
+    if two_step and single:
+        summary["create_payment_savings"] = {
+            "avg_ms": round(two_step["avg_ms"] - single["avg_ms"], 3),
+            "payment_method_create_avg_ms": (latency.get("create_payment.phase", mode=CREATE_MODE_TWO_STEP,
+                                                         phase="payment_method_create") or {}).get("avg_ms"),
+        }
+    return summary
+
 
 """
 示例输入：
@@ -124,9 +444,33 @@ account_id = os.getenv("STRIPE_ACCOUNT_ID")
 """
 
 
-@app.post("/create-payment", response_model=ChannelPaymentResponseSchema,
-          summary="创建并发起 Stripe 支付")
-async def create_payment(data: PaymentRequestSchema):
+def _capture_method(data):
+    if CAPTURE_METHOD == CAPTURE_PHYSICAL:
+        physical = any(goods.delivery_method_type == "PHYSICAL" for goods in data.order.goods or [])
+        return CAPTURE_MANUAL if physical else CAPTURE_AUTOMATIC
+    return CAPTURE_METHOD
+
+
+def _payment_fingerprint(data, capture_method):
+    """创建支付的请求指纹：只包含发往 Stripe 的参数（不含 CVC）、商户与扣款方式"""
+    return idempotency.fingerprint({"params": serializers.PAYMENT_FINGERPRINT.encode(data),
+                                    "merchant_id": data.merchant_id, "capture_method": capture_method})
+
+
+def _gateway_for(merchant_id):
+    """按 merchant_id 选择网关；严格模式下未配置的商户返回 400"""
+    try:
+        return merchants.gateway(merchant_id)
+    except UnknownMerchantError:
+        raise HTTPException(status_code=400, detail=f"未知商户: {merchant_id}")
+
+
+@router.post("/create-payment", response_model=ChannelPaymentResponseSchema,
+          summary="创建并发起 Stripe 支付",
+          responses={202: {"model": PaymentAcceptedSchema, "description": "Prefer: respond-async 时已受理，结果异步回调"}})
+async def create_payment(data: PaymentRequestSchema, request: Request, callback_url: Optional[str] = Query(
+        None, description="异步模式下接收支付结果的地址，主机须为商户配置或 STRIPE_PAYMENT_CALLBACK_URL 的主机，"
+                          "或在 STRIPE_CALLBACK_ALLOWED_HOSTS 中；为空时使用商户配置或 STRIPE_PAYMENT_CALLBACK_URL")):
     """
     输出：
     {
@@ -135,91 +479,255 @@ async def create_payment(data: PaymentRequestSchema):
       "redirect_url": "",
       "detail": null
     }
+
+    请求头带 Prefer: respond-async 时不等待 Stripe：立即返回 202 与 queue_id，由后台 worker 创建支付，
+    最终结果（上面的字段，另含 queue_id、merchant_id、system_order_id、external_request_order_id）
+    以 {"results": [...]} 批量 POST 到回调地址，失败时退避重试；GET /payment-queue/{queue_id} 可查询结果。
     :param data:
     :return:
     """
+    if "respond-async" in request.headers.get("prefer", "").lower():
+        return await _enqueue_payment(data, callback_url)
+    return await _create_payment(data)
+
+
+async def _create_payment(data):
+    mode = CREATE_PAYMENT_MODE
+    started = time.perf_counter()
+    merchant_gateway = _gateway_for(data.merchant_id)
+    capture_method = _capture_method(data)
+
+    # 幂等键已处理过：参数一致直接返回原响应，不一致直接判定冲突，均不访问 Stripe
+    idempotency_key = data.external_request_order_id
+    store_key = merchants.scoped_key(data.merchant_id, idempotency_key)
+    fingerprint = _payment_fingerprint(data, capture_method) if idempotency_key else None
+    # 幂等存储与共享状态的读写可能等待 SQLite 锁，在线程中进行，不阻塞事件循环
+    record = await asyncio.to_thread(idempotency.lookup, KIND_PAYMENT, store_key)
+    claimed = False
+    if record is None and idempotency_key:
+        claimed = await asyncio.to_thread(idempotency.claim, KIND_PAYMENT, store_key)
+        if not claimed:
+            # 同一幂等键的请求正在处理（可能在其他 worker 进程），等待它的结果
+            record = await idempotency.wait(KIND_PAYMENT, store_key)
+    if record is not None:
+        if record.fingerprint != fingerprint:
+            logger.warning("Idempotency conflict for payment key: %s", idempotency_key,
+                           extra={"event": "payment.idempotency_conflict", "merchant_id": data.merchant_id})
+            return ChannelPaymentResponseSchema(
+                channel_order_id=None,
+                status=GatewayPaymentStatus.FAILED,
+                detail={"message": IDEMPOTENCY_CONFLICT_MESSAGE},
+            )
+        logger.info("Payment replayed from idempotency store: %s", record.object_id,
+                    extra={"event": "payment.replayed", "payment_id": record.object_id, "merchant_id": data.merchant_id})
+        counters.inc("idempotency.replays", kind=KIND_PAYMENT)
+        return ChannelPaymentResponseSchema(**record.response)
+
     try:
-        billing_address = data.order.payment_method.payment_data.billing_address
-        stripe_address = {
-            "line1": billing_address.address1,
-            "line2": billing_address.address2,
-            "city": billing_address.city,
-            "state": billing_address.state,
-            "postal_code": billing_address.zip_code,
-            "country": billing_address.country,
-        }
+        if screener is not None:
+            with latency.time("create_payment.phase", mode=mode, phase="screen"):
+                rule = screener.screen(data)
+            if rule is not None:
+                logger.warning("Payment blocked by screening rule %s", rule,
+                               extra={"event": "payment.screened", "merchant_id": data.merchant_id, "rule": rule})
+                counters.inc("payment.outcomes", operation="create_payment", status=GatewayPaymentStatus.FAILED)
+                return ChannelPaymentResponseSchema(
+                    channel_order_id=None,
+                    status=GatewayPaymentStatus.FAILED,
+                    detail={"message": f"风控拦截: {rule}", "rule": rule},
+                )
 
-        payment_method = stripe.PaymentMethod.create(
-            type="card",
-            card={
-                "number": data.order.payment_method.payment_data.card_number,
-                "exp_month": int(data.order.payment_method.payment_data.expiry_month),
-                "exp_year": int("20" + data.order.payment_method.payment_data.expiry_year),
-                "cvc": data.order.payment_method.payment_data.cvv,
-            },
-            billing_details={
-                "name": data.order.payment_method.payment_data.card_holder_name.full_name,
-                "email": data.order.shipping.email,
-                "address": stripe_address,
-            },
-            stripe_account=account_id,
-        )
+        with latency.time("create_payment.phase", mode=mode, phase="build_params"):
+            if mode == CREATE_MODE_TWO_STEP:
+                intent_body = serializers.PAYMENT_INTENT.encode(data)
+            else:
+                # 单次往返：在创建并确认 PaymentIntent 时内联 payment_method_data
+                intent_body = serializers.PAYMENT_INTENT_WITH_METHOD.encode(data)
+            if capture_method == CAPTURE_MANUAL:
+                intent_body += f"&capture_method={CAPTURE_MANUAL}"
 
-        payment_intent = stripe.PaymentIntent.create(
-            amount=data.order.payment_amount.value,
-            currency=data.order.payment_amount.currency,
-            payment_method=payment_method.id,
-            confirmation_method="automatic",
-            confirm=True,
-            stripe_account=account_id,
-            return_url=data.system_three_ds_return_url,  # 确保正确传递 return_url
-            payment_method_options={
-                "card": {
-                    "request_three_d_secure": "challenge" if data.order.payment_method.payment_data.requires_3ds else "automatic"
-                }
-            },
-            metadata={
-                "system_order_id": data.system_order_id,
-                "merchant_order_id": data.order.merchant_order_id,
-                "external_request_order_id": data.external_request_order_id,
-                "source": "DD",
-                "merchant_id": data.merchant_id,
-            },
-            idempotency_key=data.external_request_order_id,
-        )
+        if mode == CREATE_MODE_TWO_STEP:
+            with latency.time("create_payment.phase", mode=mode, phase="payment_method_create"):
+                payment_method = await merchant_gateway.create_payment_method(
+                    body=serializers.PAYMENT_METHOD.encode(data))
+            intent_body += f"&payment_method={payment_method.id}"
+
+        with latency.time("create_payment.phase", mode=mode, phase="payment_intent_create"):
+            payment_intent = await merchant_gateway.create_payment_intent(body=intent_body,
+                                                                          idempotency_key=idempotency_key)
+        latency.observe("create_payment.phase", time.perf_counter() - started, mode=mode, phase="total")
 
         status_map = {
             "succeeded": GatewayPaymentStatus.SUCCESS,
             "requires_action": GatewayPaymentStatus.PENDING,
+            "requires_capture": GatewayPaymentStatus.AUTHORIZED,
         }
         payment_status = status_map.get(payment_intent.status, GatewayPaymentStatus.FAILED)
+        counters.inc("payment.outcomes", operation="create_payment", status=payment_status)
+        await asyncio.to_thread(ledger.invalidate, payment_intent.id)
+        await asyncio.to_thread(
+            card_index.add,
+            payment_method.id if mode == CREATE_MODE_TWO_STEP else payment_intent.payment_method,
+            payment_summary(payment_intent, [charge.to_dict() for charge in getattr(payment_intent.get("charges"), "data", [])]),
+            merchants.scope(data.merchant_id),
+        )
 
-        logger.info(f"Payment initiated: {payment_intent.id}, status: {payment_status}")
-        return ChannelPaymentResponseSchema(
+        logger.info("Payment initiated: %s, status: %s", payment_intent.id, payment_status,
+                    extra={"event": "payment.initiated", "payment_id": payment_intent.id,
+                           "merchant_id": data.merchant_id, "status": payment_status,
+                           "latency_ms": round((time.perf_counter() - started) * 1000, 3)})
+        response = ChannelPaymentResponseSchema(
             channel_order_id=payment_intent.id,
             status=payment_status,
             redirect_url=getattr(payment_intent.next_action, "redirect_to_url", {}).get("url", ""),
             detail=None,
         )
+        await asyncio.to_thread(idempotency.save, KIND_PAYMENT, store_key, payment_intent.id, fingerprint,
+                                response.model_dump())
+        return response
 
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe Error: {str(e)}")
+        logger.error("Stripe Error: %s", e,
+                     extra={"event": "payment.failed", "merchant_id": data.merchant_id, "error": type(e).__name__,
+                            "latency_ms": round((time.perf_counter() - started) * 1000, 3)})
+        counters.inc("payment.outcomes", operation="create_payment", status=GatewayPaymentStatus.FAILED)
+        if screener is not None and isinstance(e, stripe.error.CardError):
+            screener.record_decline(data)
         return ChannelPaymentResponseSchema(
             channel_order_id=None,
             status=GatewayPaymentStatus.FAILED,
             detail={"message": str(e)}
         )
     except Exception as e:
-        logger.error(f"Unexpected Error: {str(e)}")
+        logger.error("Unexpected Error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+    finally:
+        if claimed:
+            await asyncio.to_thread(idempotency.release, KIND_PAYMENT, store_key)
+
+
+async def _enqueue_payment(data, callback_url):
+    _gateway_for(data.merchant_id)
+    if not data.external_request_order_id:
+        raise HTTPException(status_code=400, detail="异步创建支付需要 external_request_order_id")
+    configured = merchants.callback_url(data.merchant_id) or PAYMENT_CALLBACK_URL
+    if callback_url:
+        # 调用方指定的地址只能指向允许的主机，不能借本服务向内网等任意地址投递签名的支付结果
+        allowed = CALLBACK_ALLOWED_HOSTS | ({urlsplit(configured).hostname} if configured else set())
+        if urlsplit(callback_url).hostname not in allowed:
+            raise HTTPException(status_code=400, detail=f"回调地址的主机不在允许范围内: {callback_url}")
+    else:
+        callback_url = configured
+    if callback_url and urlsplit(callback_url).scheme not in ("http", "https"):
+        raise HTTPException(status_code=400, detail=f"回调地址无效: {callback_url}")
+
+    store_key = merchants.scoped_key(data.merchant_id, data.external_request_order_id)
+    try:
+        queue_id, created = await payment_queue.submit(data, store_key, callback_url)
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="支付队列已满，请稍后重试", headers={"Retry-After": "1"})
+    status = "queued" if created else payment_queue_store.get(queue_id)["status"]
+    logger.info("Payment queued: %s, new: %s", queue_id, created,
+                extra={"event": "payment.queued", "merchant_id": data.merchant_id})
+    accepted = PaymentAcceptedSchema(queue_id=queue_id, system_order_id=data.system_order_id, status=status)
+    return JSONResponse(accepted.model_dump(), status_code=202, headers={"Location": f"/payment-queue/{queue_id}"})
+
+
+async def _queued_payment(data):
+    try:
+        response = await _create_payment(data)
+    except HTTPException as e:
+        response = ChannelPaymentResponseSchema(channel_order_id=None, status=GatewayPaymentStatus.FAILED,
+                                                detail={"message": str(e.detail)})
+    return response.model_dump()
+
+
+def _recover_queued_payment(payload):
+    """受理进程退出时未完成的异步支付：幂等存储中已有结果则直接采用，否则请商户重新提交"""
+    store_key = merchants.scoped_key(payload.get("merchant_id"), payload.get("external_request_order_id"))
+    record = idempotency.lookup(KIND_PAYMENT, store_key)
+    if record is not None:
+        return record.response
+    return ChannelPaymentResponseSchema(
+        channel_order_id=None,
+        status=GatewayPaymentStatus.FAILED,
+        detail={"message": "处理中断，请使用相同的 external_request_order_id 重新提交"},
+    ).model_dump()
+
+
+@router.get("/payment-queue/stats", summary="查询异步支付队列与回调统计")
+async def get_payment_queue_stats():
+    """本进程的排队深度、处理中的支付数，以及存储中各状态的支付与回调数"""
+    return await asyncio.to_thread(payment_queue.stats)
+
+
+@router.get("/payment-queue/{queue_id}", response_model=PaymentQueueStatusSchema, summary="查询异步支付结果")
+async def get_queued_payment(queue_id: str):
+    entry = await asyncio.to_thread(payment_queue_store.get, queue_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="队列项不存在")
+    return PaymentQueueStatusSchema(**entry)
+
+
+def _batch_item_error(item, exc):
+    if isinstance(exc, asyncio.TimeoutError):
+        message = f"请求超时（{BATCH_ITEM_TIMEOUT:g} 秒），可使用相同的 external_request_order_id 重试"
+    elif isinstance(exc, HTTPException):
+        message = str(exc.detail)
+    else:
+        message = f"服务器错误: {str(exc)}"
+    return ChannelPaymentResponseSchema(channel_order_id=None, status=GatewayPaymentStatus.FAILED,
+                                        detail={"message": message})
+
+
+@router.post("/create-payments:batch", response_model=BatchPaymentResponseSchema, summary="批量创建并发起 Stripe 支付")
+async def create_payments_batch(data: BatchPaymentRequestSchema):
+    """
+    一次提交多笔支付，整批请求一次性完成校验，再以有界并发调用 Stripe。
+
+    - 结果按 items 顺序返回，每项语义与 /create-payment 相同
+    - 单项失败或超时只影响该项，不会使整批失败
+    - 同一批次内商户与 external_request_order_id 相同、参数一致的项只向 Stripe 发起一次，并共享结果；
+      参数不一致的项返回幂等冲突，不会发往 Stripe
+    """
+    # 按商户作用域内的幂等键去重，避免同一批次内的相同请求并发撞上 Stripe 的幂等锁
+    unique, positions = [], []
+    first_by_key = {}
+    conflict = ChannelPaymentResponseSchema(channel_order_id=None, status=GatewayPaymentStatus.FAILED,
+                                            detail={"message": IDEMPOTENCY_CONFLICT_MESSAGE})
+    for item in data.items:
+        key = item.external_request_order_id
+        if key is None:
+            positions.append(len(unique))
+            unique.append(item)
+            continue
+        store_key = merchants.scoped_key(item.merchant_id, key)
+        fingerprint = _payment_fingerprint(item, _capture_method(item))
+        if store_key not in first_by_key:
+            first_by_key[store_key] = (len(unique), fingerprint)
+            positions.append(len(unique))
+            unique.append(item)
+        elif first_by_key[store_key][1] == fingerprint:
+            positions.append(first_by_key[store_key][0])
+        else:
+            logger.warning("Idempotency conflict within batch for key: %s", key,
+                           extra={"event": "payment.idempotency_conflict", "merchant_id": item.merchant_id})
+            positions.append(None)
+
+    results = await run_batch(unique, _create_payment, BATCH_CONCURRENCY, BATCH_ITEM_TIMEOUT, _batch_item_error)
+    logger.info("Batch payment processed: %d items, %d upstream", len(data.items), len(unique),
+                extra={"event": "payment.batch"})
+    return BatchPaymentResponseSchema(results=[conflict if position is None else results[position]
+                                               for position in positions])
 
 
 # 退款接口
-@app.post("/refund", response_model=RefundResponseSchema, summary="执行 Stripe 退款")
-async def refund_payment(data: RefundRequestSchema):
+@router.post("/refund", response_model=RefundResponseSchema, summary="执行 Stripe 退款")
+async def refund_payment(data: RefundRequestSchema, merchant_id: Optional[str] = Query(None, description="商户 ID，按商户配置选择 Stripe 账户；为空时使用默认账户")):
     """
     执行退款。
 
+    - **merchant_id**: 查询参数，商户 ID；支付由商户的 Stripe 账户创建时必须与创建时一致
     - **channel_order_id**: PaymentIntent ID
     - **refund_amount**: 退款金额（单位：分），为空则全额退款
     - **system_order_id**: 系统订单 ID
@@ -234,58 +742,81 @@ async def refund_payment(data: RefundRequestSchema):
         "refund_request_id": "req_refund_124" # 退款请求的自定义标识，由你手动指定，建议唯一
     }
     """
+    started = time.perf_counter()
+    merchant_gateway = _gateway_for(merchant_id)
+    store_key = merchants.scoped_key(merchant_id, data.external_refund_id)
+    fingerprint = idempotency.fingerprint({"params": serializers.REFUND.encode(data), "merchant_id": merchant_id})
+    record = await asyncio.to_thread(idempotency.lookup, KIND_REFUND, store_key)
+    claimed = False
+    if record is None:
+        claimed = await asyncio.to_thread(idempotency.claim, KIND_REFUND, store_key)
+        if not claimed:
+            record = await idempotency.wait(KIND_REFUND, store_key)
+    if record is not None:
+        if record.fingerprint != fingerprint:
+            logger.warning("Idempotency conflict for refund key: %s", data.external_refund_id,
+                           extra={"event": "refund.idempotency_conflict", "payment_id": data.channel_order_id})
+            return RefundResponseSchema(
+                channel_refund_id=None,
+                status=GatewayPaymentStatus.FAILED,
+                detail={"message": IDEMPOTENCY_CONFLICT_MESSAGE}
+            )
+        logger.info("Refund replayed from idempotency store: %s", record.object_id,
+                    extra={"event": "refund.replayed", "refund_id": record.object_id, "payment_id": data.channel_order_id})
+        counters.inc("idempotency.replays", kind=KIND_REFUND)
+        return RefundResponseSchema(**record.response)
+
     try:
-        refund = stripe.Refund.create(
-            payment_intent=data.channel_order_id,
-            amount=data.refund_amount,
-            stripe_account=account_id,
-            metadata={
-                "system_order_id": data.system_order_id,
-                "external_refund_id": data.external_refund_id,
-                "refund_request_id": data.refund_request_id
-            },
-            idempotency_key=data.external_refund_id
-        )
+        refund = await merchant_gateway.create_refund(body=serializers.REFUND.encode(data),
+                                                      idempotency_key=data.external_refund_id)
 
         status_map = {
             "succeeded": GatewayPaymentStatus.SUCCESS,
             "pending": GatewayPaymentStatus.PENDING,
         }
         refund_status = status_map.get(refund.status, GatewayPaymentStatus.FAILED)
+        counters.inc("payment.outcomes", operation="refund", status=refund_status)
+        await asyncio.to_thread(ledger.invalidate, data.channel_order_id)
 
-        logger.info(f"Refund processed: {refund.id}, status: {refund_status}")
-        return RefundResponseSchema(
+        logger.info("Refund processed: %s, status: %s", refund.id, refund_status,
+                    extra={"event": "refund.processed", "refund_id": refund.id, "payment_id": data.channel_order_id,
+                           "status": refund_status, "latency_ms": round((time.perf_counter() - started) * 1000, 3)})
+        response = RefundResponseSchema(
             channel_refund_id=refund.id,
             status=refund_status
         )
+        await asyncio.to_thread(idempotency.save, KIND_REFUND, store_key, refund.id, fingerprint, response.model_dump())
+        return response
 
     except stripe.error.IdempotencyError as e:
-        logger.warning(f"Idempotency Error: {str(e)}. Checking existing refund...")
+        logger.warning("Idempotency Error: %s. Checking existing refund...", e,
+                       extra={"event": "refund.idempotency_error", "payment_id": data.channel_order_id})
         try:
-            refunds = stripe.Refund.list(
-                payment_intent=data.channel_order_id,
-                limit=10,
-                stripe_account=account_id
-            )
-            for refund in refunds.data:
-                if refund.metadata.get("external_refund_id") == data.external_refund_id:
-                    status_map = {
-                        "succeeded": GatewayPaymentStatus.SUCCESS,
-                        "pending": GatewayPaymentStatus.PENDING,
-                    }
-                    refund_status = status_map.get(refund.status, GatewayPaymentStatus.FAILED)
-                    logger.info(f"Found existing refund: {refund.id}, status: {refund_status}")
-                    return RefundResponseSchema(
-                        channel_refund_id=refund.id,
-                        status=refund_status
-                    )
+            # 分页遍历该 PaymentIntent 的全部退款，避免超过 10 笔时漏查
+            refund = await merchant_gateway.find_refund(data.channel_order_id, data.external_refund_id)
+            if refund is not None:
+                status_map = {
+                    "succeeded": GatewayPaymentStatus.SUCCESS,
+                    "pending": GatewayPaymentStatus.PENDING,
+                }
+                refund_status = status_map.get(refund.status, GatewayPaymentStatus.FAILED)
+                await asyncio.to_thread(ledger.invalidate, data.channel_order_id)
+                logger.info("Found existing refund: %s, status: %s", refund.id, refund_status,
+                            extra={"event": "refund.found_existing", "refund_id": refund.id,
+                                   "payment_id": data.channel_order_id, "status": refund_status})
+                return RefundResponseSchema(
+                    channel_refund_id=refund.id,
+                    status=refund_status
+                )
             return RefundResponseSchema(
                 channel_refund_id=None,
                 status=GatewayPaymentStatus.FAILED,
-                detail={"message": "Idempotency key used with different parameters. Use a new key."}
+                detail={"message": IDEMPOTENCY_CONFLICT_MESSAGE}
             )
         except stripe.error.StripeError as inner_e:
-            logger.error(f"Error retrieving refund: {str(inner_e)}")
+            logger.error("Error retrieving refund: %s", inner_e,
+                         extra={"event": "refund.lookup_failed", "payment_id": data.channel_order_id,
+                                "error": type(inner_e).__name__})
             return RefundResponseSchema(
                 channel_refund_id=None,
                 status=GatewayPaymentStatus.FAILED,
@@ -293,128 +824,448 @@ async def refund_payment(data: RefundRequestSchema):
             )
 
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe Refund Error: {str(e)}")
+        logger.error("Stripe Refund Error: %s", e,
+                     extra={"event": "refund.failed", "payment_id": data.channel_order_id, "error": type(e).__name__,
+                            "latency_ms": round((time.perf_counter() - started) * 1000, 3)})
+        counters.inc("payment.outcomes", operation="refund", status=GatewayPaymentStatus.FAILED)
         return RefundResponseSchema(
             channel_refund_id=None,
             status=GatewayPaymentStatus.FAILED,
             detail={"message": str(e)}
         )
     except Exception as e:
-        logger.error(f"Unexpected Refund Error: {str(e)}")
+        logger.error("Unexpected Refund Error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+    finally:
+        if claimed:
+            await asyncio.to_thread(idempotency.release, KIND_REFUND, store_key)
+
+
+async def _refund_job_item(payload):
+    response = await refund_payment(RefundRequestSchema(**payload), merchant_id=payload.get("merchant_id"))
+    return response.model_dump()
+
+
+async def _read_ndjson(request, schema):
+    """逐块读取 NDJSON 请求体，每行一个 schema 对象；某行无效时返回 400 并指出行号"""
+    items, pending, line_no = [], [], 0
+
+    def parse(line):
+        try:
+            items.append(schema.model_validate_json(line))
+        except ValidationError as e:
+            errors = "; ".join(
+                f"{'.'.join(map(str, err['loc']))}: {err['msg']}" if err["loc"] else err["msg"] for err in e.errors()
+            )
+            raise HTTPException(status_code=400, detail=f"第 {line_no} 行无效: {errors}")
+
+    async for chunk in request.stream():
+        # 未遇到换行的片段先暂存，凑齐一行再拼接，避免长行反复拷贝
+        *lines, tail = chunk.split(b"\n")
+        if lines:
+            lines[0] = b"".join(pending + [lines[0]])
+            pending = []
+        pending.append(tail)
+        for line in lines:
+            line_no += 1
+            if line.strip():
+                parse(line)
+    last = b"".join(pending)
+    if last.strip():
+        line_no += 1
+        parse(last)
+    return items
+
+
+async def _read_job_items(request, item_schema, job_schema):
+    """作业请求体：{"items": [...]}，或 Content-Type 为 application/x-ndjson 时每行一项"""
+    if "ndjson" in request.headers.get("content-type", ""):
+        return await _read_ndjson(request, item_schema)
+    try:
+        return job_schema.model_validate_json(await request.body()).items
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+def _get_job(job_id, kind):
+    job = job_store.get(job_id)
+    if job is None or job["kind"] != kind:
+        raise HTTPException(status_code=404, detail="作业不存在")
+    return job
+
+
+@router.post("/refund-jobs", response_model=JobStatusSchema, status_code=202, summary="创建批量退款作业")
+async def create_refund_job(request: Request, merchant_id: Optional[str] = Query(None, description="商户 ID，按商户配置选择 Stripe 账户；为空时使用默认账户")):
+    """
+    提交大批量退款，立即返回作业 ID，由后台 worker 以限速并发执行。
+
+    - **merchant_id**: 查询参数，作业内全部退款所属的商户
+    - 请求体为 {"items": [RefundRequestSchema, ...]}，或 Content-Type 为 application/x-ndjson 时每行一个退款请求
+    - 进度逐项持久化；服务重启后自动续跑，external_refund_id 已完成的退款不会重复执行
+    - GET /refund-jobs/{job_id} 查询进度，GET /refund-jobs/{job_id}/results 以 NDJSON 流式返回逐项结果
+    """
+    items = await _read_job_items(request, RefundRequestSchema, RefundJobRequestSchema)
+    if not items:
+        raise HTTPException(status_code=400, detail="退款列表不能为空")
+    _gateway_for(merchant_id)
+
+    extra = {"merchant_id": merchant_id} if merchant_id is not None else {}
+    job_id = await job_runner.submit(JOB_KIND_REFUND, [(merchants.scoped_key(merchant_id, item.external_refund_id),
+                                                        dict(item.model_dump(), **extra)) for item in items])
+    logger.info("Refund job created: %s, items: %d", job_id, len(items),
+                extra={"event": "refund_job.created", "job_id": job_id})
+    return JobStatusSchema(**job_store.get(job_id))
+
+
+@router.get("/refund-jobs/{job_id}", response_model=JobStatusSchema, summary="查询批量退款作业进度")
+async def get_refund_job(job_id: str):
+    return JobStatusSchema(**_get_job(job_id, JOB_KIND_REFUND))
+
+
+@router.get("/refund-jobs/{job_id}/results", summary="流式获取批量退款逐项结果")
+async def stream_refund_job_results(job_id: str):
+    """按完成顺序输出 NDJSON，每行包含 seq（原始顺序）与 RefundResponseSchema 字段，作业完成后结束"""
+    _get_job(job_id, JOB_KIND_REFUND)
+    return StreamingResponse(job_runner.stream_results(job_id), media_type="application/x-ndjson")
+
+
+def _json_response(model, **dump_options):
+    # 由 pydantic-core 直接序列化，跳过 response_model 的二次校验与 jsonable_encoder
+    return Response(content=model.model_dump_json(**dump_options), media_type="application/json")
 
 
 # 查询支付详情接口
-@app.get("/payment/{payment_id}", response_model=PaymentDetailsResponseSchema, summary="查询支付详情")
-async def get_payment_details(payment_id: str):
+@router.get("/payment/{payment_id}", response_model=PaymentDetailsResponseSchema, summary="查询支付详情",
+         responses={200: {"model": Union[PaymentDetailsResponseSchema, PaymentDetailsSummarySchema]}})
+async def get_payment_details(payment_id: str, fields: Optional[str] = Query(
+        None, description="只返回所选字段，逗号分隔，如 status,amount,refunds；"
+                          "charges、refunds、payment_method 以精简摘要返回"),
+                              merchant_id: Optional[str] = Query(None, description="商户 ID，按商户配置选择 Stripe 账户；为空时使用默认账户")):
     """
     :param payment_id: 示例：pi_3QxN7c2KnFw7QuKu1CW304Ak
+    :param fields: 稀疏字段集；指定后只向 Stripe 请求这些字段需要的展开对象
+    :param merchant_id: 支付所属商户，本地台账未命中时以该商户的账户查询 Stripe
     :return:
     """
     try:
-        payment_intent = stripe.PaymentIntent.retrieve(
-            payment_id,
-            stripe_account=account_id,
-            expand=['charges.data', 'payment_method']
-        )
-
-        charges = []
-        refunds = []
-        if hasattr(payment_intent, 'charges') and payment_intent.charges and payment_intent.charges.data:
-            charges = [charge.to_dict() for charge in payment_intent.charges.data]
-            for charge in payment_intent.charges.data:
-                if hasattr(charge, 'refunds') and charge.refunds and charge.refunds.data:
-                    refunds.extend([refund.to_dict() for refund in charge.refunds.data])
-        else:
-            logger.warning(f"No charges data found for PaymentIntent: {payment_id}")
+        selected = parse_fields(fields) if fields is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    merchant_gateway = _gateway_for(merchant_id)
+    scope = _merchant_scope(merchant_id)
 
-        payment_method_details = {}
-        if hasattr(payment_intent, 'payment_method') and payment_intent.payment_method:
-            payment_method = payment_intent.payment_method if isinstance(payment_intent.payment_method,
-                                                                         dict) else payment_intent.payment_method.to_dict()
-            payment_method_details = payment_method
-        else:
-            logger.warning(f"No payment_method available for PaymentIntent: {payment_id}")
+    try:
+        # 3DS 流程中前端与订单服务会同时轮询同一笔支付，台账未命中时的并发请求只向 Stripe 发起一次；
+        # 台账与合并键都按商户隔离，其他商户的缓存不会命中，也不会合并到其他商户的网关上
+        if selected is not None:
+            summary = await reads.do(("payment_details", scope, payment_id, selected),
+                                     lambda: ledger.summary(merchant_gateway, payment_id, selected, scope))
+            return _json_response(summary, exclude_unset=True)
 
-        logger.info(f"Payment details retrieved: {payment_intent.id}")
-        return PaymentDetailsResponseSchema(
-            channel_order_id=payment_intent.id,
-            status=payment_intent.status,
-            amount=payment_intent.amount,
-            currency=payment_intent.currency,
-            metadata=payment_intent.metadata,
-            payment_method=payment_method_details,
-            created=payment_intent.created,
-            charges=charges,
-            refunds=refunds
-        )
+        details = await asyncio.to_thread(ledger.get, payment_id, scope)
+        if details is None:
+            details = await reads.do(("payment_details", scope, payment_id),
+                                     lambda: ledger.refresh(merchant_gateway, payment_id, scope))
+            logger.info("Payment details retrieved: %s", details.channel_order_id,
+                        extra={"event": "payment.details", "payment_id": details.channel_order_id,
+                               "status": details.status})
+        return _json_response(details)
 
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe Error retrieving payment: {str(e)}")
+        logger.error("Stripe Error retrieving payment: %s", e,
+                     extra={"event": "payment.details_failed", "payment_id": payment_id, "error": type(e).__name__})
         raise HTTPException(status_code=400, detail=f"Stripe 错误: {str(e)}")
     except Exception as e:
-        logger.error(f"Unexpected Error: {str(e)}")
+        logger.error("Unexpected Error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
 
 
-@app.get("/card-payments/{payment_method_id}", response_model=CardPaymentsResponseSchema,
+def _merchant_scope(merchant_id):
+    """
+    本地台账与卡索引的隔离范围（含卡索引的补齐进度）：已配置的商户各自一份（各自的 Stripe 账户），
+    其余商户共用默认账户的一份；严格模式下未配置的商户返回 400
+    """
+    _gateway_for(merchant_id)
+    return merchants.scope(merchant_id)
+
+
+@router.post("/card-payments/sync", summary="补齐卡 -> 支付订单索引")
+async def sync_card_payments(request: Request, merchant_id: Optional[str] = Query(None, description="商户 ID，补齐该商户 Stripe 账户下的支付；为空时为默认账户")):
+    """
+    在后台分页遍历账户下的全部 Charge 并写入本地索引；可重复调用，中断后从上次进度继续。
+    """
+    merchant_gateway = _gateway_for(merchant_id)
+    scope = _merchant_scope(merchant_id)
+    tasks = getattr(request.app.state, "card_index_sync", None)
+    if tasks is None:
+        tasks = request.app.state.card_index_sync = {}
+    task = tasks.get(scope)
+    if task is None or task.done():
+        tasks[scope] = asyncio.create_task(card_index.backfill(merchant_gateway, scope=scope))
+        return {"status": "started"}
+    return {"status": "running"}
+
+
+async def _load_card_payments(payment_method_id, limit, starting_after, merchant_id):
+    """索引补齐后读本地索引，否则扫描最近 100 条 Charge"""
+    merchant_gateway = _gateway_for(merchant_id)
+    scope = _merchant_scope(merchant_id)
+    if card_index.is_backfilled(scope):
+        payments, has_more = card_index.list(payment_method_id, limit=limit, starting_after=starting_after,
+                                             scope=scope)
+        if not payments and not starting_after:
+            # 本地无记录时确认 PaymentMethod 存在，未知的卡仍返回 400
+            await merchant_gateway.retrieve_payment_method(payment_method_id)
+        logger.info("Retrieved %d indexed payments for PaymentMethod: %s", len(payments), payment_method_id,
+                    extra={"event": "card_payments.retrieved", "source": "index"})
+        return CardPaymentsResponseSchema(
+            payments=payments,
+            has_more=has_more,
+            next_cursor=payments[-1]["channel_order_id"] if has_more else None,
+        )
+
+    # 验证 PaymentMethod 存在
+    await merchant_gateway.retrieve_payment_method(payment_method_id)
+
+    # 查询所有 Charge（无法直接按 payment_method 过滤）
+    charges = await merchant_gateway.list_charges(
+        limit=100,  # 可调整分页大小
+        expand=['data.payment_intent']  # 扩展 PaymentIntent 数据
+    )
+
+    payments = []
+    seen_intents = set()  # 避免重复
+    for charge in charges.data:
+        if charge.payment_method == payment_method_id and charge.payment_intent and charge.payment_intent.id not in seen_intents:
+            payments.append(payment_summary(charge.payment_intent, [charge.to_dict()]))
+            seen_intents.add(charge.payment_intent.id)
+    await asyncio.to_thread(card_index.add_many, [(payment_method_id, payment) for payment in payments], scope)
+
+    logger.info("Retrieved %d payments for PaymentMethod: %s", len(payments), payment_method_id,
+                extra={"event": "card_payments.retrieved", "source": "stripe"})
+    return CardPaymentsResponseSchema(payments=payments)
+
+
+@router.get("/card-payments/{payment_method_id}", response_model=CardPaymentsResponseSchema,
          summary="查询此卡的所有支付订单")
-async def get_card_payments(payment_method_id: str):
+async def get_card_payments(payment_method_id: str,
+                            limit: int = Query(100, ge=1, le=100, description="每页条数"),
+                            starting_after: Optional[str] = Query(None, description="上一页最后一条的 channel_order_id"),
+                            merchant_id: Optional[str] = Query(None, description="商户 ID，卡由商户的 Stripe 账户创建时必须提供")):
     """
     查询指定支付卡的所有支付订单。
 
     - **payment_method_id**: PaymentMethod ID (例如 'pm_1QxN7b2KnFw7QuKuaeU7hPeN')
+    - **merchant_id**: 按商户配置选择 Stripe 账户；为空时使用默认账户
+    - **limit** / **starting_after**: 游标分页，返回的 next_cursor 即下一页的 starting_after
+
+    历史数据补齐（POST /card-payments/sync）完成后直接从本地索引返回；
+    补齐完成前回退为扫描最近 100 条 Charge，并把扫描结果写入索引。
     """
+    # 在 try 之外解析商户，严格模式下未配置的商户返回 400 而不是 500
+    _gateway_for(merchant_id)
     try:
-        # 验证 PaymentMethod 存在
-        stripe.PaymentMethod.retrieve(payment_method_id, stripe_account=account_id)
-
-        # 查询所有 Charge（无法直接按 payment_method 过滤）
-        charges = stripe.Charge.list(
-            stripe_account=account_id,
-            limit=100,  # 可调整分页大小
-            expand=['data.payment_intent']  # 扩展 PaymentIntent 数据
-        )
-
-        payments = []
-        seen_intents = set()  # 避免重复
-        for charge in charges.data:
-            if charge.payment_method == payment_method_id and charge.payment_intent and charge.payment_intent.id not in seen_intents:
-                intent = charge.payment_intent
-                payments.append({
-                    "channel_order_id": intent.id,
-                    "status": intent.status,
-                    "amount": intent.amount,
-                    "currency": intent.currency,
-                    "created": intent.created,
-                    "metadata": intent.metadata,
-                    "charges": [charge.to_dict()]
-                })
-                seen_intents.add(intent.id)
-
-        logger.info(f"Retrieved {len(payments)} payments for PaymentMethod: {payment_method_id}")
-        return CardPaymentsResponseSchema(payments=payments)
-
+        # 同一张卡、同一页的并发查询共享一次加载
+        return await reads.do(("card_payments", payment_method_id, limit, starting_after, merchant_id),
+                              lambda: _load_card_payments(payment_method_id, limit, starting_after, merchant_id))
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe Error retrieving card payments: {str(e)}")
+        logger.error("Stripe Error retrieving card payments: %s", e,
+                     extra={"event": "card_payments.failed", "error": type(e).__name__})
         raise HTTPException(status_code=400, detail=f"Stripe 错误: {str(e)}")
     except Exception as e:
-        logger.error(f"Unexpected Error: {str(e)}")
+        logger.error("Unexpected Error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
 
 
-@app.post("/cancel-payment/{payment_id}", response_model=ChannelPaymentResponseSchema, summary="取消支付")
-async def cancel_payment(payment_id: str):
+async def _stream_export(pages, export_format, columns, name):
+    from backend import exports
+
+    # 预取第一页：游标无效、Stripe 报错等问题在响应开始前以 400 返回
+    try:
+        first_page = await anext(pages, [])
+    except stripe.error.StripeError as e:
+        logger.error("Stripe Error exporting %s: %s", name, e, extra={"event": "export.failed", "error": type(e).__name__})
+        raise HTTPException(status_code=400, detail=f"Stripe 错误: {str(e)}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(
+        exports.encode_pages(first_page, pages, export_format, columns),
+        media_type=exports.MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{export_format}"'},
+    )
+
+
+@router.get("/exports/payments", summary="流式导出支付订单")
+async def export_payments(export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+                          created_gte: Optional[int] = Query(None, description="创建时间下限（含），Unix 时间戳"),
+                          created_lt: Optional[int] = Query(None, description="创建时间上限（不含），Unix 时间戳"),
+                          merchant_id: Optional[str] = Query(None, description="按 metadata.merchant_id 过滤"),
+                          status: Optional[str] = Query(None, description="按 PaymentIntent 状态过滤，如 succeeded"),
+                          starting_after: Optional[str] = Query(None, description="续传游标：上次收到的最后一个 id"),
+                          source: Literal["stripe", "local"] = Query("stripe", description="数据来源")):
+    """
+    按创建时间倒序导出全部支付订单，逐页请求、逐页输出，内存占用与结果规模无关。
+
+    - **source=stripe**: 自动翻页遍历 PaymentIntent 列表；指定 merchant_id 时遍历该商户的 Stripe 账户
+    - **source=local**: 读取本地卡 -> 支付订单索引（需先完成 POST /card-payments/sync），不消耗 Stripe 配额
+
+    传输中断时，以已收到的最后一行的 id 作为 starting_after 重新请求即可续传。
+    """
+    # 导出与对账只在离线任务中使用，按需导入，不计入服务启动时间
+    from backend import exports
+
+    filters = exports.ExportFilter(created_gte, created_lt, merchant_id, status)
+    if source == "local":
+        if not card_index.is_backfilled(_merchant_scope(merchant_id)):
+            raise HTTPException(status_code=400, detail="本地索引尚未补齐，请先调用 POST /card-payments/sync")
+        pages = exports.local_payment_pages(card_index, filters, starting_after)
+    else:
+        pages = exports.payment_pages(_gateway_for(merchant_id), filters, starting_after)
+    return await _stream_export(pages, export_format, exports.PAYMENT_COLUMNS, "payments")
+
+
+@router.get("/exports/refunds", summary="流式导出退款")
+async def export_refunds(export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+                         created_gte: Optional[int] = Query(None, description="创建时间下限（含），Unix 时间戳"),
+                         created_lt: Optional[int] = Query(None, description="创建时间上限（不含），Unix 时间戳"),
+                         merchant_id: Optional[str] = Query(None, description="按原支付的 metadata.merchant_id 过滤"),
+                         status: Optional[str] = Query(None, description="按退款状态过滤，如 succeeded"),
+                         starting_after: Optional[str] = Query(None, description="续传游标：上次收到的最后一个 id")):
+    """
+    按创建时间倒序导出全部退款，自动翻页遍历 Refund 列表（展开原 PaymentIntent 以读取 merchant_id）；
+    指定 merchant_id 时遍历该商户的 Stripe 账户。
+
+    传输中断时，以已收到的最后一行的 id 作为 starting_after 重新请求即可续传。
+    """
+    from backend import exports
+
+    filters = exports.ExportFilter(created_gte, created_lt, merchant_id, status)
+    pages = exports.refund_pages(_gateway_for(merchant_id), filters, starting_after)
+    return await _stream_export(pages, export_format, exports.REFUND_COLUMNS, "refunds")
+
+
+@router.post("/reconciliation", summary="订单文件与 Stripe 对账")
+async def reconcile_orders(request: Request,
+                           created_gte: int = Query(..., description="窗口起点（含），Unix 时间戳"),
+                           created_lt: int = Query(..., description="窗口终点（不含），Unix 时间戳"),
+                           key: Literal["external_request_order_id", "system_order_id", "merchant_order_id"] = Query(
+                               "external_request_order_id", description="关联键，对应 PaymentIntent metadata"),
+                           merchant_id: Optional[str] = Query(None, description="只对账该商户的支付"),
+                           max_items: Optional[int] = Query(None, ge=0,
+                                                            description="每类差异明细条数上限，默认 STRIPE_RECONCILE_MAX_ITEMS")):
+    """
+    请求体为订单 CSV（text/csv）：关联键列与 amount（最小货币单位）必填，
+    可选 currency、refunded_amount、merchant_id（有此列时按 (merchant_id, 关联键) 匹配）。
+
+    拉取窗口内全部 PaymentIntent 与窗口起点之后的全部 Refund，返回汇总计数与各类差异明细：
+    missing、unexpected、duplicated、amount_mismatch、refund_mismatch。
+    订单文件应与窗口覆盖同一时间段，否则窗口外的订单会被报告为 missing。
+    指定 merchant_id 时拉取该商户的 Stripe 账户下的支付与退款。
+    """
+    from backend import reconcile
+
+    if max_items is None:
+        max_items = reconcile.RECONCILE_MAX_ITEMS
+    merchant_gateway = _gateway_for(merchant_id)
+    # 订单文件可能有数百万行：逐块写入临时文件（超过 RECONCILE_SPOOL_SIZE 才落盘），不在内存中整体缓冲；
+    # 解析与关联在线程中进行，不阻塞事件循环
+    with tempfile.SpooledTemporaryFile(max_size=reconcile.RECONCILE_SPOOL_SIZE) as upload:
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.seek(0)
+        try:
+            lines = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")
+            return await reconcile.run(merchant_gateway, lines, key, created_gte, created_lt, merchant_id, max_items)
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="订单文件必须为 UTF-8 编码")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except stripe.error.StripeError as e:
+            logger.error("Stripe Error during reconciliation: %s", e,
+                         extra={"event": "reconciliation.failed", "error": type(e).__name__})
+            raise HTTPException(status_code=400, detail=f"Stripe 错误: {str(e)}")
+
+
+@router.post("/webhooks/stripe", summary="接收 Stripe Webhook 事件")
+async def receive_stripe_webhook(request: Request):
+    """
+    校验 Stripe-Signature 后立即确认，事件按 ID 去重并交给后台 worker 异步处理，
+    处理结果写入本地台账，使 GET /payment/{payment_id} 无需轮询 Stripe。
+    """
+    payload = await request.body()
+    try:
+        event_id, duplicate = await webhook_processor.receive(payload, request.headers.get("Stripe-Signature"))
+    except WebhookSignatureError as e:
+        logger.warning("Webhook signature verification failed: %s", e, extra={"event": "webhook.bad_signature"})
+        raise HTTPException(status_code=400, detail=f"签名校验失败: {str(e)}")
+    except (ValueError, KeyError) as e:
+        logger.warning("Invalid webhook payload: %s", e, extra={"event": "webhook.invalid_payload"})
+        raise HTTPException(status_code=400, detail=f"无效的事件内容: {str(e)}")
+    return {"received": True, "event_id": event_id, "duplicate": duplicate}
+
+
+@router.post("/webhooks/stripe/replay", summary="重新处理已接收的 Webhook 事件")
+async def replay_stripe_webhooks(event_id: Optional[str] = Query(None, description="只回放指定事件"),
+                                 since: Optional[int] = Query(None, description="回放该时间戳之后创建的事件"),
+                                 event_type: Optional[str] = Query(None, description="只回放指定类型的事件")):
+    return {"queued": webhook_processor.replay(event_id=event_id, since=since, event_type=event_type)}
+
+
+@router.get("/webhooks/stats", summary="查询 Webhook 处理统计")
+async def get_webhook_stats():
+    return webhook_processor.stats()
+
+
+# 扣款 / 撤销后 PaymentIntent 应处的状态；作业续跑时重复执行的项据此识别为已完成
+_SETTLED_STATUS = {"capture": "succeeded", "cancel": "canceled"}
+
+
+async def _settle_payment_intent(merchant_gateway, payment_id, action, params, resume=False):
+    """
+    对 PaymentIntent 执行扣款（capture）或撤销（cancel），并刷新本地台账与卡索引。
+    resume 为真时（批量作业），Stripe 因状态不符拒绝、而 PaymentIntent 已处于目标状态的项视为已完成：
+    崩溃前已提交的项在续跑时会再执行一次，同一作业中重复的 PaymentIntent 也按此处理。
+    """
+    operation = merchant_gateway.capture_payment_intent if action == "capture" else merchant_gateway.cancel_payment_intent
+    try:
+        payment_intent = await operation(payment_id, **params)
+    except stripe.error.InvalidRequestError:
+        if not resume:
+            raise
+        payment_intent = await merchant_gateway.retrieve_payment_intent(payment_id)
+        if payment_intent.status != _SETTLED_STATUS[action]:
+            raise
+    await asyncio.to_thread(ledger.invalidate, payment_id)
+    await asyncio.to_thread(card_index.update_status, payment_id, payment_intent.status)
+    counters.inc("payment.outcomes", operation=f"{action}_payment", status=payment_intent.status)
+    return payment_intent
+
+
+def _capture_params(item):
+    return {"amount_to_capture": item.amount_to_capture} if item.amount_to_capture is not None else {}
+
+
+def _capture_response(payment_intent):
+    return CaptureResponseSchema(channel_order_id=payment_intent.id, status=payment_intent.status,
+                                 amount_captured=payment_intent.get("amount_received"))
+
+
+@router.post("/cancel-payment/{payment_id}", response_model=ChannelPaymentResponseSchema, summary="取消支付")
+async def cancel_payment(payment_id: str, merchant_id: Optional[str] = Query(None, description="商户 ID，按商户配置选择 Stripe 账户；为空时使用默认账户")):
     """
     取消未完成的支付。
     测试取消支付接口需要先发起一个支付，然后在支付未完成如状态为
     requires_action、requires_payment_method 或 requires_confirmation时取消它
     使用需要 3DS 验证的测试卡，以确保支付状态停留在 requires_action，而不是立即 succeeded。
+    手动扣款模式下状态为 requires_capture 的支付取消即撤销授权。
     - **payment_id**: PaymentIntent ID (例如 'pi_xxx')
+    - **merchant_id**: 查询参数，支付所属商户
     """
+    merchant_gateway = _gateway_for(merchant_id)
     try:
-        payment_intent = stripe.PaymentIntent.cancel(payment_id=payment_id, stripe_account=account_id)
-        logger.info(f"Payment canceled: {payment_id}")
+        payment_intent = await _settle_payment_intent(merchant_gateway, payment_id, "cancel", {})
+        logger.info("Payment canceled: %s", payment_id,
+                    extra={"event": "payment.canceled", "payment_id": payment_id, "status": payment_intent.status})
         return ChannelPaymentResponseSchema(
             channel_order_id=payment_intent.id,
             status=payment_intent.status,  # 通常为 "canceled"
@@ -422,11 +1273,164 @@ async def cancel_payment(payment_id: str):
             detail=None
         )
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe Error: {str(e)}")
+        logger.error("Stripe Error: %s", e,
+                     extra={"event": "payment.cancel_failed", "payment_id": payment_id, "error": type(e).__name__})
         raise HTTPException(status_code=400, detail=f"Stripe 错误: {str(e)}")
 
 
-if __name__ == "__main__":
+@router.post("/capture-payment/{payment_id}", response_model=CaptureResponseSchema, summary="扣款（手动扣款模式）")
+async def capture_payment(payment_id: str,
+                          amount_to_capture: Optional[int] = Query(None, gt=0, description="扣款金额（单位：分），为空则全额扣款"),
+                          merchant_id: Optional[str] = Query(None, description="商户 ID，按商户配置选择 Stripe 账户；为空时使用默认账户")):
+    """
+    对只授权的支付（STRIPE_CAPTURE_METHOD 为 manual 或 physical 时创建，状态 requires_capture）扣款，
+    通常在发货时调用；部分扣款后剩余的授权金额自动释放。
+    - **payment_id**: PaymentIntent ID
+    - **amount_to_capture**: 查询参数，扣款金额，不超过授权金额
+    - **merchant_id**: 查询参数，支付所属商户
+    """
+    merchant_gateway = _gateway_for(merchant_id)
+    params = {"amount_to_capture": amount_to_capture} if amount_to_capture is not None else {}
+    try:
+        payment_intent = await _settle_payment_intent(merchant_gateway, payment_id, "capture", params)
+    except stripe.error.StripeError as e:
+        logger.error("Stripe Error: %s", e,
+                     extra={"event": "payment.capture_failed", "payment_id": payment_id, "error": type(e).__name__})
+        raise HTTPException(status_code=400, detail=f"Stripe 错误: {str(e)}")
+    logger.info("Payment captured: %s", payment_id,
+                extra={"event": "payment.captured", "payment_id": payment_id, "status": payment_intent.status})
+    return _capture_response(payment_intent)
+
+
+async def _capture_job_item(payload):
+    item = CaptureRequestSchema(**payload)
+    merchant_gateway = _gateway_for(payload.get("merchant_id"))
+    try:
+        payment_intent = await _settle_payment_intent(merchant_gateway, item.channel_order_id, "capture",
+                                                      _capture_params(item), resume=True)
+    except stripe.error.StripeError as e:
+        return CaptureResponseSchema(channel_order_id=item.channel_order_id, status=GatewayPaymentStatus.FAILED,
+                                     detail={"message": f"Stripe 错误: {str(e)}"}).model_dump()
+    return _capture_response(payment_intent).model_dump()
+
+
+async def _cancel_job_item(payload):
+    item = CancelRequestSchema(**payload)
+    merchant_gateway = _gateway_for(payload.get("merchant_id"))
+    params = {"cancellation_reason": item.cancellation_reason} if item.cancellation_reason else {}
+    try:
+        payment_intent = await _settle_payment_intent(merchant_gateway, item.channel_order_id, "cancel", params,
+                                                      resume=True)
+    except stripe.error.StripeError as e:
+        return ChannelPaymentResponseSchema(channel_order_id=item.channel_order_id, status=GatewayPaymentStatus.FAILED,
+                                            detail={"message": f"Stripe 错误: {str(e)}"}).model_dump()
+    return ChannelPaymentResponseSchema(channel_order_id=payment_intent.id, status=payment_intent.status).model_dump()
+
+
+async def _submit_payment_job(kind, items, merchant_id):
+    _gateway_for(merchant_id)
+    extra = {"merchant_id": merchant_id} if merchant_id is not None else {}
+    # 不按 PaymentIntent 跨作业复用结果：上一次失败（如尚未完成 3DS）的支付再次提交时应重新执行
+    job_id = await job_runner.submit(kind, [(None, dict(item.model_dump(), **extra)) for item in items])
+    logger.info("%s job created: %s, items: %d", kind.capitalize(), job_id, len(items),
+                extra={"event": f"{kind}_job.created", "job_id": job_id})
+    return JobStatusSchema(**job_store.get(job_id))
+
+
+@router.post("/capture-jobs", response_model=JobStatusSchema, status_code=202, summary="创建批量扣款作业")
+async def create_capture_job(request: Request, merchant_id: Optional[str] = Query(None, description="商户 ID，按商户配置选择 Stripe 账户；为空时使用默认账户")):
+    """
+    提交一批发货后的扣款（如仓库的发货批次），立即返回作业 ID，由后台 worker 以限速并发执行。
+
+    - **merchant_id**: 查询参数，作业内全部支付所属的商户
+    - 请求体为 {"items": [CaptureRequestSchema, ...]}，或 Content-Type 为 application/x-ndjson 时每行一项；
+      amount_to_capture 可按实际发货金额部分扣款
+    - 进度逐项持久化；服务重启后自动续跑，崩溃前已扣款的项不会重复扣款
+    - GET /capture-jobs/{job_id} 查询进度，GET /capture-jobs/{job_id}/results 以 NDJSON 流式返回逐项结果
+    """
+    items = await _read_job_items(request, CaptureRequestSchema, CaptureJobRequestSchema)
+    if not items:
+        raise HTTPException(status_code=400, detail="扣款列表不能为空")
+    return await _submit_payment_job(JOB_KIND_CAPTURE, items, merchant_id)
+
+
+@router.get("/capture-jobs/{job_id}", response_model=JobStatusSchema, summary="查询批量扣款作业进度")
+async def get_capture_job(job_id: str):
+    return JobStatusSchema(**_get_job(job_id, JOB_KIND_CAPTURE))
+
+
+@router.get("/capture-jobs/{job_id}/results", summary="流式获取批量扣款逐项结果")
+async def stream_capture_job_results(job_id: str):
+    """按完成顺序输出 NDJSON，每行包含 seq（原始顺序）与 CaptureResponseSchema 字段，作业完成后结束"""
+    _get_job(job_id, JOB_KIND_CAPTURE)
+    return StreamingResponse(job_runner.stream_results(job_id), media_type="application/x-ndjson")
+
+
+@router.post("/cancel-jobs", response_model=JobStatusSchema, status_code=202, summary="创建批量撤销作业")
+async def create_cancel_job(request: Request, merchant_id: Optional[str] = Query(None, description="商户 ID，按商户配置选择 Stripe 账户；为空时使用默认账户")):
+    """
+    批量取消未完成的支付或撤销授权（如缺货取消的订单），语义与 /capture-jobs 相同。
+
+    - 请求体为 {"items": [CancelRequestSchema, ...]}，或 Content-Type 为 application/x-ndjson 时每行一项
+    - GET /cancel-jobs/{job_id} 查询进度，GET /cancel-jobs/{job_id}/results 流式返回逐项结果
+    """
+    items = await _read_job_items(request, CancelRequestSchema, CancelJobRequestSchema)
+    if not items:
+        raise HTTPException(status_code=400, detail="撤销列表不能为空")
+    return await _submit_payment_job(JOB_KIND_CANCEL, items, merchant_id)
+
+
+@router.get("/cancel-jobs/{job_id}", response_model=JobStatusSchema, summary="查询批量撤销作业进度")
+async def get_cancel_job(job_id: str):
+    return JobStatusSchema(**_get_job(job_id, JOB_KIND_CANCEL))
+
+
+@router.get("/cancel-jobs/{job_id}/results", summary="流式获取批量撤销逐项结果")
+async def stream_cancel_job_results(job_id: str):
+    """按完成顺序输出 NDJSON，每行包含 seq（原始顺序）与 ChannelPaymentResponseSchema 字段，作业完成后结束"""
+    _get_job(job_id, JOB_KIND_CANCEL)
+    return StreamingResponse(job_runner.stream_results(job_id), media_type="application/x-ndjson")
+
+
+def serve(host="127.0.0.1", port=8001, workers=1):
+    """
+    启动服务。workers 大于 1 时预先绑定监听 socket，由 uvicorn 的进程管理器派生 workers 个进程共同 accept，
+    每个进程通过 create_app 工厂各自创建应用与服务对象，进程之间经由共享状态后端协作。
+    """
+    import socket
+
     import uvicorn
+    from uvicorn.supervisors import Multiprocess
+
+    config = uvicorn.Config("backend.test_payment:create_app", factory=True, host=host, port=port, workers=workers)
+    server = uvicorn.Server(config)
+    if workers == 1:
+        server.run()
+        return
+    # 显式使用 getaddrinfo 返回的 proto（IPPROTO_TCP）：asyncio 只为 proto 为 TCP 的连接开启 TCP_NODELAY，
+    # uvicorn 多进程模式自行绑定的 socket proto 为 0，小响应会被 Nagle 算法与延迟 ACK 拖慢约 40ms
+    family, sock_type, proto, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, sock_type, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.set_inheritable(True)
+    Multiprocess(config, target=server.run, sockets=[sock]).run()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="启动支付服务")
+    parser.add_argument("--host", default=os.getenv("STRIPE_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("STRIPE_PORT", "8001")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("STRIPE_WORKERS", "1")),
+                        help="worker 进程数，大于 1 时默认使用 SQLite 共享状态后端")
+    args = parser.parse_args()
 
-    uvicorn.run(app, host="127.0.0.1", port=8001)
+    if args.workers > 1:
+        # worker 进程通过环境变量继承状态后端配置
+        os.environ.setdefault("STRIPE_STATE_BACKEND", shared_state.STATE_SQLITE)
+        if os.environ["STRIPE_STATE_BACKEND"] == shared_state.STATE_MEMORY:
+            logger.warning("STRIPE_STATE_BACKEND=memory with multiple workers: "
+                           "caches, idempotency claims and rate limits are per process")
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,262 @@
+# Stripe HTTP 传输层 - 按密钥与连接账户维护长连接池，复用 TLS 连接
+import asyncio
+import functools
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ClosedPoolError, EmptyPoolError
+from urllib3.util.connection import is_connection_dropped
+
+# Stripe 密钥的类型前缀：密钥种类（secret / restricted / publishable）与模式
+_KEY_PREFIX = re.compile(r"^(?:sk|rk|pk)_(?:live|test)_")
+
+
+class PoolStats:
+    """单个连接池的统计信息，用于调优池大小"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hits = 0
+        self.new_connections = 0
+        self.dropped_connections = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def record_checkout(self, reused, dropped, waited):
+        with self._lock:
+            self.requests += 1
+            if reused:
+                self.hits += 1
+            if dropped:
+                self.dropped_connections += 1
+            self.wait_time_total += waited
+            if waited > self.wait_time_max:
+                self.wait_time_max = waited
+
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hits": self.hits,
+                "new_connections": self.new_connections,
+                "dropped_connections": self.dropped_connections,
+                "wait_time_total_ms": round(self.wait_time_total * 1000, 3),
+                "wait_time_max_ms": round(self.wait_time_max * 1000, 3),
+                "wait_time_avg_ms": round(self.wait_time_total * 1000 / self.requests, 3) if self.requests else 0.0,
+            }
+
+
+class _InstrumentedPoolMixin:
+    """统计连接获取的等待时间、复用次数与新建连接数"""
+    stats: PoolStats
+
+    def _get_conn(self, timeout=None):
+        conn = None
+        start = time.perf_counter()
+        try:
+            conn = self.pool.get(block=self.block, timeout=timeout)
+        except AttributeError:
+            raise ClosedPoolError(self, "Pool is closed.") from None
+        except queue.Empty:
+            if self.block:
+                raise EmptyPoolError(self, "Pool is empty and a new connection can't be opened.") from None
+        waited = time.perf_counter() - start
+        # pool 中预先填充的是 None 占位符，真正的连接对象才算复用
+        dropped = bool(conn) and is_connection_dropped(conn)
+        if dropped:
+            conn.close()
+        self.stats.record_checkout(reused=bool(conn) and not dropped, dropped=dropped, waited=waited)
+        return conn or self._new_conn()
+
+    def _new_conn(self):
+        self.stats.record_new_connection()
+        return super()._new_conn()
+
+
+def _instrumented_pool_classes(stats):
+    return {
+        "http": type("InstrumentedHTTPConnectionPool", (_InstrumentedPoolMixin, HTTPConnectionPool), {"stats": stats}),
+        "https": type("InstrumentedHTTPSConnectionPool", (_InstrumentedPoolMixin, HTTPSConnectionPool), {"stats": stats}),
+    }
+
+
+class ConnectionPool:
+    """绑定到 (secret key, connected account) 的一组长连接"""
+
+    def __init__(self, pool_size):
+        self.stats = PoolStats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        adapter.poolmanager.pool_classes_by_scheme = _instrumented_pool_classes(self.stats)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.healthy = True
+
+    def close(self):
+        self.session.close()
+
+
+def _mask(secret):
+    """统计接口无需鉴权，只显示密钥类型前缀（如 sk_live_、rk_test_）与末 4 位"""
+    if not secret:
+        return "<none>"
+    prefix = _KEY_PREFIX.match(secret)
+    prefix = prefix.group(0) if prefix else ""
+    return f"{prefix}...{secret[-4:]}" if len(secret) - len(prefix) > 12 else f"{prefix}***"
+
+
+class PooledTransport(stripe.http_client.RequestsClient):
+    """
+    替换 stripe.default_http_client 的 HTTP 客户端。
+
+    SDK 的每次请求都会在请求头中带上密钥（Authorization）与连接账户（Stripe-Account），
+    这里据此路由到对应的长连接池，使多商户部署下同一账户的请求复用已建立的 TLS 连接。
+
+    - **pool_size**: 每个池的最大连接数，连接全部被占用时请求会排队等待
+    - **idle_timeout**: 连接池空闲超过该秒数后被回收
+    - **timeout**: 单次 HTTP 请求超时时间（秒）
+    """
+    name = "pooled-requests"
+
+    def __init__(self, pool_size=32, idle_timeout=300.0, timeout=80, **kwargs):
+        super().__init__(timeout=timeout, **kwargs)
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            pool_size=int(os.getenv("STRIPE_POOL_SIZE", os.getenv("STRIPE_MAX_WORKERS", "32"))),
+            idle_timeout=float(os.getenv("STRIPE_POOL_IDLE_TIMEOUT", "300")),
+            timeout=float(os.getenv("STRIPE_HTTP_TIMEOUT", "80")),
+        )
+
+    @staticmethod
+    def _pool_key(headers):
+        authorization = headers.get("Authorization", "")
+        secret = authorization[7:] if authorization.startswith("Bearer ") else authorization
+        return secret, headers.get("Stripe-Account")
+
+    def get_pool(self, key):
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = ConnectionPool(self.pool_size)
+        pool.last_used = time.monotonic()
+        return pool
+
+    def _request_internal(self, method, url, headers, post_data, is_streaming):
+        kwargs = {"verify": stripe.ca_bundle_path if self._verify_ssl_certs else False}
+        if self._proxy:
+            kwargs["proxies"] = self._proxy
+        if is_streaming:
+            kwargs["stream"] = True
+
+        pool = self.get_pool(self._pool_key(headers))
+        try:
+            result = pool.session.request(method, url, headers=headers, data=post_data, timeout=self._timeout, **kwargs)
+            content = result.raw if is_streaming else result.content
+            status_code = result.status_code
+        except Exception as e:
+            pool.healthy = False
+            self._handle_request_error(e)
+
+        pool.healthy = True
+        return content, status_code, result.headers
+
+    def evict_idle(self):
+        """回收空闲超时的连接池，返回回收数量"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, pool in self._pools.items() if now - pool.last_used > self.idle_timeout]
+            pools = [self._pools.pop(key) for key in expired]
+        for pool in pools:
+            pool.close()
+        return len(pools)
+
+    def health_check(self, api_base=None):
+        """
+        对每个连接池发起一次轻量请求，确认到 Stripe 的连接可用；
+        失败的池会被关闭并重建，避免后续请求拿到半开连接。
+        """
+        url = f"{api_base or stripe.api_base}/v1"
+        results = {}
+        with self._lock:
+            items = list(self._pools.items())
+        for key, pool in items:
+            try:
+                pool.session.head(url, timeout=5, verify=stripe.ca_bundle_path if self._verify_ssl_certs else False)
+                pool.healthy = True
+            except requests.RequestException:
+                pool.healthy = False
+                with self._lock:
+                    if self._pools.get(key) is pool:
+                        self._pools[key] = ConnectionPool(self.pool_size)
+                pool.close()
+            results[f"{_mask(key[0])}:{key[1] or '-'}"] = pool.healthy
+        return results
+
+    async def warm(self, key, connections, api_base=None):
+        """
+        预先建立 connections 条到 Stripe 的连接放入 key（密钥, 连接账户）对应的池，
+        并发发起轻量请求，使冷启动后的首批请求不必等待 DNS 解析与 TLS 握手。返回新建的连接数。
+        """
+        pool = self.get_pool(key)
+        url = f"{api_base or stripe.api_base}/v1"
+        verify = stripe.ca_bundle_path if self._verify_ssl_certs else False
+        count = min(connections, self.pool_size)
+        before = pool.stats.new_connections
+        loop = asyncio.get_running_loop()
+        # 独立线程池：默认执行器的线程数可能少于 count，请求会排队复用同一条连接
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            await asyncio.gather(*(
+                loop.run_in_executor(executor, functools.partial(pool.session.head, url, timeout=5, verify=verify))
+                for _ in range(count)
+            ))
+        return pool.stats.new_connections - before
+
+    async def maintain_forever(self, interval):
+        """后台维护任务：定期回收空闲连接池并做健康检查"""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.evict_idle)
+            await asyncio.to_thread(self.health_check)
+
+    def stats(self):
+        with self._lock:
+            items = list(self._pools.items())
+        now = time.monotonic()
+        return {
+            f"{_mask(secret)}:{account or '-'}": dict(
+                pool.stats.to_dict(),
+                healthy=pool.healthy,
+                idle_seconds=round(now - pool.last_used, 3),
+                pool_size=self.pool_size,
+            )
+            for (secret, account), pool in items
+        }
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
@@ -0,0 +1,302 @@
+# Stripe Webhook 接收与异步处理 - 以事件推送代替状态轮询
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import stripe
+
+from backend.card_index import payment_summary
+from backend.ledger import build_payment_details
+
+logger = logging.getLogger(__name__)
+
+# 会改变支付或退款状态、需要刷新本地台账的事件
+PAYMENT_INTENT_EVENTS = (
+    "payment_intent.succeeded",
+    "payment_intent.canceled",
+    "payment_intent.payment_failed",
+    "payment_intent.requires_action",
+    "payment_intent.processing",
+    "payment_intent.amount_capturable_updated",
+)
+REFUND_EVENTS = (
+    "charge.refunded",
+    "charge.refund.updated",
+    "refund.created",
+    "refund.updated",
+    "refund.failed",
+)
+
+# 对象版本（最近处理的事件时间）的保留时间（秒）：Stripe 对投递失败的事件最多重试 3 天
+OBJECT_VERSION_RETENTION = 3 * 24 * 3600
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """生成与 Stripe 相同格式的 Stripe-Signature 请求头（用于回放工具与基准测试）"""
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+class WebhookSignatureError(Exception):
+    pass
+
+
+class WebhookProcessor:
+    """
+    Webhook 事件管道：
+
+    1. receive() 校验签名、按事件 ID 去重并落库（在线程中进行），随后立即返回
+    2. 后台 worker 从队列中取出事件，更新本地台账与卡索引：PaymentIntent 事件自带完整的详情
+       （含 charges，payment_method 已展开或与台账中的一致）且不早于已处理的事件时，直接以事件内容写入台账；
+       内容不完整、事件乱序到达，以及退款事件，才向 Stripe 重新拉取
+    3. 未处理完的事件保存在 SQLite 中，进程重启后会重新入队
+
+    配置了 merchants（MerchantRegistry）时，按事件对象的 metadata.merchant_id 或事件的连接账户（account）
+    确定所属商户，以该商户的网关刷新台账并写入该商户的 scope，商户以自己的密钥或连接账户创建的支付也能取回。
+    """
+
+    def __init__(self, gateway, ledger, card_index, secret=None, path=None, workers=None, tolerance=300,
+                 merchants=None):
+        self.gateway = gateway
+        self.merchants = merchants
+        self.ledger = ledger
+        self.card_index = card_index
+        self.secret = secret or os.getenv("STRIPE_WEBHOOK_SECRET")
+        self.path = path or os.getenv("STRIPE_LEDGER_PATH", "payment_ledger.db")
+        self.workers = workers or int(os.getenv("STRIPE_WEBHOOK_WORKERS", "4"))
+        self.tolerance = tolerance
+        self.queue = None
+        self._tasks = []
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events ("
+            " event_id TEXT PRIMARY KEY,"
+            " type TEXT NOT NULL,"
+            " created INTEGER NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " received_at REAL NOT NULL,"
+            " processed_at REAL)"
+        )
+        # 每个对象最近处理的事件时间，用于识别乱序到达的事件
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_object_versions ("
+            " object_id TEXT PRIMARY KEY,"
+            " created INTEGER NOT NULL)"
+        )
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+        self.applied = 0
+        self.refreshed = 0
+        self._versions = 0
+
+    # ---- 接收 ----
+    async def receive(self, payload: bytes, sig_header):
+        """
+        校验签名并入队，返回 (event_id, 是否为重复事件)。
+        签名无效时抛出 WebhookSignatureError。
+        """
+        if not self.secret:
+            raise WebhookSignatureError("STRIPE_WEBHOOK_SECRET 未配置")
+        text = payload.decode("utf-8")
+        try:
+            stripe.WebhookSignature.verify_header(text, sig_header or "", self.secret, self.tolerance)
+        except stripe.error.SignatureVerificationError as e:
+            raise WebhookSignatureError(str(e))
+
+        event = json.loads(text)
+        event_id = event["id"]
+        inserted = await asyncio.to_thread(self._insert, event, text)
+        self.received += 1
+        if not inserted:
+            self.duplicates += 1
+            return event_id, True
+        self.queue.put_nowait(event)
+        return event_id, False
+
+    def _insert(self, event, text):
+        with self._lock:
+            return self._conn.execute(
+                "INSERT OR IGNORE INTO webhook_events (event_id, type, created, payload, received_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (event["id"], event["type"], event.get("created", 0), text, time.time()),
+            ).rowcount
+
+    def _advance(self, object_id, created):
+        """记录对象最近处理的事件时间；事件不晚于已处理的事件（乱序或同一秒内）时返回 False"""
+        with self._lock:
+            advanced = self._conn.execute(
+                "INSERT INTO webhook_object_versions (object_id, created) VALUES (?, ?)"
+                " ON CONFLICT (object_id) DO UPDATE SET created = excluded.created"
+                " WHERE excluded.created > webhook_object_versions.created",
+                (object_id, created),
+            ).rowcount == 1
+            self._versions += 1
+            # 定期清理，保持表大小有界
+            if self._versions % 1000 == 0:
+                self._conn.execute("DELETE FROM webhook_object_versions WHERE created < ?",
+                                   (time.time() - OBJECT_VERSION_RETENTION,))
+            return advanced
+
+    def _details_from_event(self, obj, scope):
+        """
+        由事件中的 PaymentIntent 构建台账详情；内容不完整时返回 None。
+        事件中的 payment_method 通常只是 ID，与台账中已展开的同一 PaymentMethod 一致时沿用台账中的内容。
+        """
+        charges = obj.get("charges")
+        if charges is None or charges.get("data") is None or charges.get("has_more"):
+            return None
+        payment_method = obj.get("payment_method")
+        if isinstance(payment_method, str):
+            cached = self.ledger.get(obj.id, scope)
+            if cached is None or (cached.payment_method or {}).get("id") != payment_method:
+                return None
+            obj = stripe.util.convert_to_stripe_object(dict(obj.to_dict_recursive(), payment_method=cached.payment_method))
+        return build_payment_details(obj)
+
+    # ---- 处理 ----
+    async def start(self):
+        self.queue = asyncio.Queue()
+        with self._lock:
+            pending = self._conn.execute(
+                "SELECT payload FROM webhook_events WHERE processed_at IS NULL ORDER BY created"
+            ).fetchall()
+        for (payload,) in pending:
+            self.queue.put_nowait(json.loads(payload))
+        if pending:
+            logger.info("Re-queued %d unprocessed webhook events", len(pending), extra={"event": "webhook.requeued"})
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                await self.handle(event)
+                with self._lock:
+                    self._conn.execute("UPDATE webhook_events SET processed_at = ? WHERE event_id = ?",
+                                       (time.time(), event["id"]))
+                self.processed += 1
+            except Exception as e:
+                # 保持 processed_at 为空，重启或回放时会再次处理
+                self.failed += 1
+                logger.error("Webhook event %s (%s) failed: %s", event.get("id"), event.get("type"), e,
+                             extra={"event": "webhook.failed", "error": type(e).__name__})
+            finally:
+                self.queue.task_done()
+
+    async def handle(self, event):
+        event_type = event["type"]
+        obj = stripe.util.convert_to_stripe_object(event["data"]["object"])
+        scope, gateway = None, self.gateway
+        if self.merchants is not None:
+            scope = self.merchants.owner((obj.get("metadata") or {}).get("merchant_id"), event.get("account"))
+            gateway = self.merchants.resolve(scope)
+        if event_type in PAYMENT_INTENT_EVENTS:
+            payment_intent_id = obj.id
+            if obj.get("payment_method"):
+                payment_method_id = obj.payment_method if isinstance(obj.payment_method, str) else obj.payment_method.id
+                charges = getattr(obj.get("charges"), "data", [])
+                await asyncio.to_thread(self.card_index.add, payment_method_id,
+                                        payment_summary(obj, [charge.to_dict() for charge in charges]), scope)
+            await asyncio.to_thread(self.card_index.update_status, payment_intent_id, obj.status)
+            # 事件按时到达且内容完整时直接写入台账，无需再向 Stripe 拉取
+            if await asyncio.to_thread(self._advance, payment_intent_id, event.get("created", 0)):
+                details = await asyncio.to_thread(self._details_from_event, obj, scope)
+                if details is not None:
+                    await asyncio.to_thread(self.ledger.put, details, scope)
+                    self.applied += 1
+                    return
+        elif event_type in REFUND_EVENTS:
+            payment_intent_id = obj.get("payment_intent")
+        else:
+            return
+        if payment_intent_id:
+            # 主动刷新台账，后续的状态查询直接命中本地
+            await asyncio.to_thread(self.ledger.invalidate, payment_intent_id)
+            await self.ledger.refresh(gateway, payment_intent_id, scope)
+            self.refreshed += 1
+
+    # ---- 回放 ----
+    def replay(self, event_id=None, since=None, event_type=None):
+        """将已保存的事件重新入队（不受去重影响），返回入队数量"""
+        where, params = ["1 = 1"], []
+        if event_id:
+            where.append("event_id = ?")
+            params.append(event_id)
+        if since:
+            where.append("created >= ?")
+            params.append(since)
+        if event_type:
+            where.append("type = ?")
+            params.append(event_type)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT payload FROM webhook_events WHERE {' AND '.join(where)} ORDER BY created", params
+            ).fetchall()
+        for (payload,) in rows:
+            self.queue.put_nowait(json.loads(payload))
+        return len(rows)
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "processed": self.processed,
+            "failed": self.failed,
+            "applied": self.applied,
+            "refreshed": self.refreshed,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _replay_file(args):
+    """读取 NDJSON 事件文件，重新签名后逐条投递到 webhook 地址"""
+    import requests
+
+    secret = args.secret or os.getenv("STRIPE_WEBHOOK_SECRET")
+    session = requests.Session()
+    sent = 0
+    with open(args.file, encoding="utf-8") as f:
+        for line in f:
+            payload = line.strip()
+            if not payload:
+                continue
+            response = session.post(args.url, data=payload.encode("utf-8"), headers={
+                "Content-Type": "application/json",
+                "Stripe-Signature": sign_payload(payload, secret),
+            })
+            sent += 1
+            if response.status_code != 200:
+                print(f"line {sent}: HTTP {response.status_code} {response.text}")
+    print(f"replayed {sent} events to {args.url}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Stripe webhook 事件回放工具")
+    parser.add_argument("file", help="NDJSON 格式的事件文件，每行一个 Stripe Event")
+    parser.add_argument("--url", default="http://127.0.0.1:8001/webhooks/stripe")
+    parser.add_argument("--secret", help="签名密钥，默认读取 STRIPE_WEBHOOK_SECRET")
+    _replay_file(parser.parse_args())